@@ -1,6 +1,10 @@
 from flask import Flask
 import mysql.connector
 from config import SECRET_KEY, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT
+from config import DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_AGE
+from config import STORAGE_BACKEND, SQLITE_PATH, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE
+from app.pool import ConnectionPool
+from app.storage import create_storage
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
@@ -15,4 +19,26 @@ def get_db_connection():
     )
     return mydb
 
-from app import routes
\ No newline at end of file
+# Pool compartilhado pelas funções de app.models; evita um handshake TCP + autenticação por consulta
+db_pool = ConnectionPool(
+    get_db_connection,
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_age=DB_POOL_MAX_AGE
+)
+
+def db_connection():
+    """Empresta uma conexão do pool; use com `with` para garantir a devolução."""
+    return db_pool.connection()
+
+# Backend de armazenamento usado por app.models (MySQL ou SQLite, ver config.py)
+storage = create_storage(
+    STORAGE_BACKEND,
+    pool=db_pool,
+    sqlite_path=SQLITE_PATH,
+    synchronous=SQLITE_SYNCHRONOUS,
+    mmap_size=SQLITE_MMAP_SIZE,
+    cache_size=SQLITE_CACHE_SIZE
+)
+
+from app import routes
@@ -0,0 +1,226 @@
+"""Servidor assíncrono (ASGI): chat, histórico e novo/limpar chat como corrotinas.
+
+    python run.py 8000 --async
+
+No servidor síncrono cada chat em andamento ocupa uma thread enquanto
+espera o modelo, e o número de threads limita quantos chats o processo
+atende ao mesmo tempo. Aqui estas rotas são corrotinas do Quart (a versão
+assíncrona do Flask, com a mesma API) servidas pelo hypercorn:
+
+- POST / e POST /stream: a chamada ao GPT usa o cliente assíncrono
+  (ASYNC_LLM_MAX_CONNECTIONS conexões) e a espera no gateway não ocupa
+  thread, então milhares de chats em andamento cabem num processo;
+- GET /, GET /chat/<id>, GET /conversations, POST /new e POST /clear (o
+  histórico com os mesmos ETag e 304 de app.routes).
+
+O banco, os caches, a renderização e o Gemini (cujo SDK não tem cliente
+assíncrono pelo transporte REST) rodam no executor do loop, com
+ASYNC_EXECUTOR_WORKERS threads; como cada chamada ao banco é curta, poucas
+threads bastam para muitos chats. As demais rotas (jobs, busca, métricas,
+admin, arquivos estáticos) continuam as do Flask (app.routes), chamadas pelo
+mesmo servidor via WSGI numa thread do executor. A sessão é o mesmo cookie
+assinado com a SECRET_KEY nas duas.
+
+Milhares de chats simultâneos contra o stub: python -m benchmarks.async_chats
+"""
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, render_template, request, session, jsonify, Response
+from app import app as flask_app
+from app.models import (save_conversation, history_page, history_etag, load_chats,
+                        clear_conversations, checkpoint_conversation, get_response_async, stream_response_async,
+                        response_timings, is_error_response)
+from app.formatting import ResponseFormatter, format_response
+from app.routes import (choose_default_model, error_status, sse_event, generate_chat_id, group_chats_by_day,
+                        page_params, body_param, not_modified, history_headers, BODY_INVALIDO, CURSOR_INVALIDO)
+from config import SECRET_KEY, STREAM_CHECKPOINT_INTERVAL, ASYNC_EXECUTOR_WORKERS
+
+quart_app = Quart(__name__, root_path=flask_app.root_path)
+quart_app.secret_key = SECRET_KEY
+
+# Caminhos atendidos pelas corrotinas; o resto vai para o aplicativo Flask
+ASYNC_ROUTES = re.compile(r"^/(stream|chat/[^/]+|conversations|new|clear)?$")
+wsgi_app = AsyncioWSGIMiddleware(flask_app)
+
+
+async def application(scope, receive, send):
+    """Aplicativo ASGI servido pelo hypercorn (ver run.py)."""
+    if scope["type"] == "http" and not ASYNC_ROUTES.match(scope["path"]):
+        await wsgi_app(scope, receive, send)
+    else:
+        await quart_app(scope, receive, send)
+
+
+@quart_app.before_serving
+async def start_executor():
+    # Executor padrão do loop: usado por blocking(), pelas rotas WSGI e por app.models
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(ASYNC_EXECUTOR_WORKERS, thread_name_prefix="async-blocking"))
+
+
+async def blocking(fn, *args):
+    """Roda `fn(*args)` (banco, caches, renderização) no executor, sem travar as outras corrotinas."""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def session_ids():
+    """(user_id, chat_id) da sessão, criando os dois se faltarem (como em app.routes)."""
+    if "user_id" not in session:
+        session["user_id"] = "1"
+    if "chat_id" not in session:
+        session["chat_id"] = generate_chat_id()
+    return session["user_id"], session["chat_id"]
+
+
+@quart_app.route("/", methods=["GET", "POST"])
+async def index():
+    user_id, chat_id = session_ids()
+    default_model = choose_default_model()
+
+    if request.method == "POST":
+        form = await request.form
+        user_message = form["message"]
+        selected_model = form.get("model", default_model)
+
+        started = time.perf_counter()
+        response = await get_response_async(selected_model, user_message, user_id, chat_id)
+        response_timings.record(f"{selected_model}.response", time.perf_counter() - started)
+        formatted_response = await blocking(format_response, response)
+
+        if is_error_response(response):
+            return jsonify({'response': formatted_response, 'error': True}), error_status(response)
+
+        await blocking(save_conversation, user_id, chat_id, user_message, response, selected_model, formatted_response)
+        return jsonify({'response': formatted_response})
+
+    return await render_template(
+        "index.html",
+        default_model=default_model
+    )
+
+
+async def stream_turn(user_id, chat_id, user_message, model):
+    """app.routes.stream_turn para corrotinas: mesmos eventos, gravação no executor."""
+    started = time.perf_counter()
+    last_checkpoint = started
+    ttft = None
+    formatter = ResponseFormatter()
+    raw = []
+    html = ""
+    conversation_id = None
+    try:
+        async for text in stream_response_async(model, user_message, user_id, chat_id):
+            if ttft is None:
+                ttft = time.perf_counter() - started
+                response_timings.record(f"{model}.ttft", ttft)
+            raw.append(text)
+            delta = formatter.feed(text)
+            html += delta
+            yield sse_event({"html": delta, "tail": formatter.tail()})
+            if STREAM_CHECKPOINT_INTERVAL and time.perf_counter() - last_checkpoint >= STREAM_CHECKPOINT_INTERVAL:
+                conversation_id = await blocking(checkpoint_conversation, user_id, chat_id, user_message,
+                                                 "".join(raw), model, conversation_id)
+                last_checkpoint = time.perf_counter()
+    finally:
+        html += formatter.close()
+        text = "".join(raw)
+        failed = is_error_response(text)
+        if conversation_id is not None:
+            await blocking(checkpoint_conversation, user_id, chat_id, user_message, text, model, conversation_id, html)
+        elif not failed:
+            await blocking(save_conversation, user_id, chat_id, user_message, text, model, html)
+        total = time.perf_counter() - started
+        response_timings.record(f"{model}.stream_total", total)
+    yield sse_event({
+        "html": html,
+        "error": failed,
+        "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+        "total_ms": round(total * 1000, 1)
+    }, event="done")
+
+
+@quart_app.route("/stream", methods=["POST"])
+async def stream():
+    user_id, chat_id = session_ids()
+    form = await request.form
+    selected_model = form.get("model", choose_default_model())
+    response = Response(
+        stream_turn(user_id, chat_id, form["message"], selected_model),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Sem limite de tempo: a resposta dura o quanto o modelo levar para gerar
+    response.timeout = None
+    return response
+
+
+@quart_app.route("/clear", methods=["POST"])
+async def clear_history():
+    user_id = session.get("user_id", "1")
+    chat_id = session.get("chat_id")
+    if chat_id:
+        await blocking(clear_conversations, user_id, chat_id)
+    return jsonify({"status": "success"})
+
+
+@quart_app.route("/new", methods=["POST"])
+async def new_chat():
+    session['user_id'] = session.get("user_id", "1")
+    session["chat_id"] = generate_chat_id()
+    return jsonify({"status": "success", "action": "new_chat", "chat_id": session["chat_id"]})
+
+
+@quart_app.route("/chat/<chat_id>", methods=["GET"])
+async def load_chat(chat_id):
+    user_id = session.get("user_id", "1")
+    params = page_params(request.args)
+    if params is None:
+        return jsonify({"status": "error", "message": CURSOR_INVALIDO}), 400
+    before, limit = params
+    body = body_param(request.args)
+    if body is None:
+        return jsonify({"status": "error", "message": BODY_INVALIDO}), 400
+
+    session["chat_id"] = chat_id
+    etag, last_modified = await blocking(history_etag, user_id, chat_id, [before, limit, body])
+    if not_modified(request, etag):
+        return history_headers(Response("", status=304), etag, last_modified)
+
+    conversations, next_cursor, ok = await blocking(history_page, user_id, chat_id, before, limit, body)
+    response = jsonify({"conversations": conversations, "next_cursor": next_cursor})
+    return history_headers(response, etag if ok else None, last_modified)
+
+
+@quart_app.route("/conversations", methods=["GET"])
+async def get_conversations():
+    user_id = session.get("user_id", "1")
+    chat_id = session.get("chat_id")
+
+    if not user_id or not chat_id:
+        return jsonify({"conversations": [], "sidebar_conversations": {}, "current_chat_id": None, "next_cursor": None})
+
+    params = page_params(request.args)
+    if params is None:
+        return jsonify({"status": "error", "message": CURSOR_INVALIDO}), 400
+    before, limit = params
+    body = body_param(request.args)
+    if body is None:
+        return jsonify({"status": "error", "message": BODY_INVALIDO}), 400
+    etag, last_modified = await blocking(partial(history_etag, sidebar=True), user_id, chat_id, [before, limit, body])
+    if not_modified(request, etag):
+        return history_headers(Response("", status=304), etag, last_modified)
+    conversations, next_cursor, ok = await blocking(history_page, user_id, chat_id, before, limit, body)
+    chats, chats_next_cursor = await blocking(load_chats, user_id)
+
+    response = jsonify({
+        "conversations": conversations,
+        "sidebar_conversations": group_chats_by_day(chats),
+        "current_chat_id": chat_id,
+        "next_cursor": next_cursor,
+        "chats_next_cursor": chats_next_cursor
+    })
+    return history_headers(response, etag if ok else None, last_modified)
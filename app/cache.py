@@ -0,0 +1,421 @@
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+try:
+    from redis.exceptions import WatchError
+except ImportError:
+    class WatchError(Exception):
+        """A chave vigiada por WATCH mudou antes do EXEC (como redis.exceptions.WatchError)."""
+
+
+def _row_size(row):
+    """Estimativa do espaço ocupado por uma conversa em cache, em bytes."""
+    size = 200
+    for field in ("user_message", "gpt_response", "user_message_blob", "gpt_response_blob", "response_html"):
+        size += len(row.get(field) or "")
+    return size
+
+
+class TranscriptCache:
+    """Cache LRU em memória das conversas mais recentes de cada chat.
+
+    Cada entrada guarda até `window` conversas (da mais antiga para a mais
+    nova) e sabe se contém o chat inteiro (`complete`). O total é limitado a
+    `max_bytes`; entradas mais velhas que `ttl` segundos são descartadas.
+    `version` protege contra gravar no cache uma leitura que ficou velha
+    enquanto a consulta ao banco acontecia: é um relógio global, e o cache
+    lembra em que momento cada chat mudou (append/evict) só para as
+    `max_changes` mudanças mais recentes. Um chat mais antigo que isso conta
+    como mudado no momento da última mudança esquecida, o que no pior caso
+    recusa um put que valeria.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=300, window=200, max_changes=10000):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._window = window
+        self._entries = OrderedDict()  # chave -> [linhas, completo, bytes, expira_em]
+        self._clock = 0
+        self._changes = OrderedDict()  # chave -> relógio da última mudança, da mais antiga para a mais nova
+        self._max_changes = max_changes
+        self._forgotten = 0  # relógio da mudança mais recente já tirada de _changes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "appends": 0}
+
+    def version(self, key):
+        with self._lock:
+            return self._clock
+
+    def _bump(self, key):
+        self._clock += 1
+        self._changes[key] = self._clock
+        self._changes.move_to_end(key)
+        if len(self._changes) > self._max_changes:
+            _, self._forgotten = self._changes.popitem(last=False)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+        return entry
+
+    def get(self, key):
+        """Retorna (linhas da mais antiga para a mais nova, completo) ou None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[3] < time.monotonic():
+                self._drop(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return list(entry[0]), entry[1]
+
+    def put(self, key, rows, complete, version=None):
+        """Guarda as linhas (da mais antiga para a mais nova), se `version` ainda valer."""
+        with self._lock:
+            if version is not None and self._changes.get(key, self._forgotten) > version:
+                return False
+            if len(rows) > self._window:
+                rows = rows[-self._window:]
+                complete = False
+            size = sum(_row_size(row) for row in rows)
+            if size > self._max_bytes:
+                return False
+            self._drop(key)
+            self._entries[key] = [list(rows), complete, size, time.monotonic() + self._ttl]
+            self._bytes += size
+            self._evict_overflow()
+            return True
+
+    def append(self, key, rows):
+        """Acrescenta conversas recém-gravadas a uma entrada existente."""
+        with self._lock:
+            self._bump(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            added = sum(_row_size(row) for row in rows)
+            entry[0].extend(rows)
+            overflow = len(entry[0]) - self._window
+            if overflow > 0:
+                added -= sum(_row_size(row) for row in entry[0][:overflow])
+                del entry[0][:overflow]
+                entry[1] = False
+            entry[2] += added
+            self._bytes += added
+            self._entries.move_to_end(key)
+            self._stats["appends"] += 1
+            self._evict_overflow()
+
+    def evict(self, key):
+        with self._lock:
+            self._bump(key)
+            self._drop(key)
+
+    def _evict_overflow(self):
+        while self._bytes > self._max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._drop(key)
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["entries"] = len(self._entries)
+            data["changes"] = len(self._changes)
+            data["bytes"] = self._bytes
+            data["max_bytes"] = self._max_bytes
+            return data
+
+
+BLOB_FIELDS = ("user_message_blob", "gpt_response_blob")
+
+
+def _encode_row(row):
+    row = dict(row)
+    if isinstance(row.get("date_group"), date):
+        row["date_group"] = row["date_group"].isoformat()
+    for field in BLOB_FIELDS:
+        if row.get(field) is not None:
+            row[field] = base64.b64encode(bytes(row[field])).decode()
+    return json.dumps(row, default=str)
+
+
+def _decode_row(raw):
+    row = json.loads(raw)
+    if row.get("date_group"):
+        row["date_group"] = date.fromisoformat(row["date_group"])
+    for field in BLOB_FIELDS:
+        if row.get(field) is not None:
+            row[field] = base64.b64decode(row[field])
+    return row
+
+
+class SharedTranscriptCache:
+    """Mesma interface de TranscriptCache, guardada num servidor compartilhado.
+
+    Usa um cliente com a API do Redis (`redis.Redis` ou `LocalRedis`): as
+    conversas ficam numa lista por chat, e `append` só acrescenta se o chat já
+    estiver no cache. O limite de memória fica a cargo da política de despejo
+    do servidor (maxmemory); aqui vale o `ttl`, renovado em todas as chaves do
+    chat (lista, `complete` e versão) a cada gravação. O `put` vigia a versão
+    do chat com WATCH/MULTI: se um `append` ou `evict` de outro processo a
+    mudar no meio, a transação não é aplicada e o put é recusado. O `append`
+    vigia a lista e `complete` do mesmo jeito e tenta de novo algumas vezes;
+    se não conseguir, descarta o chat do cache.
+    """
+
+    APPEND_ATTEMPTS = 3
+
+    def __init__(self, client, ttl=300, window=200, prefix="transcript"):
+        self._client = client
+        self._ttl = ttl
+        self._window = window
+        self._prefix = prefix
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "appends": 0}
+
+    def _keys(self, key):
+        base = f"{self._prefix}:{key[0]}:{key[1]}"
+        return base + ":rows", base + ":complete", base + ":version"
+
+    def version(self, key):
+        return int(self._client.get(self._keys(key)[2]) or 0)
+
+    def get(self, key):
+        rows_key, complete_key, _ = self._keys(key)
+        # As duas chaves numa leitura só: uma expiração entre duas idas ao servidor daria ([], True)
+        with self._client.pipeline() as pipe:
+            pipe.multi()
+            pipe.get(complete_key)
+            pipe.lrange(rows_key, 0, -1)
+            complete, raw_rows = pipe.execute()
+        if complete is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        return [_decode_row(raw) for raw in raw_rows], complete in (b"1", "1")
+
+    def put(self, key, rows, complete, version=None):
+        rows_key, complete_key, version_key = self._keys(key)
+        if len(rows) > self._window:
+            rows = rows[-self._window:]
+            complete = False
+        encoded = [_encode_row(row) for row in rows]
+        with self._client.pipeline() as pipe:
+            try:
+                pipe.watch(version_key)
+                if version is not None and int(pipe.get(version_key) or 0) != version:
+                    return False
+                pipe.multi()
+                pipe.delete(rows_key)
+                if encoded:
+                    pipe.rpush(rows_key, *encoded)
+                    pipe.expire(rows_key, self._ttl)
+                pipe.set(complete_key, "1" if complete else "0", ex=self._ttl)
+                pipe.expire(version_key, self._ttl)
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def append(self, key, rows):
+        rows_key, complete_key, version_key = self._keys(key)
+        encoded = [_encode_row(row) for row in rows]
+        for _ in range(self.APPEND_ATTEMPTS):
+            with self._client.pipeline() as pipe:
+                try:
+                    pipe.watch(rows_key, complete_key)
+                    complete = pipe.get(complete_key)
+                    overflow = complete is not None and pipe.llen(rows_key) + len(encoded) > self._window
+                    pipe.multi()
+                    pipe.incr(version_key)
+                    pipe.expire(version_key, self._ttl)
+                    if complete is not None:
+                        pipe.rpush(rows_key, *encoded)
+                        if overflow:
+                            pipe.ltrim(rows_key, -self._window, -1)
+                        pipe.expire(rows_key, self._ttl)
+                        pipe.set(complete_key, "1" if complete in (b"1", "1") and not overflow else "0", ex=self._ttl)
+                    pipe.execute()
+                except WatchError:
+                    continue
+            if complete is not None:
+                self._stats["appends"] += 1
+            return
+        self.evict(key)
+
+    def evict(self, key):
+        rows_key, complete_key, version_key = self._keys(key)
+        with self._client.pipeline() as pipe:
+            pipe.multi()
+            pipe.incr(version_key)
+            pipe.expire(version_key, self._ttl)
+            pipe.delete(rows_key, complete_key)
+            pipe.execute()
+
+    def stats(self):
+        return dict(self._stats)
+
+
+class LocalRedis:
+    """Substituto em memória do subconjunto da API do Redis usado pelo cache.
+
+    Serve para testes e para rodar sem servidor; não é compartilhado entre
+    processos.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def pipeline(self):
+        return _LocalPipeline(self)
+
+    def _snapshot(self, key):
+        with self._lock:
+            if not self._alive(key):
+                return None
+            value = self._data[key]
+            return list(value) if isinstance(value, list) else value
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires < time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = str(value).encode()
+            self._expires.pop(key, None)
+            if ex is not None:
+                self._expires[key] = time.monotonic() + ex
+            return True
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, b"0")) + 1 if self._alive(key) else 1
+            self._data[key] = str(value).encode()
+            return value
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = 0
+            for key in keys:
+                if self._alive(key):
+                    removed += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self._expires[key] = time.monotonic() + seconds
+            return True
+
+    def rpush(self, key, *values):
+        with self._lock:
+            if not self._alive(key):
+                self._data[key] = []
+            items = self._data[key]
+            items.extend(v.encode() if isinstance(v, str) else v for v in values)
+            return len(items)
+
+    def ltrim(self, key, start, end):
+        with self._lock:
+            if self._alive(key):
+                items = self._data[key]
+                end = len(items) if end == -1 else end + 1
+                self._data[key] = items[start:end]
+            return True
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._data[key]) if self._alive(key) else 0
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            if not self._alive(key):
+                return []
+            items = self._data[key]
+            end = len(items) if end == -1 else end + 1
+            return items[start:end]
+
+
+class _LocalPipeline:
+    """pipeline() do LocalRedis: WATCH, comandos imediatos até MULTI, depois enfileirados até EXEC."""
+
+    def __init__(self, client):
+        self._client = client
+        self._watched = {}
+        self._commands = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def reset(self):
+        self._watched = {}
+        self._commands = None
+
+    def watch(self, *keys):
+        for key in keys:
+            self._watched[key] = self._client._snapshot(key)
+
+    def multi(self):
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+        if self._commands is None:
+            return command
+
+        def queued(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queued
+
+    def execute(self):
+        # O RLock do cliente segura os comandos da transação juntos
+        with self._client._lock:
+            if any(self._client._snapshot(key) != value for key, value in self._watched.items()):
+                self.reset()
+                raise WatchError("chave vigiada mudou")
+            results = [command(*args, **kwargs) for command, args, kwargs in self._commands or []]
+        self.reset()
+        return results
+
+
+def create_transcript_cache(backend, max_bytes, ttl, window, redis_url=None):
+    """Cria o cache conforme TRANSCRIPT_CACHE_BACKEND ("local", "redis" ou "none")."""
+    if backend == "none":
+        return None
+    if backend == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("TRANSCRIPT_CACHE_BACKEND = 'redis' requer o pacote redis (pip install redis).")
+        return SharedTranscriptCache(redis.Redis.from_url(redis_url), ttl=ttl, window=window)
+    if backend == "local-redis":
+        return SharedTranscriptCache(LocalRedis(), ttl=ttl, window=window)
+    return TranscriptCache(max_bytes=max_bytes, ttl=ttl, window=window)
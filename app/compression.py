@@ -0,0 +1,280 @@
+"""Compressão transparente do texto das conversas.
+
+Mensagens acima de COMPRESSION_MIN_BYTES são gravadas comprimidas nas colunas
+`user_message_blob`/`gpt_response_blob`, com o codec registrado na coluna
+`codec` ("zlib", "zstd", ou "zlib:<id>"/"zstd:<id>" quando usam o dicionário
+<id> da tabela `compression_dicts`). As respostas novas são o Markdown do
+modelo (response_format = 'markdown') e as antigas, HTML com `<br>`; nos
+dois casos há muitos trechos repetidos (cercas de código, títulos, palavras
+comuns), e um dicionário treinado no próprio histórico melhora bastante a
+taxa em mensagens curtas.
+
+Uso:
+    python -m app.compression train      # treina e grava um dicionário novo
+    python -m app.compression compress   # comprime o histórico existente em blocos
+    python -m app.compression report     # espaço economizado e custo de leitura
+"""
+import argparse
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from app.formatting import MARKDOWN
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_MAX_DICT = 32 * 1024
+
+
+def _segments(text, response_format):
+    """Trechos candidatos: linhas e palavras no Markdown, pedaços entre `<br>` no HTML antigo."""
+    if response_format == MARKDOWN:
+        pieces = []
+        for line in text.split("\n"):
+            pieces.append((line, "\n"))
+            pieces.extend((word, " ") for word in line.split())
+    else:
+        pieces = [(segment, "<br>") for segment in text.split("<br>")]
+    return [piece + separator for piece, separator in pieces if len(piece) >= 4]
+
+
+def train_zlib_dictionary(samples, size=ZLIB_MAX_DICT):
+    """Monta um dicionário zlib com os trechos mais repetidos das amostras.
+
+    `samples` são pares (texto, response_format). O deflate procura
+    referências nos últimos 32 KB, então os trechos mais frequentes vão para
+    o final do dicionário.
+    """
+    counts = Counter()
+    for text, response_format in samples:
+        counts.update(_segments(text, response_format))
+    chosen = []
+    total = 0
+    for segment, count in counts.most_common():
+        if count < 2 or total + len(segment.encode()) > size:
+            continue
+        chosen.append(segment)
+        total += len(segment.encode())
+    return "".join(reversed(chosen)).encode()
+
+
+def train_dictionary(codec, samples, size=ZLIB_MAX_DICT):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("COMPRESSION_CODEC = 'zstd' requer o pacote zstandard (pip install zstandard).")
+        return zstandard.train_dictionary(size, [text.encode() for text, _ in samples]).as_bytes()
+    return train_zlib_dictionary(samples, size)
+
+
+class BodyCodec:
+    """Codifica e decodifica o texto das mensagens.
+
+    `dictionaries` é uma função que devolve {id: (codec, bytes)}; é chamada de
+    novo quando aparece um id desconhecido (dicionário treinado por outro
+    processo). Os objetos do zstd não são thread-safe, por isso ficam por thread.
+    """
+
+    def __init__(self, codec="zlib", level=6, min_bytes=512, dictionaries=None, use_dictionary=True):
+        if codec == "zstd" and zstandard is None:
+            raise RuntimeError("COMPRESSION_CODEC = 'zstd' requer o pacote zstandard (pip install zstandard).")
+        self.codec = codec
+        self.level = level
+        self.min_bytes = min_bytes
+        self._load_dictionaries = dictionaries or (lambda: {})
+        self._use_dictionary = use_dictionary
+        self._dictionaries = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _all_dictionaries(self, dict_id=None):
+        with self._lock:
+            if self._dictionaries is None or (dict_id is not None and dict_id not in self._dictionaries):
+                self._dictionaries = self._load_dictionaries()
+            return self._dictionaries
+
+    def _dictionary(self, dict_id):
+        return self._all_dictionaries(dict_id).get(dict_id)
+
+    def reload(self):
+        with self._lock:
+            self._dictionaries = None
+        self._local = threading.local()
+
+    @property
+    def tag(self):
+        """Codec usado nas gravações novas, com o dicionário mais recente se houver."""
+        if not self._use_dictionary:
+            return self.codec
+        ids = [i for i, (codec, _) in self._all_dictionaries().items() if codec == self.codec]
+        return f"{self.codec}:{max(ids)}" if ids else self.codec
+
+    def _zstd(self, kind, dict_id):
+        cache = self._local.__dict__.setdefault(kind, {})
+        if dict_id not in cache:
+            data = zstandard.ZstdCompressionDict(self._dictionary(dict_id)[1]) if dict_id is not None else None
+            if kind == "c":
+                cache[dict_id] = zstandard.ZstdCompressor(level=self.level, dict_data=data)
+            else:
+                cache[dict_id] = zstandard.ZstdDecompressor(dict_data=data)
+        return cache[dict_id]
+
+    @staticmethod
+    def _split(tag):
+        codec, _, dict_id = tag.partition(":")
+        return codec, int(dict_id) if dict_id else None
+
+    def compress(self, tag, text):
+        codec, dict_id = self._split(tag)
+        data = text.encode()
+        if codec == "zstd":
+            return self._zstd("c", dict_id).compress(data)
+        if dict_id is not None:
+            compressor = zlib.compressobj(self.level, zdict=self._dictionary(dict_id)[1])
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, tag, blob):
+        codec, dict_id = self._split(tag)
+        if codec == "zstd":
+            return self._zstd("d", dict_id).decompress(bytes(blob)).decode()
+        if dict_id is not None:
+            decompressor = zlib.decompressobj(zdict=self._dictionary(dict_id)[1])
+        else:
+            decompressor = zlib.decompressobj()
+        return (decompressor.decompress(bytes(blob)) + decompressor.flush()).decode()
+
+    def encode(self, user_message, gpt_response, tag=None):
+        """Retorna (codec, user_message, gpt_response, user_blob, response_blob).
+
+        Só comprime os campos acima de `min_bytes` e só se ficarem menores;
+        o campo comprimido vai como None na coluna de texto.
+        """
+        tag = tag or self.tag
+        fields = []
+        used = False
+        for text in (user_message, gpt_response):
+            if text is not None and len(text) >= self.min_bytes:
+                blob = self.compress(tag, text)
+                if len(blob) < len(text.encode()):
+                    fields.append((None, blob))
+                    used = True
+                    continue
+            fields.append((text, None))
+        return (tag if used else None, fields[0][0], fields[1][0], fields[0][1], fields[1][1])
+
+    def decode(self, row):
+        """Devolve uma cópia da conversa com o texto descomprimido."""
+        row = dict(row)
+        codec = row.pop("codec", None)
+        for field in ("user_message", "gpt_response"):
+            blob = row.pop(field + "_blob", None)
+            if codec and blob is not None:
+                row[field] = self.decompress(codec, blob)
+        return row
+
+
+def _compress_history(storage, codec, chunk, pause, log=print):
+    """Comprime as linhas antigas em blocos de `chunk` ids, com pausa entre eles."""
+    last_id = 0
+    total = 0
+    tag = codec.tag
+    while True:
+        rows = storage.uncompressed_rows(last_id, chunk)
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            row_codec, user_message, gpt_response, user_blob, response_blob = codec.encode(
+                row["user_message"], row["gpt_response"], tag)
+            if row_codec:
+                updates.append((row_codec, user_message, gpt_response, user_blob, response_blob, row["id"]))
+        storage.update_bodies(updates)
+        last_id = rows[-1]["id"]
+        total += len(updates)
+        log(f"  até o id {last_id}: {total} linhas comprimidas")
+        time.sleep(pause)
+    return total
+
+
+def _report(storage, codec, sample_chats, log=print):
+    """Mostra o espaço economizado e o custo de descomprimir uma página de chat."""
+    stored = original = rows = compressed = 0
+    last_id = 0
+    while True:
+        batch = storage.body_rows(last_id, 1000)
+        if not batch:
+            break
+        for row in batch:
+            rows += 1
+            for field in ("user_message", "gpt_response"):
+                text = row[field]
+                blob = row[field + "_blob"]
+                if blob is not None:
+                    compressed += 1
+                    stored += len(blob)
+                    original += len(codec.decompress(row["codec"], blob).encode())
+                elif text is not None:
+                    stored += len(text.encode())
+                    original += len(text.encode())
+        last_id = batch[-1]["id"]
+    saved = original - stored
+    log(f"Linhas: {rows}; campos comprimidos: {compressed}")
+    log(f"Texto original: {original / 1024:.1f} KiB; armazenado: {stored / 1024:.1f} KiB; "
+        f"economia: {saved / 1024:.1f} KiB ({100 * saved / max(original, 1):.1f}%)")
+
+    timings = []
+    for user_id, chat_id in storage.sample_chats(sample_chats):
+        page = storage.query_page(user_id, chat_id, None, 50)
+        started = time.perf_counter()
+        for row in page:
+            codec.decode(row)
+        timings.append((time.perf_counter() - started) * 1000)
+    if timings:
+        timings.sort()
+        log(f"Descompressão por página de 50 mensagens ({len(timings)} chats): "
+            f"p50 {timings[len(timings) // 2]:.3f} ms, máx {timings[-1]:.3f} ms")
+
+
+def main(argv=None):
+    from app import storage
+    from app.models import body_codec
+    from config import COMPRESSION_CODEC
+
+    parser = argparse.ArgumentParser(description="Compressão do histórico de conversas")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train = sub.add_parser("train", help="treina um dicionário com as mensagens mais recentes")
+    train.add_argument("--samples", type=int, default=5000)
+    train.add_argument("--size", type=int, default=ZLIB_MAX_DICT)
+    compress = sub.add_parser("compress", help="comprime as linhas ainda não comprimidas")
+    compress.add_argument("--chunk", type=int, default=500)
+    compress.add_argument("--pause", type=float, default=0.05, help="segundos entre blocos")
+    report = sub.add_parser("report", help="espaço economizado e custo de leitura")
+    report.add_argument("--chats", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    codec = body_codec or BodyCodec(COMPRESSION_CODEC)
+    try:
+        if args.command == "train":
+            samples = storage.sample_bodies(args.samples)
+            data = train_dictionary(codec.codec, samples, args.size)
+            dict_id = storage.save_dictionary(codec.codec, data)
+            print(f"Dicionário {codec.codec}:{dict_id} gravado ({len(data)} bytes, {len(samples)} amostras).")
+        elif args.command == "compress":
+            codec.reload()
+            total = _compress_history(storage, codec, args.chunk, args.pause)
+            print(f"{total} linhas comprimidas com {codec.tag}.")
+        else:
+            _report(storage, codec, args.chats)
+        return 0
+    except storage.errors as err:
+        print(f"Erro de banco de dados: {err}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Histórico das conversas enviado aos modelos, dentro de um orçamento de tokens.
+
+Cada conversa guarda, ao ser gravada, quantos tokens têm a mensagem e a
+resposta (colunas `user_tokens` e `response_tokens`). Para montar o
+contexto de uma pergunta basta ler as conversas mais recentes do chat (do
+cache de conversas, na maioria das vezes) e somar os tokens da mais nova
+para a mais antiga até o orçamento: o custo depende do tamanho da janela,
+não do tamanho do chat.
+
+O que sai da janela é resumido em segundo plano pelo `SummaryRefresher`:
+o resumo de cada chat fica na tabela `chats` junto com o id da última
+conversa que ele cobre, e vai sendo atualizado (resumo anterior + conversas
+novas) à medida que a janela anda.
+
+Com o pacote tiktoken instalado, os tokens são contados com o cl100k_base;
+sem ele, usa a estimativa de ~4 caracteres por token do gateway.
+"""
+import html
+import queue
+import re
+import threading
+from app.formatting import MARKDOWN
+from app.gateway import estimate_tokens
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # sem o pacote ou sem o arquivo do encoding (instalação offline)
+    _encoding = None
+
+BREAK_RE = re.compile(r"<br\s*/?>|<hr>|</(?:p|li|pre|h[1-6])>", re.IGNORECASE)
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def plain_text(response):
+    """Texto de uma resposta gravada em HTML (<br> e o fim de cada bloco viram quebra de linha)."""
+    if not response:
+        return ""
+    return html.unescape(TAG_RE.sub("", BREAK_RE.sub("\n", response)))
+
+
+def response_text(conversation):
+    """Texto sem formatação da resposta: o Markdown gravado ou, nas linhas antigas, o HTML sem as tags."""
+    if conversation.get("response_format") == MARKDOWN:
+        return conversation["gpt_response"] or ""
+    return plain_text(conversation["gpt_response"])
+
+
+def turn_tokens(conversation):
+    """Tokens de uma conversa; calcula na hora para linhas gravadas antes da contagem."""
+    user_tokens = conversation.get("user_tokens")
+    response_tokens = conversation.get("response_tokens")
+    if user_tokens is None:
+        user_tokens = count_tokens(conversation["user_message"])
+    if response_tokens is None:
+        response_tokens = count_tokens(response_text(conversation))
+    return user_tokens + response_tokens
+
+
+def select_window(conversations, budget, summarized_through=None):
+    """Escolhe as conversas mais recentes que cabem em `budget` tokens.
+
+    `conversations` vem da mais nova para a mais antiga. Devolve (turnos da
+    mais antiga para a mais nova, tokens usados, overflow); overflow indica
+    que o orçamento deixou de fora conversas ainda não cobertas pelo resumo.
+    """
+    selected = []
+    used = 0
+    for conv in conversations:
+        if summarized_through is not None and conv["id"] is not None and conv["id"] <= summarized_through:
+            return selected[::-1], used, False
+        cost = turn_tokens(conv)
+        if used + cost > budget:
+            return selected[::-1], used, True
+        selected.append(conv)
+        used += cost
+    return selected[::-1], used, False
+
+
+class SummaryRefresher:
+    """Fila de chats cujo resumo precisa ser atualizado, atendida por uma thread.
+
+    Um chat já na fila não entra de novo; com a fila cheia o pedido é
+    descartado (o próximo pedido do chat tenta outra vez).
+    """
+
+    def __init__(self, refresh, maxsize=1000):
+        self._refresh = refresh
+        self._queue = queue.Queue(maxsize)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {"requested": 0, "refreshed": 0, "failed": 0, "dropped": 0}
+
+    def request(self, key, *args):
+        with self._lock:
+            if key in self._queued:
+                return False
+            try:
+                self._queue.put_nowait((key, args))
+            except queue.Full:
+                self._stats["dropped"] += 1
+                return False
+            self._queued.add(key)
+            self._stats["requested"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="summary-refresher", daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            key, args = self._queue.get()
+            with self._lock:
+                self._queued.discard(key)
+            try:
+                self._refresh(key, *args)
+                outcome = "refreshed"
+            except Exception as e:
+                print(f"Erro ao atualizar o resumo do chat {key}: {e}")
+                outcome = "failed"
+            with self._lock:
+                self._stats[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["queued"] = len(self._queued)
+            return data
@@ -0,0 +1,443 @@
+"""Renderização das respostas dos modelos (Markdown) em HTML seguro para o chat.
+
+O `ResponseFormatter` lê o texto linha a linha, numa única passada, e
+reconhece o Markdown que os modelos usam: blocos de código (``` ou ~~~),
+listas com e sem número (aninhadas pela indentação), títulos, linhas
+horizontais, parágrafos, `código`, **negrito** e [links](https://...).
+O texto é escapado ao chegar (os marcadores do Markdown não são afetados);
+links só com http(s), mailto ou caminhos relativos. O custo é linear no
+tamanho da resposta.
+
+O HTML de uma linha só depende das linhas anteriores, então o formatador
+recebe o texto aos pedaços, como chega no streaming: `feed` devolve o HTML
+das linhas completas (que não muda mais), `tail()` uma prévia da linha
+ainda aberta com as tags pendentes fechadas, e `close()` o restante. A
+concatenação de tudo que `feed` e `close` devolvem é idêntica a
+`format_response(texto_completo)`.
+
+`format_response` guarda o resultado num cache LRU indexado pelo hash do
+texto: respostas repetidas (cache de respostas, regravações) não são
+renderizadas de novo.
+
+As conversas são gravadas com o texto do modelo (`response_format` =
+"markdown") e, opcionalmente, o HTML pronto em `response_html`, junto com a
+RENDER_VERSION que o gerou. O HTML que falta (ou de uma versão anterior do
+renderizador) é gerado em segundo plano pela `RenderQueue` ou em lote:
+
+    python -m app.formatting backfill --workers 4   # renderiza o histórico
+    python -m app.formatting backfill --force       # renderiza tudo de novo
+"""
+import argparse
+import hashlib
+import html
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from config import RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES
+
+FENCE_RE = re.compile(r"^([ \t]*)(`{3,}|~{3,})[ \t]*([^`\s]*)")
+HEADING_RE = re.compile(r"^ {0,3}(#{1,6})[ \t]+")
+HR_RE = re.compile(r"^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+BULLET_RE = re.compile(r"^([ \t]*)([-*+])[ \t]+")
+ORDERED_RE = re.compile(r"^([ \t]*)(\d{1,9})[.)][ \t]+")
+INLINE_RE = re.compile(r"`+|\*\*|\[")
+LINK_RE = re.compile(r"\[([^\[\]\n]*)\]\(([^()\s]*)\)")
+SAFE_URL_RE = re.compile(r"^(?:https?:|mailto:|/|#)", re.IGNORECASE)
+LANGUAGE_RE = re.compile(r"^[\w#+.-]+$")
+BLOCK_MARKERS = frozenset("`~-*_#+0123456789")   # Primeiro caractere das linhas que podem abrir um bloco
+NESTED_INDENT = 2   # Espaços a mais que abrem uma lista dentro do item anterior
+
+MARKDOWN = "markdown"   # response_format das conversas gravadas com o texto do modelo (None: HTML antigo)
+RENDER_VERSION = 1      # Aumente ao mudar o HTML gerado: o backfill renderiza de novo as versões anteriores
+
+
+def escape(text):
+    return html.escape(text, quote=True)
+
+
+def _indent(prefix):
+    return len(prefix.expandtabs(4))
+
+
+def _code_span(text):
+    # Como no CommonMark, um espaço de cada lado é removido (permite `` `crase` ``)
+    if len(text) > 2 and text[0] == " " and text[-1] == " " and text.strip():
+        text = text[1:-1]
+    return f"<code>{text}</code>"
+
+
+def _link(match):
+    label, url = match.group(1), match.group(2)
+    if not SAFE_URL_RE.match(url):
+        return label
+    return f'<a href="{url}" target="_blank" rel="noopener noreferrer">{label}</a>'
+
+
+def render_inline(text):
+    """Código, negrito e links de uma linha já escapada.
+
+    Cada marcador é visitado uma vez: a crase que fecha um trecho de código é
+    procurada por listas de posições por comprimento, com ponteiros que só
+    avançam; um ** sem par é devolvido como texto no fim.
+    """
+    if "`" not in text and "**" not in text and "[" not in text:
+        return text
+    tokens = [(m.start(), m.group()) for m in INLINE_RE.finditer(text)]
+    if not tokens:
+        return text
+    ticks = {}          # comprimento da sequência de crases -> posições
+    for start, token in tokens:
+        if token[0] == "`":
+            ticks.setdefault(len(token), []).append(start)
+    next_tick = dict.fromkeys(ticks, 0)
+    out = []
+    pos = 0
+    bold_at = None      # índice em `out` do <strong> ainda aberto
+    for start, token in tokens:
+        if start < pos:
+            continue    # dentro de um trecho de código ou link já emitido
+        if token[0] == "`":
+            size = len(token)
+            positions = ticks[size]
+            i = next_tick[size]
+            while i < len(positions) and positions[i] <= start:
+                i += 1
+            next_tick[size] = i
+            if i == len(positions):
+                continue    # sem crase de fechamento: fica como texto
+            out.append(text[pos:start])
+            out.append(_code_span(text[start + size:positions[i]]))
+            pos = positions[i] + size
+        elif token == "**":
+            out.append(text[pos:start])
+            if bold_at is None:
+                bold_at = len(out)
+                out.append("<strong>")
+            else:
+                out.append("</strong>")
+                bold_at = None
+            pos = start + 2
+        else:
+            match = LINK_RE.match(text, start)
+            if match is None:
+                continue
+            out.append(text[pos:start])
+            out.append(_link(match))
+            pos = match.end()
+    out.append(text[pos:])
+    if bold_at is not None:
+        out[bold_at] = "**"
+    return "".join(out)
+
+
+class ResponseFormatter:
+
+    def __init__(self):
+        self._line = ""         # linha ainda incompleta
+        self._code = None       # (caractere, tamanho, indentação) da cerca do bloco de código aberto
+        self._code_lines = 0    # linhas já emitidas no bloco de código
+        self._lists = []        # listas abertas: [tag, indentação], da externa para a interna
+        self._para = False      # parágrafo aberto
+        self._blank = False     # linha em branco desde o último conteúdo
+
+    def _close_para(self):
+        if self._para:
+            self._para = False
+            return "</p>"
+        return ""
+
+    def _close_lists(self, indent=-1):
+        """Fecha as listas com indentação maior que `indent` (todas, por padrão)."""
+        out = []
+        while self._lists and self._lists[-1][1] > indent:
+            out.append(f"</li></{self._lists.pop()[0]}>")
+        return "".join(out)
+
+    def _close_all(self):
+        out = ""
+        if self._code is not None:
+            out += "</code></pre>"
+            self._code = None
+        return out + self._close_para() + self._close_lists()
+
+    def _in_list(self, indent, lazy=True):
+        """Para uma linha que não é item: fecha as listas que ela encerra; True se continua um item.
+
+        Com `lazy`, texto logo abaixo do item (sem linha em branco) continua o item.
+        """
+        if not self._lists:
+            return False, ""
+        if lazy and not self._blank and indent <= self._lists[-1][1]:
+            return True, ""     # continuação "preguiçosa" do item, sem linha em branco
+        closed = self._close_lists(indent - 1)
+        return bool(self._lists), closed
+
+    def _item(self, indent, tag, start, content):
+        out = [self._close_para()]
+        lists = self._lists
+        while lists and indent < lists[-1][1]:
+            out.append(f"</li></{lists.pop()[0]}>")
+        if lists and indent < lists[-1][1] + NESTED_INDENT:
+            if lists[-1][0] == tag:
+                out.append("</li><li>")
+            else:
+                out.append(f"</li></{lists.pop()[0]}>")
+                lists = None
+        else:
+            lists = None
+        if lists is None:
+            attrs = f' start="{start}"' if tag == "ol" and start != 1 else ""
+            out.append(f"<{tag}{attrs}><li>")
+            self._lists.append([tag, indent])
+        out.append(render_inline(content))
+        return "".join(out)
+
+    def _render_line(self, line):
+        if self._code is not None:
+            fence = FENCE_RE.match(line)
+            char, size, _ = self._code
+            if fence and fence.group(2)[0] == char and len(fence.group(2)) >= size and not line[fence.end():].strip():
+                self._code = None
+                return "</code></pre>"
+            self._code_lines += 1
+            return ("\n" if self._code_lines > 1 else "") + line
+
+        text = line.strip()
+        if not text:
+            self._blank = True
+            return self._close_para()
+
+        out = ""
+        fence = FENCE_RE.match(line) if text[0] in BLOCK_MARKERS else None
+        if text[0] not in BLOCK_MARKERS:
+            out = self._paragraph(line, text)
+        elif fence:
+            indent = _indent(fence.group(1))
+            _, closed = self._in_list(indent, lazy=False)
+            out = self._close_para() + closed
+            language = fence.group(3)
+            attrs = f' class="language-{language}"' if language and LANGUAGE_RE.match(language) else ""
+            self._code = (fence.group(2)[0], len(fence.group(2)), indent)
+            self._code_lines = 0
+            out += f"<pre><code{attrs}>"
+        elif HR_RE.match(line):
+            out = self._close_para() + self._close_lists() + "<hr>"
+        elif HEADING_RE.match(line):
+            heading = HEADING_RE.match(line)
+            level = len(heading.group(1))
+            text = line[heading.end():].rstrip().rstrip("#").rstrip()
+            out = self._close_para() + self._close_lists() + f"<h{level}>{render_inline(text)}</h{level}>"
+        else:
+            item = BULLET_RE.match(line) or ORDERED_RE.match(line)
+            if item:
+                ordered = item.re is ORDERED_RE
+                out = self._item(_indent(item.group(1)), "ol" if ordered else "ul",
+                                 int(item.group(2)) if ordered else None, line[item.end():])
+            else:
+                out = self._paragraph(line, text)
+        self._blank = False
+        return out
+
+    def _paragraph(self, line, text):
+        continues, closed = self._in_list(_indent(line[:len(line) - len(line.lstrip())]))
+        if continues or self._para:
+            return closed + "<br>" + render_inline(text)
+        self._para = True
+        return closed + "<p>" + render_inline(text)
+
+    def feed(self, chunk):
+        """Recebe mais texto do modelo e devolve o HTML que ficou definitivo."""
+        lines = (self._line + escape(chunk)).split("\n")
+        self._line = lines.pop()
+        return "".join(self._render_line(line.rstrip("\r")) for line in lines)
+
+    def tail(self):
+        """Prévia da linha ainda aberta, com as tags pendentes fechadas (pode mudar com o próximo pedaço)."""
+        state = (self._code, self._code_lines, [item[:] for item in self._lists], self._para, self._blank)
+        preview = (self._render_line(self._line) if self._line else "") + self._close_all()
+        self._code, self._code_lines, self._lists, self._para, self._blank = state
+        return preview
+
+    def close(self):
+        """Fim da resposta: devolve o HTML restante, fechando os blocos abertos."""
+        out = self._render_line(self._line.rstrip("\r")) if self._line else ""
+        self._line = ""
+        return out + self._close_all()
+
+
+class RenderCache:
+    """Cache LRU do HTML renderizado, indexado pelo hash do texto."""
+
+    def __init__(self, max_entries=2000, max_bytes=8 * 1024 * 1024):
+        self._entries = OrderedDict()   # hash -> HTML
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            self._bytes += len(value)
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["entries"] = len(self._entries)
+            data["bytes"] = self._bytes
+            return data
+
+
+render_cache = RenderCache(RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES) if RENDER_CACHE_MAX_ENTRIES else None
+
+
+def render(response):
+    """Markdown -> HTML, sem cache."""
+    formatter = ResponseFormatter()
+    return formatter.feed(response) + formatter.close()
+
+
+def format_response(response):
+    """Formata a resposta do modelo (Markdown) como HTML seguro para o chat."""
+    if not response:
+        return ""
+    if render_cache is None:
+        return render(response)
+    key = hashlib.blake2b(response.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    cached = render_cache.get(key)
+    if cached is None:
+        cached = render(response)
+        render_cache.put(key, cached)
+    return cached
+
+
+class RenderQueue:
+    """Fila de conversas sem o HTML gravado, renderizadas por uma thread.
+
+    `save` recebe um lote [(id, chave do chat, html)] e grava. Uma conversa
+    já na fila não entra de novo; com a fila cheia o pedido é descartado (a
+    próxima leitura da conversa pede outra vez).
+    """
+
+    def __init__(self, save, maxsize=1000, batch_size=50):
+        self._save = save
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {"requested": 0, "rendered": 0, "failed": 0, "dropped": 0}
+
+    def request(self, conversation_id, key, text):
+        with self._lock:
+            if conversation_id in self._queued:
+                return False
+            try:
+                self._queue.put_nowait((conversation_id, key, text))
+            except queue.Full:
+                self._stats["dropped"] += 1
+                return False
+            self._queued.add(conversation_id)
+            self._stats["requested"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="render-queue", daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self._batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [(conversation_id, key, format_response(text)) for conversation_id, key, text in items]
+            try:
+                self._save(batch)
+                outcome = "rendered"
+            except Exception as e:
+                print(f"Erro ao gravar o HTML de {len(batch)} conversas: {e}")
+                outcome = "failed"
+            with self._lock:
+                self._queued.difference_update(item[0] for item in items)
+                self._stats[outcome] += len(items)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["queued"] = len(self._queued)
+            return data
+
+
+def _backfill(storage, codec, version, chunk, workers, pause, log=print):
+    """Renderiza, em blocos de `chunk` ids, as conversas com HTML ausente ou anterior a `version`.
+
+    A renderização roda em até `workers` processos (ela é limitada pela CPU);
+    a leitura e a gravação ficam no processo principal, um bloco por vez.
+    """
+    last_id = 0
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = storage.render_rows(last_id, chunk, version)
+            if not rows:
+                break
+            texts = [codec.decode(row)["gpt_response"] or "" for row in rows]
+            rendered = pool.map(render, texts, chunksize=max(1, len(texts) // (workers * 4)))
+            storage.update_rendered([(markup, RENDER_VERSION, row["id"]) for row, markup in zip(rows, rendered)])
+            last_id = rows[-1]["id"]
+            total += len(rows)
+            log(f"  até o id {last_id}: {total} conversas renderizadas")
+            time.sleep(pause)
+    return total
+
+
+def main(argv=None):
+    from app import storage
+    from app.models import body_codec
+
+    parser = argparse.ArgumentParser(description="HTML pré-renderizado das respostas")
+    sub = parser.add_subparsers(dest="command", required=True)
+    backfill = sub.add_parser("backfill", help="renderiza as conversas sem HTML ou de uma versão anterior")
+    backfill.add_argument("--chunk", type=int, default=500)
+    backfill.add_argument("--workers", type=int, default=2, help="processos renderizando ao mesmo tempo")
+    backfill.add_argument("--pause", type=float, default=0.05, help="segundos entre blocos")
+    backfill.add_argument("--force", action="store_true", help="renderiza também as que já estão na versão atual")
+    args = parser.parse_args(argv)
+
+    version = RENDER_VERSION + 1 if args.force else RENDER_VERSION
+    try:
+        total = _backfill(storage, body_codec, version, args.chunk, max(1, args.workers), args.pause)
+        print(f"{total} conversas renderizadas (versão {RENDER_VERSION}).")
+        return 0
+    except storage.errors as err:
+        print(f"Erro de banco de dados: {err}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""Controle de vazão das chamadas aos provedores de LLM.
+
+Cada provedor tem um `ProviderGateway` com:
+
+- um limite de chamadas simultâneas (`max_in_flight`);
+- baldes de tokens (token buckets) de requisições e de tokens por minuto,
+  do provedor e de cada usuário, para ficar logo abaixo das cotas em vez
+  de receber 429;
+- uma fila por ordem de chegada com tempo máximo de espera
+  (`wait_timeout`); quem passa do limite recebe `GatewayTimeout`.
+
+Os tokens de uma chamada são estimados antes (pergunta + reserva para a
+resposta) e acertados depois com o tamanho real da resposta. Um 429 do
+provedor zera o balde, e as chamadas seguintes esperam a recarga.
+
+Threads usam `acquire` (`with`) e corrotinas `acquire_async` (`async with`),
+que esperam na mesma fila sem ocupar uma thread.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from app.metrics import TimingStats
+
+
+class GatewayTimeout(Exception):
+    """A chamada esperou mais que `wait_timeout` por uma vaga no provedor."""
+
+
+def estimate_tokens(text):
+    """Estimativa grosseira (~4 caracteres por token), suficiente para os baldes."""
+    return max(1, len(text or "") // 4)
+
+
+def is_rate_limit_error(error):
+    """Reconhece o 429 dos SDKs do OpenAI (novo e antigo) e do Gemini."""
+    if getattr(error, "status_code", None) == 429 or getattr(error, "http_status", None) == 429:
+        return True
+    code = getattr(error, "code", None)
+    if code == 429 or getattr(code, "value", None) == 429:
+        return True
+    return type(error).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+
+def _wake_all(futures):
+    for future in futures:
+        if not future.done():
+            future.set_result(None)
+
+
+class TokenBucket:
+    """Balde de `per_minute` unidades, recarregado continuamente.
+
+    Um pedido maior que o balde inteiro passa quando o balde está cheio e
+    deixa o saldo negativo (a dívida é paga pela recarga).
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Segundos até haver saldo para `amount` (0 se já houver)."""
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def give_back(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0.0)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Permit:
+    """Vaga obtida no gateway; `settle` acerta os tokens com o uso real."""
+
+    def __init__(self, gateway, buckets, tokens):
+        self._gateway = gateway
+        self._buckets = buckets
+        self.tokens = tokens
+
+    def settle(self, tokens):
+        self._gateway._settle(self._buckets, tokens - self.tokens)
+        self.tokens = tokens
+
+
+class ProviderGateway:
+
+    MAX_TRACKED_USERS = 10000
+
+    def __init__(self, name, max_in_flight=None, rpm=None, tpm=None, user_rpm=None, user_tpm=None, wait_timeout=10):
+        self.name = name
+        self._max_in_flight = max_in_flight
+        self._rpm = TokenBucket(rpm) if rpm else None
+        self._tpm = TokenBucket(tpm) if tpm else None
+        self._user_rpm = user_rpm
+        self._user_tpm = user_tpm
+        self._users = {}   # user_id -> (balde de requisições ou None, balde de tokens ou None)
+        self._wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._wakers = {}  # loop -> futures das corrotinas esperando uma vaga
+        self._in_flight = 0
+        self._timings = TimingStats()
+        self._stats = {"acquired": 0, "timeouts": 0, "throttled": 0, "max_queue_depth": 0, "max_in_flight": 0}
+
+    def _user_buckets(self, user_id):
+        if user_id is None or not (self._user_rpm or self._user_tpm):
+            return None, None
+        buckets = self._users.get(user_id)
+        if buckets is None:
+            if len(self._users) >= self.MAX_TRACKED_USERS:
+                now = time.monotonic()
+                # Baldes cheios equivalem a baldes novos: podem ser esquecidos
+                self._users = {u: b for u, b in self._users.items()
+                               if not all(bucket is None or bucket.full(now) for bucket in b)}
+            buckets = self._users[user_id] = (TokenBucket(self._user_rpm) if self._user_rpm else None,
+                                              TokenBucket(self._user_tpm) if self._user_tpm else None)
+        return buckets
+
+    @staticmethod
+    def _wait_for(pairs, now):
+        return max([bucket.wait_time(amount, now) for bucket, amount in pairs if bucket is not None] or [0.0])
+
+    @staticmethod
+    def _take(pairs):
+        for bucket, amount in pairs:
+            if bucket is not None:
+                bucket.take(amount)
+
+    def _remaining(self, deadline):
+        """Segundos até o prazo; levanta GatewayTimeout se já passou."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._stats["timeouts"] += 1
+            raise GatewayTimeout(f"Limite de requisições do provedor {self.name} atingido.")
+        return remaining
+
+    def _wait(self, deadline, wait=None):
+        remaining = self._remaining(deadline)
+        self._cond.wait(remaining if wait is None else min(wait, remaining))
+
+    def _notify(self):
+        """Acorda quem espera uma vaga: as threads (Condition) e as corrotinas (futures no seu loop)."""
+        self._cond.notify_all()
+        wakers, self._wakers = self._wakers, {}
+        for loop, futures in wakers.items():
+            try:
+                loop.call_soon_threadsafe(_wake_all, futures)
+            except RuntimeError:
+                pass  # loop já fechado
+
+    def _try_user(self, pairs):
+        """Tenta a cota do usuário: 0 se conseguiu, senão os segundos até haver saldo."""
+        wait = self._wait_for(pairs, time.monotonic())
+        if wait == 0:
+            self._take(pairs)
+        return wait
+
+    def _try_provider(self, ticket, pairs):
+        """Tenta a vaga e a cota do provedor: 0 se conseguiu, a espera em segundos, ou None (não é a vez)."""
+        if self._queue[0] is not ticket or (self._max_in_flight is not None and self._in_flight >= self._max_in_flight):
+            return None
+        wait = self._wait_for(pairs, time.monotonic())
+        if wait == 0:
+            self._take(pairs)
+            self._in_flight += 1
+        return wait
+
+    def _enqueue(self, ticket):
+        self._queue.append(ticket)
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+
+    def _admitted(self):
+        self._stats["acquired"] += 1
+        self._stats["max_in_flight"] = max(self._stats["max_in_flight"], self._in_flight)
+
+    @staticmethod
+    def _give_back(pairs):
+        # Devolve a cota do usuário, que não chegou a ser usada
+        for bucket, amount in pairs:
+            if bucket is not None:
+                bucket.give_back(amount)
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._notify()
+
+    @contextmanager
+    def acquire(self, user_id=None, tokens=1):
+        """Espera uma vaga (simultaneidade + baldes) e a libera ao sair do `with`."""
+        started = time.monotonic()
+        deadline = started + self._wait_timeout
+        provider_pairs = [(self._rpm, 1), (self._tpm, tokens)]
+        with self._cond:
+            user_rpm, user_tpm = self._user_buckets(user_id)
+            user_pairs = [(user_rpm, 1), (user_tpm, tokens)]
+            # 1) cota do usuário, fora da fila, para um usuário no limite não travar os outros
+            while True:
+                wait = self._try_user(user_pairs)
+                if wait == 0:
+                    break
+                self._wait(deadline, wait)
+            # 2) fila por ordem de chegada para a vaga e a cota do provedor
+            ticket = object()
+            self._enqueue(ticket)
+            try:
+                while True:
+                    wait = self._try_provider(ticket, provider_pairs)
+                    if wait == 0:
+                        break
+                    self._wait(deadline, wait)
+            except GatewayTimeout:
+                self._give_back(user_pairs)
+                raise
+            finally:
+                self._queue.remove(ticket)
+                self._notify()
+            self._admitted()
+        self._timings.record("wait", time.monotonic() - started)
+        permit = Permit(self, [user_tpm, self._tpm], tokens)
+        try:
+            yield permit
+        finally:
+            self._release()
+
+    async def _wait_async(self, deadline, wait=None):
+        """`_wait` para corrotinas: dorme até ser avisado (`_notify`) ou até `wait`, sem ocupar thread."""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            remaining = self._remaining(deadline)
+            waker = loop.create_future()
+            self._wakers.setdefault(loop, []).append(waker)
+        await asyncio.wait([waker], timeout=remaining if wait is None else min(wait, remaining))
+
+    @asynccontextmanager
+    async def acquire_async(self, user_id=None, tokens=1):
+        """Como `acquire`, para corrotinas (`async with`): mesma fila e mesmas cotas das threads."""
+        started = time.monotonic()
+        deadline = started + self._wait_timeout
+        provider_pairs = [(self._rpm, 1), (self._tpm, tokens)]
+        with self._cond:
+            user_rpm, user_tpm = self._user_buckets(user_id)
+        user_pairs = [(user_rpm, 1), (user_tpm, tokens)]
+        while True:
+            with self._cond:
+                wait = self._try_user(user_pairs)
+            if wait == 0:
+                break
+            await self._wait_async(deadline, wait)
+        ticket = object()
+        with self._cond:
+            self._enqueue(ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_provider(ticket, provider_pairs)
+                if wait == 0:
+                    break
+                await self._wait_async(deadline, wait)
+        except (GatewayTimeout, asyncio.CancelledError):
+            with self._cond:
+                self._give_back(user_pairs)
+            raise
+        finally:
+            with self._cond:
+                self._queue.remove(ticket)
+                self._notify()
+        with self._cond:
+            self._admitted()
+        self._timings.record("wait", time.monotonic() - started)
+        permit = Permit(self, [user_tpm, self._tpm], tokens)
+        try:
+            yield permit
+        finally:
+            self._release()
+
+    def _settle(self, buckets, delta):
+        """Cobra (delta > 0) ou devolve (delta < 0) a diferença de tokens nos baldes."""
+        with self._cond:
+            for bucket in buckets:
+                if bucket is None:
+                    continue
+                if delta > 0:
+                    bucket.take(delta)
+                elif delta < 0:
+                    bucket.give_back(-delta)
+            self._notify()
+
+    def throttled(self):
+        """O provedor respondeu 429: esvazia os baldes para as próximas chamadas esperarem."""
+        with self._cond:
+            self._stats["throttled"] += 1
+            for bucket in (self._rpm, self._tpm):
+                if bucket is not None:
+                    bucket.drain()
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data["in_flight"] = self._in_flight
+            data["queue_depth"] = len(self._queue)
+            data["tracked_users"] = len(self._users)
+        data["wait"] = self._timings.snapshot().get("wait")
+        return data
@@ -0,0 +1,172 @@
+"""Pedidos com hedge entre provedores, para cortar a cauda da latência.
+
+O provedor principal recebe a pergunta; se ele não começar a responder
+(primeiro pedaço no streaming, resposta inteira sem streaming) dentro de
+`delay()` — o percentil `percentile` das latências recentes dele, entre
+`min_delay` e `max_delay` —, a mesma pergunta vai para o provedor reserva
+e vale quem responder primeiro. O perdedor é descartado: para na próxima
+vez que entregar um pedaço (uma chamada HTTP em andamento não tem como
+ser interrompida).
+
+O orçamento segue a ideia de "retry budget": cada pedido acumula `budget`
+créditos (até `max_credits`) e cada hedge gasta um, então no máximo uma
+fração `budget` dos pedidos dispara hedge, mesmo com o provedor lento.
+"""
+import queue
+import threading
+import time
+from collections import deque
+from app.metrics import percentile
+
+CHUNK, DONE, ERROR = "chunk", "done", "error"
+
+
+def _as_stream(fn):
+    """Gerador sem pedaços que devolve o resultado de fn(), para `call` reaproveitar `stream`."""
+    return fn()
+    yield
+
+
+class Hedger:
+
+    def __init__(self, percentile=0.95, min_delay=0.5, max_delay=10.0, budget=0.05, max_credits=10,
+                 window=500, min_samples=20):
+        self._percentile = percentile
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._budget = budget
+        self._max_credits = max_credits
+        self._credits = 0.0
+        self._latencies = deque(maxlen=window)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "hedges_fired": 0, "hedges_won": 0, "budget_denied": 0, "fallbacks": 0}
+
+    def delay(self):
+        """Segundos de espera pelo principal antes do hedge."""
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return self._max_delay
+            value = percentile(sorted(self._latencies), self._percentile)
+        return min(self._max_delay, max(self._min_delay, value))
+
+    def _record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _take_credit(self):
+        with self._lock:
+            if self._credits >= 1:
+                self._credits -= 1
+                self._stats["hedges_fired"] += 1
+                return True
+            self._stats["budget_denied"] += 1
+            return False
+
+    def stream(self, primary, secondary, fallback=False):
+        """Gera os pedaços de quem começar a responder primeiro.
+
+        `primary` e `secondary` são pares (nome, função que cria o gerador).
+        Devolve (via `yield from`) o par (nome do vencedor, valor de retorno
+        do gerador dele). Com `fallback`, um erro do principal antes do hedge
+        chama o reserva na hora; se nenhum responder, levanta o erro do principal.
+        """
+        events = queue.Queue()
+        stops = {}
+        started = time.monotonic()
+
+        def pump(name, make, stop, on_first=None):
+            try:
+                gen = make()
+                while True:
+                    try:
+                        chunk = next(gen)
+                    except StopIteration as done:
+                        if on_first:
+                            on_first(time.monotonic() - started)
+                        events.put((name, DONE, done.value))
+                        return
+                    if on_first:
+                        on_first(time.monotonic() - started)
+                        on_first = None
+                    events.put((name, CHUNK, chunk))
+                    if stop.is_set():
+                        gen.close()
+                        return
+            except Exception as e:
+                events.put((name, ERROR, e))
+
+        def launch(name, make, on_first=None):
+            stops[name] = threading.Event()
+            threading.Thread(target=pump, args=(name, make, stops[name], on_first), daemon=True).start()
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._credits = min(self._max_credits, self._credits + self._budget)
+        primary_name, secondary_name = primary[0], secondary[0]
+        launch(primary_name, primary[1], on_first=self._record)
+        deadline = started + self.delay()
+        winner = None
+        errors = {}
+        try:
+            while True:
+                timeout = None
+                if winner is None and deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    name, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    deadline = None
+                    if self._take_credit():
+                        launch(secondary_name, secondary[1])
+                    continue
+                if winner is None:
+                    if kind == ERROR:
+                        errors[name] = value
+                        if name == primary_name and fallback and secondary_name not in stops:
+                            deadline = None
+                            self._count("fallbacks")
+                            launch(secondary_name, secondary[1])
+                        if len(errors) == len(stops):
+                            raise errors.get(primary_name, value)
+                        continue
+                    winner = name
+                    if winner == secondary_name and primary_name not in errors:
+                        self._count("hedges_won")
+                    for other, stop in stops.items():
+                        if other != winner:
+                            stop.set()
+                if name != winner:
+                    continue
+                if kind == CHUNK:
+                    yield value
+                elif kind == DONE:
+                    return winner, value
+                else:
+                    raise value
+        finally:
+            for stop in stops.values():
+                stop.set()
+
+    def call(self, primary, secondary, fallback=False):
+        """Como `stream`, para funções que devolvem a resposta inteira: (vencedor, resposta)."""
+        gen = self.stream((primary[0], lambda: _as_stream(primary[1])),
+                          (secondary[0], lambda: _as_stream(secondary[1])), fallback)
+        try:
+            while True:
+                next(gen)
+        except StopIteration as done:
+            return done.value
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            data = dict(self._stats)
+            data["delay_ms"] = round(delay * 1000, 1)
+            data["hedge_rate"] = round(data["hedges_fired"] / data["requests"], 4) if data["requests"] else 0.0
+            data["samples"] = len(self._latencies)
+            return data
@@ -0,0 +1,512 @@
+"""Fila de jobs para as chamadas aos modelos, fora das threads do servidor web.
+
+`POST /jobs` só registra o job e responde com o id; workers (threads do
+próprio servidor ou processos à parte, com `python -m app.jobs worker`)
+executam o handler — pergunta ao modelo, formata e grava a conversa — e o
+cliente acompanha por `GET /jobs/<id>` ou `GET /jobs/<id>/events`.
+
+Um job falho é repetido até `max_attempts` vezes, com espera exponencial e
+jitter entre as tentativas; esgotadas as tentativas (ou com `PermanentError`)
+ele vai para a fila de mortos, de onde pode ser reenviado.
+
+Estados: queued -> running -> done | retrying -> running ... | dead.
+
+Dois backends, escolhidos por JOBS_BACKEND:
+
+- `LocalJobStore`: memória do processo; os workers têm que ser threads do
+  próprio servidor. Serve para testes e instalações de um só processo.
+- `RedisJobStore`: compartilhado entre processos; o servidor só enfileira e
+  os workers podem rodar em outras máquinas. O job em execução fica numa
+  lista de processamento com um lease de `lease` segundos, renovado pelo
+  worker enquanto ele roda; se o worker morre, o lease vence e qualquer
+  outro worker devolve o job à fila como uma tentativa falha.
+"""
+import argparse
+import heapq
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from app.resilience import backoff_delay
+
+QUEUED, RUNNING, RETRYING, DONE, DEAD = "queued", "running", "retrying", "done", "dead"
+FINISHED = (DONE, DEAD)
+
+
+class QueueFull(Exception):
+    """A fila de jobs atingiu o limite: o pedido deve ser recusado."""
+
+
+class PermanentError(Exception):
+    """Erro que não adianta repetir: o job vai direto para a fila de mortos."""
+
+
+class LeaseExpired(Exception):
+    """O worker que executava o job parou de renovar o lease (caiu ou travou)."""
+
+
+class LocalJobStore:
+    """Jobs, fila de prontos, fila de espera (retries) e fila de mortos em memória."""
+
+    def __init__(self, max_queued=1000, dead_letter_size=1000):
+        self._jobs = OrderedDict()   # id -> job (dict), na ordem de criação
+        self._expires = {}           # id -> instante em que o job terminado é descartado
+        self._ready = deque()
+        self._delayed = []           # heap de (quando, id)
+        self._dead = deque(maxlen=dead_letter_size)
+        self._max_queued = max_queued
+        self._changed = threading.Condition()
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, expires in self._expires.items() if expires < now]:
+            self._jobs.pop(job_id, None)
+            self._expires.pop(job_id)
+
+    def create(self, job):
+        with self._changed:
+            self._prune()
+            if len(self._ready) + len(self._delayed) >= self._max_queued:
+                raise QueueFull(f"{self._max_queued} jobs na fila.")
+            self._jobs[job["id"]] = dict(job)
+            self._ready.append(job["id"])
+            self._changed.notify_all()
+
+    def save(self, job, ttl=None):
+        with self._changed:
+            self._jobs[job["id"]] = dict(job)
+            if ttl is not None:
+                self._expires[job["id"]] = time.monotonic() + ttl
+            else:
+                self._expires.pop(job["id"], None)
+            self._changed.notify_all()
+
+    def load(self, job_id):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def push(self, job_id, delay=0):
+        with self._changed:
+            if delay > 0:
+                heapq.heappush(self._delayed, (time.monotonic() + delay, job_id))
+            else:
+                self._ready.append(job_id)
+            self._changed.notify_all()
+
+    def pop(self, timeout, lease=None):
+        """Próximo job pronto (os retries vencidos entram antes); None se não houver em `timeout` s."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._delayed)[1])
+                if self._ready:
+                    return self._ready.popleft()
+                wait = deadline - now
+                if self._delayed:
+                    wait = min(wait, self._delayed[0][0] - now)
+                if wait <= 0:
+                    return None
+                self._changed.wait(wait)
+
+    def wait(self, job_id, status, timeout):
+        """Espera o job sair do estado `status` (ou terminar); devolve o job."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] != status or job["status"] in FINISHED or remaining <= 0:
+                    return dict(job) if job is not None else None
+                self._changed.wait(remaining)
+
+    def add_dead(self, job_id):
+        with self._changed:
+            self._dead.appendleft(job_id)
+
+    def remove_dead(self, job_id):
+        with self._changed:
+            try:
+                self._dead.remove(job_id)
+                return True
+            except ValueError:
+                return False
+
+    def dead(self, limit):
+        with self._changed:
+            return list(self._dead)[:limit]
+
+    def counts(self):
+        with self._changed:
+            return {"queued": len(self._ready), "delayed": len(self._delayed), "dead": len(self._dead)}
+
+    # Os workers são threads deste processo: se ele morre, os jobs morrem junto
+    # e não há lease a vencer.
+
+    def renew(self, job_ids, lease):
+        pass
+
+    def ack(self, job_id):
+        pass
+
+    def expired(self, lease):
+        return []
+
+
+class RedisJobStore:
+    """Mesma interface de LocalJobStore sobre um cliente com a API do Redis.
+
+    Cada job é um JSON em `<prefix>:job:<id>`; os ids prontos ficam numa
+    lista (LPUSH/BLMOVE), os retries num sorted set pelo instante da nova
+    tentativa e os mortos numa lista limitada a `dead_letter_size`. O BLMOVE
+    passa o id para a lista `<prefix>:processing` e o lease fica no sorted
+    set `<prefix>:leases`, pelo instante em que vence.
+    """
+
+    def __init__(self, client, prefix="jobs", max_queued=1000, dead_letter_size=1000, poll_interval=0.2):
+        self._client = client
+        self._prefix = prefix
+        self._ready = f"{prefix}:ready"
+        self._delayed = f"{prefix}:delayed"
+        self._dead = f"{prefix}:dead"
+        self._processing = f"{prefix}:processing"
+        self._leases = f"{prefix}:leases"
+        self._max_queued = max_queued
+        self._dead_letter_size = dead_letter_size
+        self._poll_interval = poll_interval
+
+    def _key(self, job_id):
+        return f"{self._prefix}:job:{job_id}"
+
+    def create(self, job):
+        if self._client.llen(self._ready) + self._client.zcard(self._delayed) >= self._max_queued:
+            raise QueueFull(f"{self._max_queued} jobs na fila.")
+        self._client.set(self._key(job["id"]), json.dumps(job))
+        self._client.lpush(self._ready, job["id"])
+
+    def save(self, job, ttl=None):
+        self._client.set(self._key(job["id"]), json.dumps(job), ex=ttl)
+
+    def load(self, job_id):
+        raw = self._client.get(self._key(job_id))
+        return json.loads(raw) if raw is not None else None
+
+    def push(self, job_id, delay=0):
+        if delay > 0:
+            self._client.zadd(self._delayed, {job_id: time.time() + delay})
+        else:
+            self._client.lpush(self._ready, job_id)
+
+    def _promote(self):
+        """Move para a fila de prontos os retries vencidos (zrem garante um só worker por id)."""
+        for job_id in self._client.zrangebyscore(self._delayed, 0, time.time(), start=0, num=100):
+            if self._client.zrem(self._delayed, job_id):
+                self._client.lpush(self._ready, job_id)
+
+    def pop(self, timeout, lease=60):
+        self._promote()
+        job_id = self._client.blmove(self._ready, self._processing, max(1, int(timeout)), "RIGHT", "LEFT")
+        if job_id is None:
+            return None
+        self._client.zadd(self._leases, {job_id: time.time() + lease})
+        return job_id.decode() if isinstance(job_id, bytes) else job_id
+
+    def renew(self, job_ids, lease):
+        """Adia o vencimento do lease dos jobs que este worker está executando."""
+        if job_ids:
+            self._client.zadd(self._leases, {job_id: time.time() + lease for job_id in job_ids}, xx=True)
+
+    def ack(self, job_id):
+        """O worker terminou (ou reagendou) o job: tira da lista de processamento."""
+        self._client.zrem(self._leases, job_id)
+        self._client.lrem(self._processing, 0, job_id)
+
+    def expired(self, lease):
+        """Ids com o lease vencido (zrem garante um só worker por id)."""
+        now = time.time()
+        # Um id sem lease (o worker caiu entre o BLMOVE e o ZADD) ganha um agora e vence depois
+        for job_id in self._client.lrange(self._processing, 0, -1):
+            self._client.zadd(self._leases, {job_id: now + lease}, nx=True)
+        expired = []
+        for job_id in self._client.zrangebyscore(self._leases, 0, now, start=0, num=100):
+            if self._client.zrem(self._leases, job_id):
+                self._client.lrem(self._processing, 0, job_id)
+                expired.append(job_id.decode() if isinstance(job_id, bytes) else job_id)
+        return expired
+
+    def wait(self, job_id, status, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.load(job_id)
+            if job is None or job["status"] != status or job["status"] in FINISHED or time.monotonic() >= deadline:
+                return job
+            time.sleep(self._poll_interval)
+
+    def add_dead(self, job_id):
+        self._client.lpush(self._dead, job_id)
+        self._client.ltrim(self._dead, 0, self._dead_letter_size - 1)
+
+    def remove_dead(self, job_id):
+        return bool(self._client.lrem(self._dead, 0, job_id))
+
+    def dead(self, limit):
+        return [job_id.decode() if isinstance(job_id, bytes) else job_id
+                for job_id in self._client.lrange(self._dead, 0, limit - 1)]
+
+    def counts(self):
+        return {"queued": self._client.llen(self._ready), "delayed": self._client.zcard(self._delayed),
+                "dead": self._client.llen(self._dead), "processing": self._client.llen(self._processing)}
+
+
+def create_job_store(backend, redis_url=None, max_queued=1000, dead_letter_size=1000):
+    """Cria o armazenamento dos jobs conforme JOBS_BACKEND ("local" ou "redis")."""
+    if backend == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("JOBS_BACKEND = 'redis' requer o pacote redis (pip install redis).")
+        return RedisJobStore(redis.Redis.from_url(redis_url), max_queued=max_queued,
+                             dead_letter_size=dead_letter_size)
+    return LocalJobStore(max_queued=max_queued, dead_letter_size=dead_letter_size)
+
+
+class JobQueue:
+    """Enfileira jobs e os executa com `handler(payload)` em threads de worker.
+
+    Com os workers, sobe uma thread que renova a cada `lease / 3` s o lease
+    dos jobs em execução neste processo e devolve à fila os jobs cujo lease
+    venceu em qualquer processo.
+    """
+
+    def __init__(self, store, handler, max_attempts=3, base_delay=2.0, max_delay=60.0, result_ttl=3600, lease=60):
+        self._store = store
+        self._handler = handler
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._result_ttl = result_ttl
+        self._lease = lease
+        self._active = set()         # ids em execução neste processo
+        self._heartbeat = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running = 0
+        self._stats = {"submitted": 0, "completed": 0, "retried": 0, "dead_lettered": 0, "requeued": 0,
+                       "lease_expired": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def submit(self, payload, owner=None):
+        """Registra o job e devolve o registro; levanta QueueFull com a fila cheia."""
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": QUEUED,
+            "owner": owner,
+            "payload": payload,
+            "attempts": 0,
+            "max_attempts": self._max_attempts,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "next_attempt_at": None,
+            "result": None,
+            "error": None,
+        }
+        self._store.create(job)
+        self._count("submitted")
+        return job
+
+    def get(self, job_id):
+        return self._store.load(job_id)
+
+    def wait(self, job_id, timeout):
+        """Espera até `timeout` s o job terminar; devolve o estado mais recente."""
+        deadline = time.monotonic() + timeout
+        job = self._store.load(job_id)
+        while job is not None and job["status"] not in FINISHED:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            job = self._store.wait(job_id, job["status"], remaining)
+        return job
+
+    def watch(self, job_id, timeout, heartbeat=15):
+        """Gera o job a cada mudança de estado, até terminar ou passar `timeout` s.
+
+        Sem mudança por `heartbeat` s, gera None (para manter a conexão viva).
+        """
+        deadline = time.monotonic() + timeout
+        job = self._store.load(job_id)
+        while job is not None:
+            yield job
+            if job["status"] in FINISHED:
+                return
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                status, attempts = job["status"], job["attempts"]
+                job = self._store.wait(job_id, status, min(heartbeat, remaining))
+                if job is None or job["status"] != status or job["attempts"] != attempts:
+                    break
+                yield None
+
+    def start(self, workers):
+        """Inicia `workers` threads que consomem a fila."""
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{len(self._threads) + 1}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+        if workers and self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        for thread in self._threads + ([self._heartbeat] if self._heartbeat else []):
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stop.is_set():
+            job_id = self._store.pop(timeout=1.0, lease=self._lease)
+            if job_id is not None:
+                self._execute(job_id)
+
+    def _beat(self):
+        while not self._stop.wait(self._lease / 3):
+            try:
+                with self._lock:
+                    active = list(self._active)
+                self._store.renew(active, self._lease)
+                self.reap()
+            except Exception as e:
+                print(f"Erro ao renovar os leases dos jobs: {e}")
+
+    def reap(self):
+        """Devolve à fila (ou à fila de mortos) os jobs cujo worker parou de renovar o lease."""
+        reaped = 0
+        for job_id in self._store.expired(self._lease):
+            job = self._store.load(job_id)
+            if job is None or job["status"] != RUNNING:
+                continue
+            print(f"Job {job_id} ficou {self._lease}s sem sinal do worker; contando como tentativa falha")
+            self._count("lease_expired")
+            self._failed(job, LeaseExpired(f"lease de {self._lease}s vencido"))
+            reaped += 1
+        return reaped
+
+    def _execute(self, job_id):
+        job = self._store.load(job_id)
+        if job is None or job["status"] in FINISHED:
+            self._store.ack(job_id)
+            return  # expirou ou já foi concluído (ex.: reenviado duas vezes)
+        job.update(status=RUNNING, attempts=job["attempts"] + 1, started_at=time.time(), next_attempt_at=None)
+        # O TTL só vale se nem o lease salvar o job (ex.: o Redis perdeu a lista de processamento)
+        self._store.save(job, ttl=self._result_ttl)
+        with self._lock:
+            self._running += 1
+            self._active.add(job_id)
+        try:
+            result = self._handler(job["payload"])
+        except Exception as e:
+            self._failed(job, e)
+        else:
+            job.update(status=DONE, result=result, error=None, finished_at=time.time())
+            self._store.save(job, ttl=self._result_ttl)
+            self._count("completed")
+        finally:
+            self._store.ack(job_id)
+            with self._lock:
+                self._running -= 1
+                self._active.discard(job_id)
+
+    def _failed(self, job, error):
+        job["error"] = str(error) or type(error).__name__
+        if isinstance(error, PermanentError) or job["attempts"] >= job["max_attempts"]:
+            print(f"Job {job['id']} foi para a fila de mortos após {job['attempts']} tentativa(s): {job['error']}")
+            job.update(status=DEAD, finished_at=time.time())
+            self._store.save(job, ttl=self._result_ttl)
+            self._store.add_dead(job["id"])
+            self._count("dead_lettered")
+            return
+        delay = backoff_delay(job["attempts"] - 1, self._base_delay, self._max_delay)
+        print(f"Job {job['id']} falhou ({job['error']}); nova tentativa em {delay:.1f}s")
+        job.update(status=RETRYING, next_attempt_at=time.time() + delay)
+        self._store.save(job)
+        self._store.push(job["id"], delay)
+        self._count("retried")
+
+    def dead_letters(self, limit=50):
+        """Jobs na fila de mortos, do mais recente para o mais antigo."""
+        jobs = (self._store.load(job_id) for job_id in self._store.dead(limit))
+        return [job for job in jobs if job is not None]
+
+    def requeue(self, job_id):
+        """Tira o job da fila de mortos e o enfileira de novo, com as tentativas zeradas."""
+        job = self._store.load(job_id)
+        if job is None or job["status"] != DEAD or not self._store.remove_dead(job_id):
+            return None
+        job.update(status=QUEUED, attempts=0, finished_at=None, error=None)
+        self._store.save(job)
+        self._store.push(job_id)
+        self._count("requeued")
+        return job
+
+    def stats(self):
+        data = self._store.counts()
+        with self._lock:
+            data.update(self._stats)
+            data["running"] = self._running
+            data["workers"] = len(self._threads)
+        return data
+
+
+def main(argv=None):
+    from app.models import job_queue
+    from config import JOBS_WORKERS
+
+    parser = argparse.ArgumentParser(description="Fila de jobs das chamadas aos modelos")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="executa jobs (requer JOBS_BACKEND = 'redis' para servir outro processo)")
+    worker.add_argument("--workers", type=int, default=max(JOBS_WORKERS, 4))
+    dead = sub.add_parser("dead", help="lista os jobs da fila de mortos")
+    dead.add_argument("--limit", type=int, default=20)
+    retry = sub.add_parser("retry", help="reenvia um job da fila de mortos")
+    retry.add_argument("job_id")
+    args = parser.parse_args(argv)
+
+    if job_queue is None:
+        print("A fila de jobs está desativada (JOBS_ENABLED = False).")
+        return 1
+    if args.command == "worker":
+        # Ao importar app.models já sobem JOBS_WORKERS threads; completa até --workers
+        job_queue.start(max(0, args.workers - job_queue.stats()["workers"]))
+        print(f"{args.workers} workers consumindo a fila de jobs (Ctrl+C para sair).")
+        try:
+            while True:
+                time.sleep(60)
+                print(f"Jobs: {job_queue.stats()}")
+        except KeyboardInterrupt:
+            job_queue.stop()
+        return 0
+    if args.command == "dead":
+        for job in job_queue.dead_letters(args.limit):
+            finished = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["finished_at"]))
+            print(f"{job['id']}  {finished}  {job['attempts']} tentativa(s)  {job['error']}")
+        return 0
+    if job_queue.requeue(args.job_id) is None:
+        print(f"Job {args.job_id} não está na fila de mortos.")
+        return 1
+    print(f"Job {args.job_id} reenviado.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
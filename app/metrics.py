@@ -0,0 +1,47 @@
+"""Amostras de latência para o /metrics (ex.: tempo até o primeiro token).
+
+Guarda as últimas `window` medições de cada série e calcula os percentis
+na leitura; o custo por medição é um append numa deque sob um lock.
+"""
+import threading
+from collections import deque
+
+
+def percentile(values, fraction):
+    """Percentil de uma lista já ordenada (0 se vazia)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TimingStats:
+
+    def __init__(self, window=1000):
+        self._window = window
+        self._series = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = deque(maxlen=self._window)
+            series.append(seconds)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def snapshot(self):
+        """{série: {count, p50_ms, p95_ms, p99_ms, max_ms}} das últimas medições."""
+        with self._lock:
+            data = {name: sorted(series) for name, series in self._series.items()}
+            counts = dict(self._counts)
+        return {
+            name: {
+                "count": counts[name],
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+            for name, values in data.items()
+        }
@@ -0,0 +1,264 @@
+"""Migrações versionadas do esquema do banco de dados.
+
+Cada migração tem um número de versão crescente e é idempotente: antes de
+alterar o esquema ela confere no information_schema se a mudança já existe.
+A versão aplicada fica registrada na tabela `schema_version`.
+
+Uso:
+    python -m app.migrations            # aplica as migrações pendentes
+    python -m app.migrations --status   # mostra a versão atual e as pendentes
+"""
+import argparse
+import sys
+import mysql.connector
+from config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+        (table, column)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def _index_exists(cursor, table, index):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+        (table, index)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def _add_column(table, column, definition):
+    def step(cursor):
+        if not _column_exists(cursor, table, column):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+def _add_index(table, index, columns):
+    def step(cursor):
+        if not _index_exists(cursor, table, index):
+            cursor.execute(f"CREATE INDEX {index} ON {table} ({columns})")
+    return step
+
+
+def _create_conversations(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id VARCHAR(255),
+            user_message TEXT,
+            gpt_response TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            date_group DATE,
+            model VARCHAR(50)
+        )
+    """)
+
+
+def _create_chats(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            user_id VARCHAR(255) NOT NULL,
+            chat_id VARCHAR(36) NOT NULL,
+            title VARCHAR(255),
+            created_at TIMESTAMP NULL,
+            last_message_at TIMESTAMP NULL,
+            message_count INT NOT NULL DEFAULT 0,
+            model VARCHAR(50),
+            PRIMARY KEY (user_id, chat_id),
+            INDEX idx_chats_user_last (user_id, last_message_at, chat_id)
+        )
+    """)
+    # Preenche o resumo a partir do histórico existente; reexecutar só recalcula
+    cursor.execute("""
+        INSERT INTO chats (user_id, chat_id, title, created_at, last_message_at, message_count, model)
+        SELECT c.user_id, c.chat_id, LEFT(f.user_message, 80), MIN(c.timestamp), MAX(c.timestamp), COUNT(*), l.model
+        FROM conversations c
+        JOIN conversations f ON f.id = (SELECT MIN(id) FROM conversations WHERE user_id = c.user_id AND chat_id = c.chat_id)
+        JOIN conversations l ON l.id = (SELECT MAX(id) FROM conversations WHERE user_id = c.user_id AND chat_id = c.chat_id)
+        WHERE c.chat_id IS NOT NULL
+        GROUP BY c.user_id, c.chat_id, f.user_message, l.model
+        ON DUPLICATE KEY UPDATE
+            created_at = VALUES(created_at),
+            last_message_at = VALUES(last_message_at),
+            message_count = VALUES(message_count),
+            model = VALUES(model)
+    """)
+
+
+def _create_compression_dicts(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            codec VARCHAR(16) NOT NULL,
+            data MEDIUMBLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _create_conversations_search(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations_search (
+            id INT PRIMARY KEY,
+            user_id VARCHAR(255),
+            chat_id VARCHAR(36),
+            body MEDIUMTEXT,
+            INDEX idx_search_user_chat (user_id, chat_id),
+            FULLTEXT INDEX ft_search_body (body)
+        ) ENGINE=InnoDB
+    """)
+    # Indexa o histórico em texto puro; linhas já comprimidas precisam de
+    # "python -m app.search reindex"
+    cursor.execute("""
+        INSERT IGNORE INTO conversations_search (id, user_id, chat_id, body)
+        SELECT id, user_id, chat_id,
+               CONCAT_WS('\n', REGEXP_REPLACE(user_message, '<[^>]+>', ' '), REGEXP_REPLACE(gpt_response, '<[^>]+>', ' '))
+        FROM conversations
+        WHERE codec IS NULL
+    """)
+
+
+def _create_response_cache(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key CHAR(64) PRIMARY KEY,
+            model VARCHAR(255) NOT NULL,
+            response MEDIUMTEXT NOT NULL,
+            created_at DOUBLE NOT NULL,
+            INDEX idx_response_cache_created (created_at),
+            INDEX idx_response_cache_model (model)
+        ) ENGINE=InnoDB
+    """)
+
+
+def _steps(*steps):
+    def step(cursor):
+        for each in steps:
+            each(cursor)
+    return step
+
+
+# (versão, descrição, passo) — sempre acrescente no final, nunca reordene
+MIGRATIONS = [
+    (1, "cria a tabela conversations", _create_conversations),
+    (2, "adiciona a coluna chat_id", _add_column("conversations", "chat_id", "VARCHAR(36) AFTER user_id")),
+    (3, "índice (user_id, chat_id, timestamp) para carregar um chat",
+     _add_index("conversations", "idx_conversations_user_chat_ts", "user_id, chat_id, timestamp")),
+    (4, "índice (user_id, date_group) para agrupar por data",
+     _add_index("conversations", "idx_conversations_user_date", "user_id, date_group")),
+    (5, "índice (user_id, chat_id, id) para paginação por cursor",
+     _add_index("conversations", "idx_conversations_user_chat_id", "user_id, chat_id, id")),
+    (6, "tabela de resumo chats para a barra lateral", _create_chats),
+    (7, "colunas de texto comprimido e tabela de dicionários", _steps(
+        _add_column("conversations", "codec", "VARCHAR(32) NULL"),
+        _add_column("conversations", "user_message_blob", "MEDIUMBLOB NULL"),
+        _add_column("conversations", "gpt_response_blob", "MEDIUMBLOB NULL"),
+        _create_compression_dicts
+    )),
+    (8, "índice FULLTEXT para a busca no histórico", _create_conversations_search),
+    (9, "tabela response_cache para o cache de respostas dos modelos", _create_response_cache),
+    (10, "contagem de tokens das conversas e resumo de cada chat", _steps(
+        _add_column("conversations", "user_tokens", "INT NULL"),
+        _add_column("conversations", "response_tokens", "INT NULL"),
+        _add_column("chats", "summary", "TEXT NULL"),
+        _add_column("chats", "summary_through", "INT NULL"),
+        _add_column("chats", "summary_tokens", "INT NULL")
+    )),
+    (11, "resposta gravada em Markdown e HTML pré-renderizado", _steps(
+        _add_column("conversations", "response_format", "VARCHAR(16) NULL"),
+        _add_column("conversations", "response_html", "MEDIUMTEXT NULL"),
+        _add_column("conversations", "render_version", "INT NULL")
+    )),
+    (12, "versão de cada chat para o ETag do histórico", _steps(
+        _add_column("chats", "version", "BIGINT NOT NULL DEFAULT 0"),
+        _add_index("chats", "idx_chats_user_version", "user_id, version")
+    )),
+]
+
+
+def ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def current_version(cursor):
+    ensure_version_table(cursor)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+
+def pending_migrations(cursor):
+    version = current_version(cursor)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def migrate(mydb, target=None, log=print):
+    """Aplica, em ordem, as migrações pendentes até `target` (ou todas).
+
+    Retorna a versão final do esquema.
+    """
+    mycursor = mydb.cursor()
+    version = current_version(mycursor)
+    for number, description, step in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        log(f"Aplicando migração {number}: {description}")
+        step(mycursor)
+        mycursor.execute(
+            "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+            (number, description)
+        )
+        mydb.commit()
+        version = number
+    mycursor.close()
+    return version
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrações do esquema do ChatGPT Clone")
+    parser.add_argument("--status", action="store_true", help="mostra a versão atual sem aplicar nada")
+    parser.add_argument("--target", type=int, help="para na versão indicada")
+    args = parser.parse_args(argv)
+
+    try:
+        mydb = mysql.connector.connect(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            port=DB_PORT
+        )
+    except mysql.connector.Error as err:
+        print(f"Erro ao conectar ao banco de dados: {err}")
+        return 1
+
+    try:
+        if args.status:
+            mycursor = mydb.cursor()
+            print(f"Versão atual do esquema: {current_version(mycursor)}")
+            for number, description, _ in pending_migrations(mycursor):
+                print(f"  pendente {number}: {description}")
+            return 0
+        version = migrate(mydb, target=args.target)
+        print(f"Esquema na versão {version}.")
+        return 0
+    except mysql.connector.Error as err:
+        print(f"Erro ao aplicar migrações: {err}")
+        return 1
+    finally:
+        mydb.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
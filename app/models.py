@@ -1,79 +1,1164 @@
-from datetime import datetime
-import mysql.connector
-from app import get_db_connection
-import google.generativeai as genai
-import openai
+import asyncio
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+from app import storage
+from app.writebehind import WriteBehindQueue
+from app.cache import create_transcript_cache
+from app.compression import BodyCodec
+from app.search import search_body, query_terms, make_snippet
+from app.providers import ProviderRegistry, gemini_model, openai_chat, openai_chat_async
+from app.metrics import TimingStats
+from app.response_cache import ResponseCache, cache_key
+from app.singleflight import SingleFlight
+from app.gateway import ProviderGateway, GatewayTimeout, estimate_tokens, is_rate_limit_error
+from app.resilience import CircuitBreaker, CircuitOpen, retry_call, retry_call_async, backoff_delay
+from app.hedging import Hedger
+from app.context import count_tokens, plain_text, response_text, select_window, turn_tokens, SummaryRefresher
+from app.jobs import JobQueue, PermanentError, create_job_store
+from app.formatting import format_response, RenderQueue, MARKDOWN, RENDER_VERSION
 from config import GEMINI_API_KEY, OPENAI_API_KEY
+from config import OPENAI_BASE_URL, LLM_MAX_CONNECTIONS, LLM_KEEPALIVE, LLM_TIMEOUT, LLM_WARM_UP, LLM_STUB_URL
+from config import ASYNC_LLM_MAX_CONNECTIONS, ASYNC_LLM_CLIENTS
+from config import (RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL,
+                    RESPONSE_CACHE_PERSISTENT, RESPONSE_CACHE_STORE_MAX_ENTRIES, RESPONSE_CACHE_EXCLUDED_MODELS)
+from config import SINGLE_FLIGHT_ENABLED
+from config import RENDER_STORE_HTML, RENDER_QUEUE_SIZE
+from config import PROVIDER_LIMITS, USER_RPM, USER_TPM, GATEWAY_WAIT_TIMEOUT, GATEWAY_RESPONSE_TOKENS
+from config import (RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, BREAKER_FAILURE_THRESHOLD,
+                    BREAKER_RESET_TIMEOUT, FAILOVER_ENABLED)
+from config import HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY, HEDGE_BUDGET
+from config import (CONTEXT_ENABLED, CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_TURNS, SUMMARY_ENABLED, SUMMARY_MAX_WORDS,
+                    SUMMARY_QUEUE_SIZE)
+from config import (JOBS_ENABLED, JOBS_BACKEND, JOBS_WORKERS, JOBS_MAX_ATTEMPTS, JOBS_RETRY_BASE_DELAY, JOBS_RETRY_MAX_DELAY,
+                    JOBS_RESULT_TTL, JOBS_LEASE, JOBS_MAX_QUEUED, JOBS_DEAD_LETTER_SIZE)
+from config import (SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_CAPACITY, SEMANTIC_CACHE_DIM,
+                    SEMANTIC_CACHE_DTYPE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_PATH, SEMANTIC_CACHE_EMBEDDER)
+from config import (WRITE_BEHIND_ENABLED, WRITE_BEHIND_SPOOL_PATH, WRITE_BEHIND_QUEUE_SIZE,
+                    WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_PUT_TIMEOUT,
+                    WRITE_BEHIND_MAX_RETRIES, WRITE_BEHIND_DEAD_LETTER_PATH)
+from config import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE
+from config import CHATS_PAGE_SIZE, CHATS_MAX_PAGE_SIZE, CHAT_TITLE_LENGTH
+from config import (TRANSCRIPT_CACHE_BACKEND, TRANSCRIPT_CACHE_MAX_BYTES, TRANSCRIPT_CACHE_TTL,
+                    TRANSCRIPT_CACHE_WINDOW, REDIS_URL)
+from config import SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
+from config import (COMPRESSION_ENABLED, COMPRESSION_CODEC, COMPRESSION_LEVEL, COMPRESSION_MIN_BYTES,
+                    COMPRESSION_USE_DICTIONARY)
 
-def save_conversation(user_id, chat_id, user_message, gpt_response, model):
+# Codec do texto das conversas; decodifica sempre, comprime só com COMPRESSION_ENABLED
+body_codec = BodyCodec(
+    COMPRESSION_CODEC,
+    level=COMPRESSION_LEVEL,
+    min_bytes=COMPRESSION_MIN_BYTES,
+    dictionaries=storage.load_dictionaries,
+    use_dictionary=COMPRESSION_USE_DICTIONARY
+)
+
+# Cache das conversas mais recentes de cada chat (None se desativado)
+transcript_cache = create_transcript_cache(
+    TRANSCRIPT_CACHE_BACKEND,
+    max_bytes=TRANSCRIPT_CACHE_MAX_BYTES,
+    ttl=TRANSCRIPT_CACHE_TTL,
+    window=TRANSCRIPT_CACHE_WINDOW,
+    redis_url=REDIS_URL
+)
+
+# Com LLM_STUB_URL, os dois provedores apontam para o stub local (as chaves não importam)
+if LLM_STUB_URL:
+    GEMINI_API_KEY = GEMINI_API_KEY or "stub"
+    OPENAI_API_KEY = OPENAI_API_KEY or "stub"
+    print(f"Aviso: usando o provedor stub em {LLM_STUB_URL} no lugar do GPT e do Gemini.")
+
+# Clientes dos provedores de LLM, criados uma vez e compartilhados entre as threads
+llm_clients = ProviderRegistry({
+    "gemini": lambda: gemini_model(GEMINI_API_KEY, endpoint=LLM_STUB_URL),
+    "gpt": lambda: openai_chat(OPENAI_API_KEY, base_url=f"{LLM_STUB_URL}/v1" if LLM_STUB_URL else OPENAI_BASE_URL,
+                               max_connections=LLM_MAX_CONNECTIONS, keepalive=LLM_KEEPALIVE, timeout=LLM_TIMEOUT,
+                               max_retries=0),
+})
+
+# Cliente assíncrono do GPT, usado só pelo servidor assíncrono (app.asgi); o do Gemini roda no executor
+async_llm_clients = ProviderRegistry({
+    "gpt": lambda: openai_chat_async(OPENAI_API_KEY, base_url=f"{LLM_STUB_URL}/v1" if LLM_STUB_URL else OPENAI_BASE_URL,
+                                     max_connections=ASYNC_LLM_MAX_CONNECTIONS, keepalive=LLM_KEEPALIVE,
+                                     timeout=LLM_TIMEOUT, max_retries=0, clients=ASYNC_LLM_CLIENTS),
+})
+
+# Controle de vazão de cada provedor: chamadas simultâneas e cotas por minuto
+gateways = {
+    name: ProviderGateway(name, user_rpm=USER_RPM, user_tpm=USER_TPM, wait_timeout=GATEWAY_WAIT_TIMEOUT,
+                          **PROVIDER_LIMITS.get(name, {}))
+    for name in ("gemini", "gpt")
+}
+
+# Circuit breaker de cada provedor: falha na hora enquanto o provedor está fora
+breakers = {
+    name: CircuitBreaker(name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT)
+    for name in gateways
+}
+
+# Provedor reserva de cada modelo (usado só com FAILOVER_ENABLED e se tiver chave)
+FAILOVER = {"gpt": "gemini", "gemini": "gpt"}
+PROVIDER_KEYS = {"gemini": GEMINI_API_KEY, "gpt": OPENAI_API_KEY}
+failover_counts = {name: 0 for name in gateways}
+_failover_lock = threading.Lock()
+
+# Hedge para o provedor reserva quando o principal demora (vazio se desativado);
+# "<modelo>" mede a resposta inteira e "<modelo>.stream" o primeiro pedaço
+hedgers = {
+    f"{name}{kind}": Hedger(percentile=HEDGE_PERCENTILE, min_delay=HEDGE_MIN_DELAY, max_delay=HEDGE_MAX_DELAY,
+                            budget=HEDGE_BUDGET)
+    for name in gateways for kind in ("", ".stream")
+} if HEDGE_ENABLED else {}
+
+# Cache de respostas para perguntas idênticas (None se desativado)
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+    store=storage if RESPONSE_CACHE_PERSISTENT else None,
+    store_max_entries=RESPONSE_CACHE_STORE_MAX_ENTRIES,
+    excluded_models=RESPONSE_CACHE_EXCLUDED_MODELS
+) if RESPONSE_CACHE_ENABLED else None
+
+# Cache semântico para perguntas parecidas (None se desativado; requer numpy)
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    from app.semantic_cache import SemanticCache, load_embedder
+    semantic_cache = SemanticCache(
+        load_embedder(SEMANTIC_CACHE_EMBEDDER, SEMANTIC_CACHE_DIM),
+        dim=SEMANTIC_CACHE_DIM,
+        capacity=SEMANTIC_CACHE_CAPACITY,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        dtype=SEMANTIC_CACHE_DTYPE,
+        ttl=SEMANTIC_CACHE_TTL,
+        path=SEMANTIC_CACHE_PATH
+    )
+
+# Perguntas iguais em andamento ao mesmo tempo compartilham uma chamada ao modelo (None se desativado)
+inflight = SingleFlight() if SINGLE_FLIGHT_ENABLED else None
+
+# Latência das respostas dos modelos (tempo até o primeiro token, total)
+response_timings = TimingStats()
+
+if LLM_WARM_UP:
+    for _name, _err in llm_clients.warm_up().items():
+        print(f"Aviso: cliente {_name} não foi criado no aquecimento: {_err}")
+
+def _chat_version():
+    """Versão de um chat que acabou de mudar: o instante atual em microssegundos (ver app.storage)."""
+    return time.time_ns() // 1000
+
+def _chat_summaries(rows):
+    """Resume as linhas por chat: uma linha de `chats` por (user_id, chat_id)."""
+    summaries = {}
+    version = _chat_version()
+    for user_id, chat_id, user_message, _, timestamp, _, model, *_ in rows:
+        summary = summaries.get((user_id, chat_id))
+        if summary is None:
+            summaries[(user_id, chat_id)] = [user_id, chat_id, user_message[:CHAT_TITLE_LENGTH], timestamp, timestamp, 1,
+                                             model, version]
+        else:
+            summary[4] = max(summary[4], timestamp)
+            summary[5] += 1
+            summary[6] = model
+    return list(summaries.values())
+
+def _encode_rows(rows):
+    """Acrescenta às linhas o codec, os blobs (comprimindo se estiver ativado), os tokens e o HTML pronto."""
+    encoded = []
+    for row in rows:
+        if COMPRESSION_ENABLED:
+            codec, user_message, gpt_response, user_blob, response_blob = body_codec.encode(row[2], row[3])
+        else:
+            codec, user_message, gpt_response, user_blob, response_blob = None, row[2], row[3], None, None
+        response_format, response_html = row[7], row[8]
+        response_tokens = count_tokens(row[3] if response_format == MARKDOWN else plain_text(row[3]))
+        encoded.append([row[0], row[1], user_message, gpt_response, row[4], row[5], row[6], codec, user_blob, response_blob,
+                        count_tokens(row[2]), response_tokens, response_format, response_html,
+                        RENDER_VERSION if response_html is not None else None])
+    return encoded
+
+def _decoded(conversations):
+    """Descomprime só as conversas que serão devolvidas (o cache guarda comprimido)."""
+    return [body_codec.decode(conv) for conv in conversations]
+
+def _insert_conversations(rows):
+    """Grava várias linhas de conversa e atualiza `chats` numa única transação; devolve o id da primeira."""
+    # Linhas do spool de versões anteriores não têm response_format e response_html (resposta em HTML)
+    rows = [row + [None, None] if len(row) == 7 else row for row in rows]
+    search_bodies = [search_body(row[2], row[3], row[7]) for row in rows]
+    encoded = _encode_rows(rows)
+    ids = storage.insert_conversations(encoded, _chat_summaries(rows), search_bodies)
+    if transcript_cache is not None:
+        _append_to_cache(rows, ids, encoded)
+    return ids[0]
+
+def _append_to_cache(rows, ids, encoded):
+    """Acrescenta as conversas gravadas às entradas do cache, sem invalidá-las."""
+    by_chat = {}
+    for conversation_id, row, stored in zip(ids, rows, encoded):
+        by_chat.setdefault((row[0], row[1]), []).append({
+            "id": conversation_id,
+            "user_message": row[2],
+            "gpt_response": row[3],
+            "date_group": date.fromisoformat(row[5]),
+            "chat_id": row[1],
+            "user_tokens": stored[10],
+            "response_tokens": stored[11],
+            "response_format": row[7],
+            "response_html": row[8],
+            "render_version": stored[14]
+        })
+    for key, conversations in by_chat.items():
+        transcript_cache.append(key, conversations)
+
+def _conversation_key(row):
+    return (row[0], row[1])
+
+def _spool_path(path):
+    """No gunicorn com vários workers (run.py), cada worker a partir do segundo tem o seu spool."""
+    slot = os.environ.get("SERVER_WORKER_SLOT")
+    return f"{path}.{slot}" if path and slot not in (None, "0") else path
+
+def _transient_storage_error(err):
+    """Erros de banco que podem passar numa nova tentativa (conexão, pool, bloqueio); os demais são permanentes."""
+    return isinstance(err, storage.errors) and not isinstance(err, storage.permanent_errors)
+
+# Gravação assíncrona em lote (opcional, ver WRITE_BEHIND_ENABLED em config.py)
+write_behind = WriteBehindQueue(
+    _insert_conversations,
+    key=_conversation_key,
+    spool_path=_spool_path(WRITE_BEHIND_SPOOL_PATH),
+    maxsize=WRITE_BEHIND_QUEUE_SIZE,
+    batch_size=WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+    put_timeout=WRITE_BEHIND_PUT_TIMEOUT,
+    is_transient=_transient_storage_error,
+    max_retries=WRITE_BEHIND_MAX_RETRIES,
+    dead_letter_path=_spool_path(WRITE_BEHIND_DEAD_LETTER_PATH)
+)
+if WRITE_BEHIND_ENABLED:
+    # Regrava o que ficou no spool de uma execução anterior
+    write_behind.start()
+
+def _new_row(user_id, chat_id, user_message, gpt_response, model, html):
+    """Linha de uma conversa nova: a resposta em Markdown e, com RENDER_STORE_HTML, o HTML já renderizado."""
+    now = datetime.now()
+    return [user_id, chat_id, user_message, gpt_response, now.strftime('%Y-%m-%d %H:%M:%S'), now.date().isoformat(),
+            model, MARKDOWN, html if RENDER_STORE_HTML else None]
+
+def save_conversation(user_id, chat_id, user_message, gpt_response, model, html=None):
+    """Grava a resposta como veio do modelo; `html` é a renderização que quem chama já tiver feito.
+
+    Sem `html`, a resposta é renderizada na primeira leitura e gravada em
+    segundo plano (ver render_bodies).
+    """
+    row = _new_row(user_id, chat_id, user_message, gpt_response, model, html)
+    if WRITE_BEHIND_ENABLED and write_behind.enqueue(row):
+        return
     try:
-        mydb = get_db_connection()
-        mycursor = mydb.cursor()
-        sql = "INSERT INTO conversations (user_id, chat_id, user_message, gpt_response, date_group, model) VALUES (%s, %s, %s, %s, %s, %s)"
-        val = (user_id, chat_id, user_message, gpt_response, datetime.now().date(), model)
-        mycursor.execute(sql, val)
-        mydb.commit()
-        mydb.close()
-    except mysql.connector.Error as err:
+        _insert_conversations([row])
+    except storage.errors as err:
         print(f"Erro ao salvar conversa: {err}")
 
+def checkpoint_conversation(user_id, chat_id, user_message, gpt_response, model, conversation_id=None, html=None):
+    """Grava uma resposta ainda em geração e devolve o id da linha.
+
+    Na primeira chamada insere a conversa (sem passar pela fila do
+    write-behind, para saber o id); nas seguintes regrava o texto da mesma
+    linha e o índice de busca. Os checkpoints parciais gravam só o texto;
+    `html` vem com a resposta completa. Devolve None se não conseguir gravar.
+    """
+    if conversation_id is None:
+        if WRITE_BEHIND_ENABLED:
+            # Mantém a ordem dos ids em relação às conversas ainda na fila
+            write_behind.wait_flushed((user_id, chat_id))
+        row = _new_row(user_id, chat_id, user_message, gpt_response, model, html)
+        try:
+            return _insert_conversations([row])
+        except storage.errors as err:
+            print(f"Erro ao salvar conversa: {err}")
+            return None
+    row = _encode_rows([[user_id, chat_id, user_message, gpt_response, None, None, model, MARKDOWN, None]])[0]
+    markup = html if RENDER_STORE_HTML else None
+    try:
+        storage.update_bodies([(row[7], row[2], row[3], row[8], row[9], conversation_id)])
+        storage.update_tokens([(row[10], row[11], conversation_id)])
+        storage.update_rendered([(markup, RENDER_VERSION if markup is not None else None, conversation_id)])
+        storage.index_bodies([(conversation_id, user_id, chat_id, search_body(user_message, gpt_response, MARKDOWN))])
+        storage.touch_chat(user_id, chat_id, _chat_version())
+    except storage.errors as err:
+        print(f"Erro ao salvar conversa: {err}")
+    finally:
+        if transcript_cache is not None:
+            transcript_cache.evict((user_id, chat_id))
+    return conversation_id
+
+def _pending_conversations(user_id, chat_id):
+    """Conversas do chat ainda na fila de gravação, da mais nova para a mais antiga."""
+    if not WRITE_BEHIND_ENABLED:
+        return []
+    return [
+        {
+            "user_message": row[2],
+            "gpt_response": row[3],
+            "id": None,
+            "date_group": date.fromisoformat(row[5]),
+            "chat_id": row[1],
+            "response_format": row[7] if len(row) > 7 else None,
+            "response_html": row[8] if len(row) > 7 else None,
+            "render_version": RENDER_VERSION if len(row) > 7 and row[8] is not None else None
+        }
+        for row in reversed(write_behind.pending((user_id, chat_id)))
+    ]
+
 def load_conversations(user_id, chat_id):
+    pending = _pending_conversations(user_id, chat_id)
+    key = (user_id, chat_id)
+    cached = transcript_cache.get(key) if transcript_cache is not None else None
+    if cached is not None and cached[1]:
+        return pending + _decoded(cached[0][::-1])
+    version = transcript_cache.version(key) if transcript_cache is not None else None
     try:
-        mydb = get_db_connection()
-        mycursor = mydb.cursor(dictionary=True)
-        mycursor.execute("SELECT user_message, gpt_response, DATE(timestamp) as date_group, chat_id FROM conversations WHERE user_id = %s AND chat_id = %s ORDER BY timestamp DESC", (user_id, chat_id))
-        conversations = mycursor.fetchall()
-        mydb.close()
-        print("Conversas carregadas do banco:", conversations)
-        return conversations
-    except mysql.connector.Error as err:
+        conversations = storage.query_conversations(user_id, chat_id)
+        if transcript_cache is not None:
+            transcript_cache.put(key, conversations[::-1], complete=True, version=version)
+        return pending + _decoded(conversations)
+    except storage.errors as err:
         print(f"Erro ao carregar conversas: {err}")
-        return []
+        return pending
+
+def _cached_page(key, before, limit):
+    """Monta a página a partir do cache; None se o cache não cobrir a página."""
+    cached = transcript_cache.get(key) if transcript_cache is not None else None
+    if cached is None:
+        return None
+    rows, complete = cached
+    newest_first = [row for row in reversed(rows) if before is None or row["id"] < before]
+    if len(newest_first) > limit or (len(newest_first) == limit and not complete):
+        page = newest_first[:limit]
+        return page, page[-1]["id"]
+    if complete:
+        return newest_first, None
+    return None
+
+def load_conversations_page(user_id, chat_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """Carrega uma página do chat, da mensagem mais nova para a mais antiga.
+
+    Paginação por cursor (keyset): `before` é o id da mensagem mais antiga da
+    página anterior, e a consulta percorre o índice (user_id, chat_id, id) a
+    partir dele, sem OFFSET. Retorna (conversas, next_cursor); next_cursor é
+    None quando não há mensagens mais antigas. As páginas mais recentes saem
+    do cache de conversas quando ele está ativo.
+    """
+    conversations, next_cursor, _ = _load_page(user_id, chat_id, before, limit)
+    return conversations, next_cursor
+
+def _load_page(user_id, chat_id, before, limit):
+    """load_conversations_page mais um terceiro valor, False se o banco falhou (a página tem só a fila)."""
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+    before = int(before) if before is not None else None
+    key = (user_id, chat_id)
+    # As conversas na fila de gravação são as mais novas: só entram na primeira página
+    pending = _pending_conversations(user_id, chat_id) if before is None else []
+
+    page = _cached_page(key, before, limit)
+    if page is not None:
+        return pending + _decoded(page[0]), page[1], True
+
+    # Na primeira página, busca a janela inteira do cache de uma vez
+    fill_cache = transcript_cache is not None and before is None
+    fetch = max(limit, TRANSCRIPT_CACHE_WINDOW) if fill_cache else limit
+    version = transcript_cache.version(key) if fill_cache else None
+    try:
+        conversations = storage.query_page(user_id, chat_id, before, fetch + 1)
+    except storage.errors as err:
+        print(f"Erro ao carregar conversas: {err}")
+        return pending, None, False
+    if fill_cache:
+        complete = len(conversations) <= fetch
+        transcript_cache.put(key, conversations[:fetch][::-1], complete=complete, version=version)
+    next_cursor = None
+    if len(conversations) > limit:
+        conversations = conversations[:limit]
+        next_cursor = conversations[-1]["id"]
+    return pending + _decoded(conversations), next_cursor, True
+
+def history_etag(user_id, chat_id, params, sidebar=False):
+    """Validadores (ETag, Last-Modified) de uma página do histórico, sem ler as mensagens.
+
+    O ETag resume a versão do chat na tabela `chats` (que sobe a cada
+    conversa gravada ou regravada e some com o chat), as conversas do chat
+    ainda na fila do write-behind, a versão do renderizador e `params` (os
+    parâmetros da página). Com `sidebar`, também o número de chats do usuário
+    e a maior versão entre eles (a barra lateral de GET /conversations).
+    Last-Modified é o instante da versão mais recente; os chats gravados
+    antes da coluna `version` ficam sem ele até a próxima conversa.
+    Devolve (None, None) se o banco falhar.
+    """
+    try:
+        version = storage.chat_version(user_id, chat_id)
+        chats = storage.chats_version(user_id) if sidebar else None
+    except storage.errors as err:
+        print(f"Erro ao ler a versão do chat: {err}")
+        return None, None
+    pending = len(write_behind.pending((user_id, chat_id))) if WRITE_BEHIND_ENABLED else 0
+    state = [user_id, chat_id, version, pending, RENDER_VERSION, chats, params]
+    etag = hashlib.blake2b(json.dumps(state, default=str).encode(), digest_size=16).hexdigest()
+    latest = max(version or 0, chats[1] if chats else 0)
+    last_modified = datetime.fromtimestamp(latest / 1_000_000, timezone.utc) if latest else None
+    return etag, last_modified
+
+def _save_rendered(batch):
+    """Grava o HTML renderizado pela render_queue e tira do cache os chats que mudaram."""
+    storage.update_rendered([(markup, RENDER_VERSION, conversation_id) for conversation_id, _, markup in batch])
+    if transcript_cache is not None:
+        for key in {key for _, key, _ in batch}:
+            transcript_cache.evict(key)
+
+# Renderiza em segundo plano as respostas lidas sem o HTML gravado (None com RENDER_STORE_HTML desligado)
+render_queue = RenderQueue(_save_rendered, maxsize=RENDER_QUEUE_SIZE) if RENDER_STORE_HTML else None
+
+BODY_HTML = "html"
+BODY_RAW = "raw"
+
+def render_bodies(user_id, conversations, body=BODY_HTML):
+    """Prepara as conversas carregadas para o cliente.
+
+    Com body="html", `gpt_response` sai em HTML: o response_html gravado ou,
+    se faltar ou for de uma versão anterior do renderizador, renderizado na
+    hora (com o cache de renderização) e pedido à render_queue. Com
+    body="raw", sai como foi gravado. `response_format` diz o que veio em
+    `gpt_response` ("markdown" ou "html"; as conversas antigas só têm HTML).
+    """
+    result = []
+    for conv in conversations:
+        conv = dict(conv)
+        markup = conv.pop("response_html", None)
+        version = conv.pop("render_version", None)
+        if conv.get("response_format") != MARKDOWN:
+            conv["response_format"] = BODY_HTML
+        elif body != BODY_RAW:
+            if markup is None or version != RENDER_VERSION:
+                markup = format_response(conv["gpt_response"])
+                if conv["id"] is not None and render_queue is not None:
+                    render_queue.request(conv["id"], (user_id, conv["chat_id"]), conv["gpt_response"])
+            conv["gpt_response"] = markup
+            conv["response_format"] = BODY_HTML
+        result.append(conv)
+    return result
+
+def history_page(user_id, chat_id, before, limit, body):
+    """Uma página do chat pronta para o cliente: (conversas, next_cursor, ok); ok é False se o banco falhou."""
+    conversations, next_cursor, ok = _load_page(user_id, chat_id, before, limit)
+    return render_bodies(user_id, conversations, body), next_cursor, ok
 
 def clear_conversations(user_id, chat_id):
+    if WRITE_BEHIND_ENABLED:
+        # Evita que um lote ainda pendente regrave o chat depois do DELETE
+        write_behind.wait_flushed((user_id, chat_id))
     try:
-        mydb = get_db_connection()
-        mycursor = mydb.cursor()
-        # Modifica a consulta para deletar pelo user_id e chat_id
-        mycursor.execute("DELETE FROM conversations WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
-        mydb.commit()
-        mydb.close()
-    except mysql.connector.Error as err:
+        # Apaga as mensagens e o resumo do chat pelo user_id e chat_id
+        storage.delete_chat(user_id, chat_id)
+    except storage.errors as err:
         print(f"Erro ao limpar histórico de conversas: {err}")
+    finally:
+        if transcript_cache is not None:
+            transcript_cache.evict((user_id, chat_id))
 
-def enviar_mensagem_gemini(modelo, mensagem):
+def load_chats(user_id, before=None, limit=CHATS_PAGE_SIZE):
+    """Lista os chats do usuário, do mais recente para o mais antigo.
+
+    Lê só a tabela `chats` pelo índice (user_id, last_message_at, chat_id), com
+    o dia já calculado no SQL. `before` é o cursor devolvido pela página
+    anterior ("<last_message_at>|<chat_id>"); um cursor inválido (ver
+    chats_cursor) busca a primeira página. Retorna (chats, next_cursor).
+    """
+    limit = max(1, min(int(limit), CHATS_MAX_PAGE_SIZE))
+    before = chats_cursor(before) if before else None
     try:
-        resposta = modelo.generate_content(mensagem)
-        return resposta.text
-    except Exception as e:
-        print(f"Erro ao enviar mensagem ao Gemini: {e}")
-        print(f"Detalhes do erro: {e.args}")
-        return "Desculpe, não consegui entender sua pergunta, por favor, reformule"
-
-def enviar_mensagem_gpt(mensagem):
+        chats = storage.list_chats(user_id, before or None, limit + 1)
+    except storage.errors as err:
+        print(f"Erro ao carregar a lista de chats: {err}")
+        return [], None
+    next_cursor = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        last = chats[-1]
+        next_cursor = f"{last['last_message_at'].strftime(CHATS_CURSOR_FORMAT)}|{last['chat_id']}"
+    return chats, next_cursor
+
+CHATS_CURSOR_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def chats_cursor(before):
+    """(last_message_at, chat_id) do cursor "<last_message_at>|<chat_id>" da lista de chats; None se for inválido."""
+    last_message_at, _, chat_id = before.partition("|")
     try:
-        if not OPENAI_API_KEY:
-            raise Exception("Chave da API do GPT não configurada.")
-        openai.api_key = OPENAI_API_KEY
-        resposta = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "Você é um assistente útil."},
-                {"role": "user", "content": mensagem}
-            ]
-        )
-        resposta_texto = resposta.choices[0].message.content
-        return resposta_texto
-    except Exception as e:
-        print(f"Erro ao enviar mensagem ao GPT-4: {e}")
-        return "Erro ao obter resposta do GPT-4 (verifique a chave da API)."
-
-def get_response(model, prompt):
-    if model == "gpt":
-        return enviar_mensagem_gpt(prompt)
-    elif model == "gemini":
-        genai.configure(api_key=GEMINI_API_KEY)
-        modelo_gemini = genai.GenerativeModel('gemini-pro')
-        return enviar_mensagem_gemini(modelo_gemini, prompt)
+        datetime.strptime(last_message_at, CHATS_CURSOR_FORMAT)
+    except ValueError:
+        return None
+    return (last_message_at, chat_id) if chat_id else None
+
+def search_cursor(before):
+    """(score, id) do cursor "<score>|<id>" da busca; None se ele for inválido."""
+    score, _, last_id = before.partition("|")
+    try:
+        score, last_id = float(score), int(last_id)
+    except ValueError:
+        return None
+    return (score, last_id) if math.isfinite(score) else None
+
+def search_conversations(user_id, query, before=None, limit=SEARCH_PAGE_SIZE):
+    """Busca nas mensagens e respostas do usuário, da mais relevante à menos.
+
+    Retorna (resultados, next_cursor); cada resultado tem id, chat_id,
+    timestamp, score e um trecho (snippet) em HTML com as palavras marcadas.
+    `before` é o cursor "<score>|<id>" da página anterior; um cursor inválido
+    (ver search_cursor) busca a primeira página.
+    """
+    limit = max(1, min(int(limit), SEARCH_MAX_PAGE_SIZE))
+    terms = query_terms(query)
+    if not terms:
+        return [], None
+    before = search_cursor(before) if before else None
+    try:
+        rows = storage.search(user_id, query, before, limit + 1)
+    except storage.errors as err:
+        print(f"Erro ao buscar conversas: {err}")
+        return [], None
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['score']!r}|{rows[-1]['id']}"
+    results = []
+    for conv in _decoded(rows):
+        results.append({
+            "id": conv["id"],
+            "chat_id": conv["chat_id"],
+            "timestamp": conv["timestamp"],
+            "score": conv["score"],
+            "snippet": make_snippet(search_body(conv["user_message"], conv["gpt_response"], conv["response_format"]), terms)
+        })
+    return results, next_cursor
+
+def _chat_summary(user_id, chat_id):
+    try:
+        return storage.chat_summary(user_id, chat_id)
+    except storage.errors as err:
+        print(f"Erro ao carregar o resumo do chat: {err}")
+        return None
+
+def _context_window(user_id, chat_id):
+    """(summary, recent, turns, used, overflow) do chat.
+
+    `summary` é a linha do resumo (ou None), `recent` as até CONTEXT_MAX_TURNS
+    conversas mais novas, `turns` as que cabem no orçamento de tokens, `used`
+    os tokens delas e `overflow` se há conversas fora da janela e do resumo.
+    """
+    recent, next_cursor = load_conversations_page(user_id, chat_id, None, CONTEXT_MAX_TURNS)
+    summary = _chat_summary(user_id, chat_id) if recent else None
+    budget = CONTEXT_TOKEN_BUDGET - (summary["summary_tokens"] or 0 if summary else 0)
+    turns, used, overflow = select_window(recent, budget, summary["summary_through"] if summary else None)
+    # A página inteira coube e há conversas mais antigas: também ficaram de fora
+    overflow = overflow or (len(turns) == len(recent) and next_cursor is not None)
+    return summary, recent, turns, used, overflow
+
+def build_context(user_id, chat_id, model):
+    """Resumo do chat + conversas mais recentes que cabem em CONTEXT_TOKEN_BUDGET.
+
+    Lê no máximo CONTEXT_MAX_TURNS conversas (normalmente do cache de
+    conversas) e um resumo por chave primária. Se conversas ainda não
+    resumidas ficaram de fora, pede a atualização do resumo em segundo plano.
+    Devolve None sem chat_id ou com CONTEXT_ENABLED desligado.
+    """
+    if not CONTEXT_ENABLED or chat_id is None:
+        return None
+    summary, _, turns, used, overflow = _context_window(user_id, chat_id)
+    if overflow and SUMMARY_ENABLED:
+        summary_refresher.request((user_id, chat_id), model)
+    return {
+        "summary": summary["summary"] if summary else None,
+        "turns": [[conv["user_message"], response_text(conv)] for conv in turns],
+        "tokens": used + (summary["summary_tokens"] or 0 if summary else 0)
+    }
+
+SUMMARY_PROMPT = (
+    "Resuma a conversa abaixo entre um usuário e um assistente em até {words} palavras, mantendo os fatos, "
+    "nomes, decisões e pedidos em aberto necessários para continuar a conversa. Responda só com o resumo.\n\n"
+    "Resumo anterior:\n{summary}\n\nNovas mensagens:\n{transcript}"
+)
+
+def _refresh_summary(key, model):
+    """Incorpora ao resumo do chat as conversas que saíram da janela de contexto."""
+    user_id, chat_id = key
+    summary, recent, turns, _, _ = _context_window(user_id, chat_id)
+    in_window = [conv["id"] for conv in turns if conv["id"] is not None]
+    saved = [conv["id"] for conv in recent if conv["id"] is not None]
+    if in_window:
+        cutoff = min(in_window)
+    elif saved:
+        cutoff = max(saved) + 1
     else:
-        return "Modelo inválido."
\ No newline at end of file
+        return
+    text = summary["summary"] if summary else ""
+    through = summary["summary_through"] if summary else 0
+    while True:
+        rows = _decoded(storage.query_range(user_id, chat_id, through, cutoff, CONTEXT_MAX_TURNS))
+        batch, tokens = [], 0
+        for row in rows:
+            tokens += turn_tokens(row)
+            if batch and tokens > CONTEXT_TOKEN_BUDGET:
+                break
+            batch.append(row)
+        if not batch:
+            return
+        transcript = "\n".join(f"Usuário: {row['user_message']}\nAssistente: {response_text(row)}"
+                               for row in batch)
+        _, response = _call_model(model, SUMMARY_PROMPT.format(words=SUMMARY_MAX_WORDS, summary=text or "(nenhum)",
+                                                                transcript=transcript))
+        if is_error_response(response):
+            raise RuntimeError(response)
+        text = response.strip()
+        through = batch[-1]["id"]
+        storage.save_chat_summary(user_id, chat_id, text, through, count_tokens(text))
+
+# Atualiza em segundo plano o resumo dos chats mais longos que a janela de contexto
+summary_refresher = SummaryRefresher(_refresh_summary, maxsize=SUMMARY_QUEUE_SIZE)
+
+# Mensagens devolvidas no lugar da resposta quando a chamada falha (nunca vão para o cache)
+ERRO_GEMINI = "Desculpe, não consegui entender sua pergunta, por favor, reformule"
+ERRO_GPT = "Erro ao obter resposta do GPT-4 (verifique a chave da API)."
+ERRO_LIMITE = "Muitas mensagens ao modelo neste momento. Aguarde alguns segundos e tente novamente."
+ERRO_INDISPONIVEL = "O modelo está indisponível no momento. Tente novamente em instantes."
+MODELO_INVALIDO = "Modelo inválido."
+RESPOSTAS_DE_ERRO = {ERRO_GEMINI, ERRO_GPT, ERRO_LIMITE, ERRO_INDISPONIVEL, MODELO_INVALIDO}
+
+# Prompt de sistema enviado a cada modelo (faz parte da chave do cache de respostas)
+SYSTEM_PROMPTS = {"gpt": "Você é um assistente útil.", "gemini": None}
+
+# enviar_mensagem_* e _stream_* deixam os erros do SDK subirem: quem decide
+# entre nova tentativa, outro provedor ou mensagem de erro é _call_model/stream_response
+
+def _history(context):
+    """Parte do contexto que muda a resposta (entra na chave do cache); None se vazio."""
+    if not context or not (context["summary"] or context["turns"]):
+        return None
+    return [context["summary"], context["turns"]]
+
+def _gpt_messages(prompt, context):
+    messages = [{"role": "system", "content": SYSTEM_PROMPTS["gpt"]}]
+    if context and context["summary"]:
+        messages.append({"role": "system", "content": f"Resumo da conversa até aqui: {context['summary']}"})
+    for user_message, response in (context["turns"] if context else []):
+        messages.append({"role": "user", "content": user_message})
+        messages.append({"role": "assistant", "content": response})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def _gemini_contents(prompt, context):
+    """Sem histórico, só o texto (como antes); com histórico, os turnos user/model."""
+    if _history(context) is None:
+        return prompt
+    contents = []
+    if context["summary"]:
+        contents.append({"role": "user", "parts": [f"Resumo da conversa até aqui: {context['summary']}"]})
+        contents.append({"role": "model", "parts": ["Entendido."]})
+    for user_message, response in context["turns"]:
+        contents.append({"role": "user", "parts": [user_message]})
+        contents.append({"role": "model", "parts": [response]})
+    contents.append({"role": "user", "parts": [prompt]})
+    return contents
+
+def enviar_mensagem_gemini(modelo, mensagem, contexto=None):
+    resposta = modelo.generate_content(_gemini_contents(mensagem, contexto))
+    return resposta.text
+
+def enviar_mensagem_gpt(mensagem, contexto=None):
+    chat = llm_clients.get("gpt")
+    resposta = chat.create(
+        model="gpt-4",
+        messages=_gpt_messages(mensagem, contexto)
+    )
+    resposta_texto = resposta.choices[0].message.content
+    return resposta_texto
+
+def _stream_gemini(prompt, context=None):
+    modelo = llm_clients.get("gemini")
+    for chunk in modelo.generate_content(_gemini_contents(prompt, context), stream=True):
+        yield chunk.text
+
+def _stream_gpt(prompt, context=None):
+    chat = llm_clients.get("gpt")
+    resposta = chat.create(
+        model="gpt-4",
+        messages=_gpt_messages(prompt, context),
+        stream=True
+    )
+    for chunk in resposta:
+        if chunk.choices:
+            content = getattr(chunk.choices[0].delta, "content", None)
+            if content:
+                yield content
+
+STREAMS = {"gpt": _stream_gpt, "gemini": _stream_gemini}
+
+# Versões assíncronas (servidor assíncrono, app.asgi). O SDK do Gemini não tem
+# cliente assíncrono pelo transporte REST: ele roda no executor padrão do loop
+
+async def enviar_mensagem_gpt_async(mensagem, contexto=None):
+    chat = async_llm_clients.get("gpt")
+    resposta = await chat.create(
+        model="gpt-4",
+        messages=_gpt_messages(mensagem, contexto)
+    )
+    return resposta.choices[0].message.content
+
+async def enviar_mensagem_gemini_async(mensagem, contexto=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, enviar_mensagem_gemini, llm_clients.get("gemini"), mensagem, contexto)
+
+async def iterate_in_executor(make):
+    """Percorre o gerador bloqueante `make()` no executor padrão, um item por vez."""
+    loop = asyncio.get_running_loop()
+    iterator = await loop.run_in_executor(None, make)
+    done = object()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        await loop.run_in_executor(None, iterator.close)
+
+async def _stream_gpt_async(prompt, context=None):
+    chat = async_llm_clients.get("gpt")
+    resposta = await chat.create(
+        model="gpt-4",
+        messages=_gpt_messages(prompt, context),
+        stream=True
+    )
+    async for chunk in resposta:
+        if chunk.choices:
+            content = getattr(chunk.choices[0].delta, "content", None)
+            if content:
+                yield content
+
+def _stream_gemini_async(prompt, context=None):
+    return iterate_in_executor(lambda: _stream_gemini(prompt, context))
+
+STREAMS_ASYNC = {"gpt": _stream_gpt_async, "gemini": _stream_gemini_async}
+
+def _semantic_namespace(model):
+    """Namespace do cache semântico: o modelo e um hash do prompt de sistema."""
+    return f"{model}|{cache_key(model, '', SYSTEM_PROMPTS.get(model))[:16]}"
+
+def _cached_response(model, prompt, context=None):
+    """Procura no cache exato e depois no semântico; None se nenhum tiver a resposta.
+
+    O cache semântico só vale para perguntas sem histórico: com histórico,
+    perguntas parecidas podem ter respostas diferentes.
+    """
+    history = _history(context)
+    if response_cache is not None:
+        cached = response_cache.get(model, prompt, SYSTEM_PROMPTS.get(model), history)
+        if cached is not None:
+            return cached
+    if semantic_cache is not None and history is None and model not in RESPONSE_CACHE_EXCLUDED_MODELS:
+        cached = semantic_cache.lookup(_semantic_namespace(model), prompt)
+        if cached is not None:
+            if response_cache is not None:
+                response_cache.put(model, prompt, cached, SYSTEM_PROMPTS.get(model))
+            return cached
+    return None
+
+def _cache_response(model, prompt, response, context=None):
+    if not response or response in RESPOSTAS_DE_ERRO:
+        return
+    history = _history(context)
+    if response_cache is not None:
+        response_cache.put(model, prompt, response, SYSTEM_PROMPTS.get(model), history)
+    if semantic_cache is not None and history is None and model not in RESPONSE_CACHE_EXCLUDED_MODELS:
+        semantic_cache.put(_semantic_namespace(model), prompt, response)
+
+def _failover_chain(model):
+    """O modelo pedido e, com FAILOVER_ENABLED, o provedor reserva configurado."""
+    chain = [model]
+    other = FAILOVER.get(model)
+    if FAILOVER_ENABLED and other and PROVIDER_KEYS.get(other):
+        chain.append(other)
+    return chain
+
+def _hedge_target(model):
+    """Provedor do hedge (com HEDGE_ENABLED e chave configurada), ou None."""
+    other = FAILOVER.get(model)
+    if HEDGE_ENABLED and other and PROVIDER_KEYS.get(other):
+        return other
+    return None
+
+def _count_failover(model, candidate):
+    print(f"Resposta do {model} obtida do provedor reserva {candidate}.")
+    with _failover_lock:
+        failover_counts[model] += 1
+
+def _error_message(model, error):
+    """Mensagem devolvida no lugar da resposta quando nenhum provedor respondeu."""
+    if isinstance(error, GatewayTimeout) or is_rate_limit_error(error):
+        return ERRO_LIMITE
+    if isinstance(error, CircuitOpen):
+        return ERRO_INDISPONIVEL
+    return ERRO_GPT if model == "gpt" else ERRO_GEMINI
+
+def _stream_attempt(model, prompt, user_id, parts, context=None):
+    """Uma chamada de streaming, com a vaga no gateway ocupada até o fim."""
+    prompt_tokens = estimate_tokens(prompt) + (context["tokens"] if context else 0)
+    with gateways[model].acquire(user_id, prompt_tokens + GATEWAY_RESPONSE_TOKENS) as permit:
+        try:
+            for text in STREAMS[model](prompt, context):
+                if text:
+                    parts.append(text)
+                    yield text
+        except Exception as e:
+            if is_rate_limit_error(e):
+                gateways[model].throttled()
+            raise
+        finally:
+            permit.settle(prompt_tokens + estimate_tokens("".join(parts)))
+
+def _stream_provider(model, prompt, user_id, context=None):
+    """Streaming de um provedor, com novas tentativas antes do primeiro pedaço.
+
+    Devolve (via `yield from`) o texto completo, ou None se a resposta foi
+    cortada no meio; se nada chegou, levanta o último erro.
+    """
+    breaker = breakers[model]
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        if not breaker.allow():
+            raise CircuitOpen(f"Provedor {model} indisponível (circuito aberto).")
+        parts = []
+        try:
+            yield from _stream_attempt(model, prompt, user_id, parts, context)
+        except GeneratorExit:
+            # O navegador desconectou (ou perdeu o hedge): o provedor estava respondendo
+            breaker.record_success()
+            raise
+        except GatewayTimeout:
+            breaker.release()
+            raise
+        except Exception as e:
+            print(f"Erro no streaming da resposta ({model}): {e}")
+            retryable = breaker.record_error(e)
+            if parts:
+                return None
+            if not retryable or attempt == RETRY_ATTEMPTS:
+                raise
+            breaker.record_retry()
+            time.sleep(backoff_delay(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY))
+            continue
+        breaker.record_success()
+        return "".join(parts)
+
+def stream_response(model, prompt, user_id=None, chat_id=None):
+    """Como get_response, mas devolve o texto aos pedaços, à medida que o modelo gera.
+
+    Erros antes do primeiro pedaço passam pelas novas tentativas, pelo
+    circuit breaker, pelo hedge e pelo provedor reserva; se nada der certo,
+    devolve a mesma mensagem de erro de get_response. Se falhar no meio,
+    encerra com o que já chegou. Uma resposta em cache sai num único pedaço.
+    Com `chat_id`, o histórico do chat vai junto (ver build_context).
+    """
+    if model not in STREAMS:
+        yield MODELO_INVALIDO
+        return
+    context = build_context(user_id, chat_id, model)
+    cached = _cached_response(model, prompt, context)
+    if cached is not None:
+        yield cached
+        return
+    hedge_to = _hedge_target(model)
+    if hedge_to:
+        try:
+            answered_by, text = yield from hedgers[f"{model}.stream"].stream(
+                (model, lambda: _stream_provider(model, prompt, user_id, context)),
+                (hedge_to, lambda: _stream_provider(hedge_to, prompt, user_id, context)),
+                fallback=FAILOVER_ENABLED
+            )
+        except Exception as e:
+            print(f"Erro ao obter resposta do {model} (hedge com {hedge_to}): {e}")
+            yield _error_message(model, e)
+            return
+        _cache_response(answered_by, prompt, text, context)
+        return
+    first_error = None
+    for candidate in _failover_chain(model):
+        try:
+            text = yield from _stream_provider(candidate, prompt, user_id, context)
+        except Exception as e:
+            first_error = first_error or e
+            continue
+        if candidate != model:
+            _count_failover(model, candidate)
+        _cache_response(candidate, prompt, text, context)
+        return
+    yield _error_message(model, first_error)
+
+async def _stream_attempt_async(model, prompt, user_id, parts, context=None):
+    """_stream_attempt para corrotinas: a espera pela vaga no gateway não ocupa thread."""
+    prompt_tokens = estimate_tokens(prompt) + (context["tokens"] if context else 0)
+    async with gateways[model].acquire_async(user_id, prompt_tokens + GATEWAY_RESPONSE_TOKENS) as permit:
+        try:
+            async for text in STREAMS_ASYNC[model](prompt, context):
+                if text:
+                    parts.append(text)
+                    yield text
+        except Exception as e:
+            if is_rate_limit_error(e):
+                gateways[model].throttled()
+            raise
+        finally:
+            permit.settle(prompt_tokens + estimate_tokens("".join(parts)))
+
+async def _stream_provider_async(model, prompt, user_id, result, context=None):
+    """_stream_provider para corrotinas; o texto completo fica em result["text"] (None se cortado no meio)."""
+    breaker = breakers[model]
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        if not breaker.allow():
+            raise CircuitOpen(f"Provedor {model} indisponível (circuito aberto).")
+        parts = []
+        try:
+            async for text in _stream_attempt_async(model, prompt, user_id, parts, context):
+                yield text
+        except (GeneratorExit, asyncio.CancelledError):
+            # O navegador desconectou: se o provedor já estava respondendo, conta como sucesso
+            if parts:
+                breaker.record_success()
+            else:
+                breaker.release()
+            raise
+        except GatewayTimeout:
+            breaker.release()
+            raise
+        except Exception as e:
+            print(f"Erro no streaming da resposta ({model}): {e}")
+            retryable = breaker.record_error(e)
+            if parts:
+                return
+            if not retryable or attempt == RETRY_ATTEMPTS:
+                raise
+            breaker.record_retry()
+            await asyncio.sleep(backoff_delay(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY))
+            continue
+        breaker.record_success()
+        result["text"] = "".join(parts)
+        return
+
+async def stream_response_async(model, prompt, user_id=None, chat_id=None):
+    """stream_response para corrotinas (servidor assíncrono).
+
+    O GPT usa o cliente assíncrono e a espera no gateway não ocupa thread; o
+    contexto e os caches rodam no executor padrão. Com hedge, usa o
+    stream_response síncrono no executor (o Hedger é feito para threads).
+    """
+    if model not in STREAMS_ASYNC:
+        yield MODELO_INVALIDO
+        return
+    if _hedge_target(model):
+        async for text in iterate_in_executor(lambda: stream_response(model, prompt, user_id, chat_id)):
+            yield text
+        return
+    loop = asyncio.get_running_loop()
+    context, cached = await loop.run_in_executor(None, _lookup, model, prompt, user_id, chat_id)
+    if cached is not None:
+        yield cached
+        return
+    first_error = None
+    for candidate in _failover_chain(model):
+        result = {"text": None}
+        try:
+            async for text in _stream_provider_async(candidate, prompt, user_id, result, context):
+                yield text
+        except Exception as e:
+            first_error = first_error or e
+            continue
+        if candidate != model:
+            _count_failover(model, candidate)
+        await loop.run_in_executor(None, _cache_response, candidate, prompt, result["text"], context)
+        return
+    yield _error_message(model, first_error)
+
+def _attempt(model, prompt, user_id, context=None):
+    """Uma chamada ao provedor, dentro da cota do gateway."""
+    prompt_tokens = estimate_tokens(prompt) + (context["tokens"] if context else 0)
+    with gateways[model].acquire(user_id, prompt_tokens + GATEWAY_RESPONSE_TOKENS) as permit:
+        try:
+            if model == "gpt":
+                response = enviar_mensagem_gpt(prompt, context)
+            else:
+                response = enviar_mensagem_gemini(llm_clients.get("gemini"), prompt, context)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                gateways[model].throttled()
+            raise
+        permit.settle(prompt_tokens + estimate_tokens(response))
+        return response
+
+def _ask_provider(model, prompt, user_id, context=None):
+    return retry_call(lambda: _attempt(model, prompt, user_id, context), breakers[model],
+                      retries=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY)
+
+async def _attempt_async(model, prompt, user_id, context=None):
+    """_attempt para corrotinas."""
+    prompt_tokens = estimate_tokens(prompt) + (context["tokens"] if context else 0)
+    async with gateways[model].acquire_async(user_id, prompt_tokens + GATEWAY_RESPONSE_TOKENS) as permit:
+        try:
+            if model == "gpt":
+                response = await enviar_mensagem_gpt_async(prompt, context)
+            else:
+                response = await enviar_mensagem_gemini_async(prompt, context)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                gateways[model].throttled()
+            raise
+        permit.settle(prompt_tokens + estimate_tokens(response))
+        return response
+
+async def _ask_provider_async(model, prompt, user_id, context=None):
+    return await retry_call_async(lambda: _attempt_async(model, prompt, user_id, context), breakers[model],
+                                  retries=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY)
+
+def _call_model(model, prompt, user_id=None, context=None):
+    """(modelo que respondeu, resposta), tentando de novo e no provedor reserva se preciso."""
+    if model not in gateways:
+        return model, MODELO_INVALIDO
+    hedge_to = _hedge_target(model)
+    if hedge_to:
+        try:
+            return hedgers[model].call((model, lambda: _ask_provider(model, prompt, user_id, context)),
+                                       (hedge_to, lambda: _ask_provider(hedge_to, prompt, user_id, context)),
+                                       fallback=FAILOVER_ENABLED)
+        except Exception as e:
+            print(f"Erro ao obter resposta do {model} (hedge com {hedge_to}): {e}")
+            return model, _error_message(model, e)
+    first_error = None
+    for candidate in _failover_chain(model):
+        try:
+            response = _ask_provider(candidate, prompt, user_id, context)
+        except Exception as e:
+            print(f"Erro ao obter resposta do {candidate}: {e}")
+            first_error = first_error or e
+            continue
+        if candidate != model:
+            _count_failover(model, candidate)
+        return candidate, response
+    return model, _error_message(model, first_error)
+
+async def _call_model_async(model, prompt, user_id=None, context=None):
+    """_call_model para corrotinas; com hedge, roda o _call_model síncrono no executor."""
+    if model not in gateways:
+        return model, MODELO_INVALIDO
+    if _hedge_target(model):
+        return await asyncio.get_running_loop().run_in_executor(None, _call_model, model, prompt, user_id, context)
+    first_error = None
+    for candidate in _failover_chain(model):
+        try:
+            response = await _ask_provider_async(candidate, prompt, user_id, context)
+        except Exception as e:
+            print(f"Erro ao obter resposta do {candidate}: {e}")
+            first_error = first_error or e
+            continue
+        if candidate != model:
+            _count_failover(model, candidate)
+        return candidate, response
+    return model, _error_message(model, first_error)
+
+def _fetch_response(model, prompt, user_id, context):
+    answered_by, response = _call_model(model, prompt, user_id, context)
+    _cache_response(answered_by, prompt, response, context)
+    return response
+
+async def _fetch_response_async(model, prompt, user_id, context):
+    answered_by, response = await _call_model_async(model, prompt, user_id, context)
+    await asyncio.get_running_loop().run_in_executor(None, _cache_response, answered_by, prompt, response, context)
+    return response
+
+def _flight_key(model, prompt, context):
+    """Chave do single-flight (a mesma do cache de respostas); None se a pergunta não deve ser agrupada."""
+    if inflight is None or model in RESPONSE_CACHE_EXCLUDED_MODELS:
+        return None
+    return cache_key(model, prompt, SYSTEM_PROMPTS.get(model), _history(context))
+
+def _lookup(model, prompt, user_id, chat_id):
+    """(contexto, resposta em cache ou None) da pergunta."""
+    context = build_context(user_id, chat_id, model) if model in gateways else None
+    return context, _cached_response(model, prompt, context)
+
+def get_response(model, prompt, user_id=None, chat_id=None):
+    """Resposta do modelo; perguntas repetidas são atendidas pelo cache de respostas.
+
+    Com `chat_id`, o histórico do chat vai junto (ver build_context). Perguntas
+    iguais feitas ao mesmo tempo esperam a mesma chamada ao modelo.
+    """
+    context, cached = _lookup(model, prompt, user_id, chat_id)
+    if cached is not None:
+        return cached
+    key = _flight_key(model, prompt, context)
+    if key is None:
+        return _fetch_response(model, prompt, user_id, context)
+    response, _ = inflight.do(key, lambda: _fetch_response(model, prompt, user_id, context))
+    return response
+
+async def get_response_async(model, prompt, user_id=None, chat_id=None):
+    """get_response para corrotinas: a chamada ao GPT não ocupa thread enquanto espera o modelo.
+
+    O contexto, os caches e o Gemini rodam no executor padrão do loop.
+    """
+    loop = asyncio.get_running_loop()
+    context, cached = await loop.run_in_executor(None, _lookup, model, prompt, user_id, chat_id)
+    if cached is not None:
+        return cached
+    key = _flight_key(model, prompt, context)
+    if key is None:
+        return await _fetch_response_async(model, prompt, user_id, context)
+    response, _ = await inflight.do_await(key, lambda: _fetch_response_async(model, prompt, user_id, context))
+    return response
+
+def is_error_response(response):
+    """True para as mensagens devolvidas no lugar de uma resposta (não devem ser gravadas)."""
+    return response in RESPOSTAS_DE_ERRO
+
+def run_chat_job(payload):
+    """Handler da fila de jobs: pergunta ao modelo, formata e grava a conversa.
+
+    Uma mensagem de erro do modelo (limite, indisponível) levanta exceção para
+    o job ser repetido; modelo inválido não se resolve repetindo.
+    """
+    model = payload["model"]
+    started = time.perf_counter()
+    response = get_response(model, payload["message"], payload["user_id"], payload["chat_id"])
+    response_timings.record(f"{model}.job", time.perf_counter() - started)
+    if response == MODELO_INVALIDO:
+        raise PermanentError(response)
+    if is_error_response(response):
+        raise RuntimeError(response)
+    formatted_response = format_response(response)
+    save_conversation(payload["user_id"], payload["chat_id"], payload["message"], response, model, formatted_response)
+    return {"response": formatted_response}
+
+# Fila de jobs (POST /jobs); com JOBS_BACKEND = "redis" os workers podem rodar à parte (python -m app.jobs worker)
+job_queue = JobQueue(
+    create_job_store(JOBS_BACKEND, redis_url=REDIS_URL, max_queued=JOBS_MAX_QUEUED,
+                     dead_letter_size=JOBS_DEAD_LETTER_SIZE),
+    run_chat_job,
+    max_attempts=JOBS_MAX_ATTEMPTS,
+    base_delay=JOBS_RETRY_BASE_DELAY,
+    max_delay=JOBS_RETRY_MAX_DELAY,
+    result_ttl=JOBS_RESULT_TTL,
+    lease=JOBS_LEASE
+) if JOBS_ENABLED else None
+if job_queue is not None and JOBS_WORKERS:
+    job_queue.start(JOBS_WORKERS)
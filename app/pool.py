@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Nenhuma conexão ficou livre dentro do tempo de espera configurado."""
+
+
+class ConnectionPool:
+    """Pool limitado de conexões reaproveitáveis.
+
+    As conexões são criadas sob demanda por `factory` até o limite `size`.
+    Ao emprestar, a conexão passa por `validate` (checagem de vida) e, se
+    tiver mais de `max_age` segundos, é fechada e recriada.
+    """
+
+    def __init__(self, factory, size=5, timeout=10.0, max_age=1800.0, validate=None):
+        if size < 1:
+            raise ValueError("O tamanho do pool deve ser pelo menos 1.")
+        self._factory = factory
+        self._size = size
+        self._timeout = timeout
+        self._max_age = max_age
+        self._validate = validate or (lambda conn: conn.is_connected())
+        self._idle = deque()  # (conexão, criada_em)
+        self._created_at = {}
+        self._in_use = 0
+        self._lock = threading.Condition()
+        self._waits = 0
+        self._wait_time = 0.0
+        self._created = 0
+        self._recycled = 0
+        self._discarded = 0
+        self._closed = False
+
+    def _expired(self, created_at):
+        return self._max_age is not None and time.monotonic() - created_at > self._max_age
+
+    def _close_quietly(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _open(self):
+        conn = self._factory()
+        with self._lock:
+            self._created += 1
+            self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def acquire(self, timeout=None):
+        """Empresta uma conexão, esperando até `timeout` segundos por uma vaga."""
+        timeout = self._timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self._closed:
+                raise PoolTimeout("O pool de conexões está fechado.")
+            if not self._idle and self._in_use >= self._size:
+                self._waits += 1
+                started = time.monotonic()
+                while not self._idle and self._in_use >= self._size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        self._wait_time += time.monotonic() - started
+                        raise PoolTimeout(f"Nenhuma conexão livre após {timeout:.1f}s.")
+                    self._lock.wait(remaining)
+                self._wait_time += time.monotonic() - started
+            self._in_use += 1
+            candidate = self._idle.pop() if self._idle else None
+
+        try:
+            if candidate is not None:
+                conn, created_at = candidate
+                if self._expired(created_at):
+                    with self._lock:
+                        self._recycled += 1
+                    self._close_quietly(conn)
+                    return self._open()
+                if self._is_alive(conn):
+                    return conn
+                with self._lock:
+                    self._discarded += 1
+                self._close_quietly(conn)
+            return self._open()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+    def _is_alive(self, conn):
+        try:
+            return bool(self._validate(conn))
+        except Exception:
+            return False
+
+    def release(self, conn, discard=False):
+        """Devolve a conexão ao pool (ou a descarta, se estiver quebrada ou velha)."""
+        created_at = self._created_at.get(id(conn), time.monotonic())
+        with self._lock:
+            self._in_use -= 1
+            keep = not discard and not self._closed and not self._expired(created_at)
+            if keep:
+                self._idle.append((conn, created_at))
+            elif discard:
+                self._discarded += 1
+            elif not self._closed:
+                self._recycled += 1
+            self._lock.notify()
+        if not keep:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Empresta uma conexão e garante a devolução, inclusive em caso de erro.
+
+        Qualquer transação deixada aberta é desfeita na devolução, para que a
+        próxima requisição não herde bloqueios nem um snapshot de leitura antigo.
+        """
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except BaseException:
+            discard = not self._rollback(conn)
+            raise
+        else:
+            discard = not self._rollback(conn)
+        finally:
+            self.release(conn, discard=discard)
+
+    @staticmethod
+    def _rollback(conn):
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        """Retorna um retrato do estado do pool."""
+        with self._lock:
+            return {
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waits": self._waits,
+                "wait_time": round(self._wait_time, 6),
+                "created": self._created,
+                "recycled": self._recycled,
+                "discarded": self._discarded,
+            }
+
+    def close(self):
+        """Fecha as conexões ociosas; as emprestadas são fechadas ao voltar."""
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._lock.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
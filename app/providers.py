@@ -0,0 +1,175 @@
+"""Clientes dos provedores de LLM (Gemini e GPT), criados uma vez por processo.
+
+Antes, cada mensagem chamava `genai.configure` e criava um novo
+`GenerativeModel`, e o GPT reconfigurava o módulo `openai` e abria uma
+conexão HTTPS nova. O `ProviderRegistry` cria cada cliente no primeiro uso
+(ou no aquecimento, com LLM_WARM_UP) e o compartilha entre as threads; os
+clientes HTTP mantêm as conexões abertas (keep-alive) num pool limitado.
+"""
+import itertools
+import threading
+import time
+import google.generativeai as genai
+import openai
+
+
+class ProviderRegistry:
+    """Cria cada cliente uma única vez, sob um lock por provedor.
+
+    `factories` é um dicionário {nome: função sem argumentos que cria o
+    cliente}. Se a criação falhar (ex.: chave ausente), nada fica guardado
+    e o erro sobe para quem pediu o cliente; a próxima chamada tenta de novo.
+    """
+
+    def __init__(self, factories):
+        self._factories = dict(factories)
+        self._clients = {}
+        self._locks = {name: threading.Lock() for name in self._factories}
+        self._builds = {name: 0 for name in self._factories}
+        self._build_time = {name: 0.0 for name in self._factories}
+        self._failures = {name: 0 for name in self._factories}
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        if name not in self._factories:
+            raise KeyError(f"Provedor desconhecido: {name}")
+        with self._locks[name]:
+            client = self._clients.get(name)
+            if client is None:
+                started = time.perf_counter()
+                try:
+                    client = self._factories[name]()
+                except Exception:
+                    self._failures[name] += 1
+                    raise
+                self._build_time[name] += time.perf_counter() - started
+                self._builds[name] += 1
+                self._clients[name] = client
+            return client
+
+    def warm_up(self, names=None):
+        """Cria os clientes antecipadamente; devolve {nome: erro} dos que falharam."""
+        errors = {}
+        for name in names or list(self._factories):
+            try:
+                self.get(name)
+            except Exception as e:
+                errors[name] = e
+        return errors
+
+    def reset(self, name=None):
+        """Descarta os clientes (todos ou um) para que sejam recriados no próximo uso."""
+        for key in [name] if name else list(self._factories):
+            with self._locks[key]:
+                self._clients.pop(key, None)
+
+    def stats(self):
+        return {
+            name: {
+                "ready": name in self._clients,
+                "builds": self._builds[name],
+                "build_time": round(self._build_time[name], 6),
+                "failures": self._failures[name],
+            }
+            for name in self._factories
+        }
+
+
+def gemini_model(api_key, model_name="gemini-pro", endpoint=None):
+    """Configura o SDK do Gemini uma vez e devolve o modelo (thread-safe).
+
+    Com `endpoint` (ex.: o provedor stub), usa o transporte REST nesse endereço.
+    """
+    if endpoint:
+        genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": endpoint})
+    else:
+        genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+def openai_chat(api_key, base_url=None, max_connections=10, keepalive=30, timeout=60, max_retries=2):
+    """Cliente de chat completions do OpenAI com pool de conexões keep-alive.
+
+    Com o SDK novo (openai >= 1.0) devolve `client.chat.completions` de um
+    único `OpenAI`, cujo cliente HTTP mantém o pool; com o SDK antigo configura o módulo uma única vez
+    e instala uma `requests.Session` compartilhada. Nos dois casos o objeto
+    devolvido tem `.create(model=..., messages=...)`. `max_retries` são as
+    novas tentativas internas do SDK novo (o app usa 0 e repete por conta própria).
+    """
+    if not api_key:
+        raise Exception("Chave da API do GPT não configurada.")
+    if hasattr(openai, "OpenAI"):
+        # O cliente do SDK já reaproveita conexões; com o httpx disponível os
+        # limites do pool seguem a configuração
+        try:
+            import httpx
+            http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections,
+                                    keepalive_expiry=keepalive),
+                timeout=timeout
+            )
+        except (ImportError, AttributeError):
+            http_client = None
+        return openai.OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=max_retries,
+                             http_client=http_client).chat.completions
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    openai.api_key = api_key
+    if base_url:
+        openai.api_base = base_url
+    openai.requestssession = session
+    return openai.ChatCompletion
+
+
+class RoundRobin:
+    """Reparte as chamadas `create` entre vários clientes iguais, um de cada vez."""
+
+    def __init__(self, clients):
+        self._clients = list(clients)
+        self._next = itertools.count()
+
+    def create(self, **kwargs):
+        return self._clients[next(self._next) % len(self._clients)].create(**kwargs)
+
+
+def openai_chat_async(api_key, base_url=None, max_connections=1000, keepalive=30, timeout=60, max_retries=2,
+                      clients=1):
+    """Como `openai_chat`, com o cliente assíncrono: `await chat.create(...)`.
+
+    Usado pelo servidor assíncrono (app.asgi); requer o SDK novo (openai >= 1.0).
+    Cada chat em andamento ocupa uma conexão, por isso `max_connections` é bem
+    maior que o do cliente síncrono. O pool do httpx percorre todas as suas
+    conexões a cada requisição: com milhares em andamento num só pool esse
+    custo domina a CPU do loop, então as conexões são divididas entre
+    `clients` clientes (RoundRobin). Os pools pertencem ao loop de eventos em
+    que foram usados pela primeira vez.
+    """
+    if not api_key:
+        raise Exception("Chave da API do GPT não configurada.")
+    if not hasattr(openai, "AsyncOpenAI"):
+        raise Exception("O cliente assíncrono do GPT requer openai >= 1.0.")
+    per_client = max(1, max_connections // clients)
+
+    def build():
+        try:
+            import httpx
+            http_client = openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=per_client,
+                                    max_keepalive_connections=per_client,
+                                    keepalive_expiry=keepalive),
+                timeout=timeout
+            )
+        except (ImportError, AttributeError):
+            http_client = None
+        return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=max_retries,
+                                  http_client=http_client).chat.completions
+
+    if clients <= 1:
+        return build()
+    return RoundRobin(build() for _ in range(clients))
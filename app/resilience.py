@@ -0,0 +1,204 @@
+"""Novas tentativas e circuit breaker das chamadas aos provedores de LLM.
+
+Erros temporários (429, 5xx, timeout, falha de conexão) são repetidos com
+espera exponencial e jitter. Cada provedor tem um `CircuitBreaker`:
+depois de `failure_threshold` falhas seguidas o circuito abre e as chamadas
+falham na hora, sem esperar o timeout do provedor; passado
+`reset_timeout`, uma chamada de teste (meio-aberto) decide se ele fecha de
+novo ou continua aberto.
+
+Um 429 ou um erro do pedido (ex.: 400) mostram que o provedor está no ar:
+não contam como falha para o circuito.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from app.gateway import GatewayTimeout, is_rate_limit_error
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {
+    # openai >= 1.0
+    "APIConnectionError", "APITimeoutError", "InternalServerError", "RateLimitError",
+    # openai < 1.0
+    "APIError", "Timeout", "TryAgain", "ServiceUnavailableError",
+    # google.api_core (Gemini)
+    "DeadlineExceeded", "ServiceUnavailable", "ResourceExhausted", "TooManyRequests",
+    # requests/httpx/socket
+    "ConnectionError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "TimeoutError",
+}
+
+
+class CircuitOpen(Exception):
+    """O circuito do provedor está aberto: a chamada nem foi feita."""
+
+
+def error_status(error):
+    """Código HTTP do erro de um SDK, se houver."""
+    for attr in ("status_code", "http_status", "code"):
+        value = getattr(error, attr, None)
+        value = getattr(value, "value", value)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable_error(error):
+    """True para erros temporários, que valem uma nova tentativa."""
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Espera antes da nova tentativa `attempt` (0, 1, ...): exponencial com jitter completo."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Estados fechado -> aberto -> meio-aberto -> fechado, por provedor."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_calls=1):
+        self.name = name
+        self._threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._half_open_calls = half_open_calls
+        self._state = self.CLOSED
+        self._failures = 0          # falhas seguidas
+        self._opened_at = 0.0
+        self._probes = 0            # chamadas de teste em andamento no meio-aberto
+        self._lock = threading.Lock()
+        self._transitions = deque(maxlen=20)
+        self._stats = {"calls": 0, "successes": 0, "failures": 0, "rejected": 0, "retries": 0, "opened": 0}
+
+    def _move(self, state, reason):
+        print(f"Circuito do provedor {self.name}: {self._state} -> {state} ({reason})")
+        self._transitions.append({"at": time.time(), "from": self._state, "to": state, "reason": reason})
+        self._state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+            self._stats["opened"] += 1
+        elif state == self.HALF_OPEN:
+            self._probes = 0
+        else:
+            self._failures = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Reserva a chamada; False se o circuito está aberto (ou o teste já está em andamento)."""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                self._move(self.HALF_OPEN, f"{self._reset_timeout}s aberto")
+            if self._state == self.CLOSED or (self._state == self.HALF_OPEN and self._probes < self._half_open_calls):
+                if self._state == self.HALF_OPEN:
+                    self._probes += 1
+                self._stats["calls"] += 1
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._stats["successes"] += 1
+            self._failures = 0
+            if self._state == self.HALF_OPEN:
+                self._move(self.CLOSED, "chamada de teste bem-sucedida")
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self._state == self.HALF_OPEN:
+                self._move(self.OPEN, f"chamada de teste falhou: {type(error).__name__}")
+            elif self._state == self.CLOSED and self._failures >= self._threshold:
+                self._move(self.OPEN, f"{self._failures} falhas seguidas")
+
+    def record_error(self, error):
+        """Registra o erro de uma chamada permitida; devolve se vale tentar de novo."""
+        retryable = is_retryable_error(error)
+        if retryable and not is_rate_limit_error(error):
+            self.record_failure(error)
+        else:
+            # O provedor respondeu: não é sinal de queda
+            self.record_success()
+        return retryable
+
+    def release(self):
+        """A chamada permitida não chegou ao provedor (ex.: fila do gateway): libera a vaga de teste."""
+        with self._lock:
+            self._stats["calls"] -= 1
+            if self._state == self.HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record_retry(self):
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            data = dict(self._stats)
+            data["state"] = state
+            data["consecutive_failures"] = self._failures
+            data["transitions"] = list(self._transitions)
+            return data
+
+
+def retry_call(fn, breaker, retries=2, base_delay=0.5, max_delay=8, sleep=time.sleep):
+    """Chama `fn()` pelo circuito `breaker`, repetindo erros temporários.
+
+    Levanta `CircuitOpen` se o circuito não deixar chamar, ou o último erro
+    quando ele não é temporário ou as tentativas acabam.
+    """
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            raise CircuitOpen(f"Provedor {breaker.name} indisponível (circuito aberto).")
+        try:
+            result = fn()
+        except GatewayTimeout:
+            breaker.release()
+            raise
+        except Exception as e:
+            if not breaker.record_error(e) or attempt == retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"Erro temporário no provedor {breaker.name} ({e}); nova tentativa em {delay:.2f}s")
+            breaker.record_retry()
+            sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+async def retry_call_async(fn, breaker, retries=2, base_delay=0.5, max_delay=8):
+    """Como `retry_call`, para corrotinas: `fn()` devolve um awaitable e a espera é `asyncio.sleep`."""
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            raise CircuitOpen(f"Provedor {breaker.name} indisponível (circuito aberto).")
+        try:
+            result = await fn()
+        except (GatewayTimeout, asyncio.CancelledError):
+            breaker.release()
+            raise
+        except Exception as e:
+            if not breaker.record_error(e) or attempt == retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"Erro temporário no provedor {breaker.name} ({e}); nova tentativa em {delay:.2f}s")
+            breaker.record_retry()
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,180 @@
+"""Cache das respostas dos modelos para perguntas idênticas.
+
+A chave é o hash de (modelo, pergunta normalizada, prompt de sistema,
+histórico enviado junto). Uma camada LRU em memória atende os acertos mais
+frequentes; opcionalmente, uma segunda camada no banco (tabela
+`response_cache`) sobrevive a reinícios e é compartilhada entre processos.
+As duas respeitam o TTL; a do banco é podada a cada `trim_every` gravações
+para não passar de `store_max_entries` linhas.
+
+Uso:
+    python -m app.response_cache purge [--model gemini]
+"""
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt):
+    """Ignora diferenças de maiúsculas, acentuação composta e espaços."""
+    return SPACES_RE.sub(" ", unicodedata.normalize("NFKC", prompt)).strip().casefold()
+
+
+def cache_key(model, prompt, system_prompt=None, history=None):
+    """Hash SHA-256 (hex) da combinação que determina a resposta."""
+    history_hash = hashlib.sha256(json.dumps(history or [], ensure_ascii=False).encode()).hexdigest()
+    payload = json.dumps([model, normalize_prompt(prompt), system_prompt or "", history_hash], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Cache LRU de respostas, com uma camada persistente opcional.
+
+    `store` é o backend de armazenamento (ou None para só memória);
+    `excluded_models` são os modelos que nunca passam pelo cache.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=86400, store=None,
+                 store_max_entries=100000, excluded_models=(), trim_every=500):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._store = store
+        self._store_max_entries = store_max_entries
+        self._excluded = set(excluded_models)
+        self._trim_every = trim_every
+        self._entries = OrderedDict()  # chave -> (modelo, resposta, bytes, criada_em)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "store_hits": 0, "misses": 0, "puts": 0, "evictions": 0, "store_errors": 0}
+
+    def enabled_for(self, model):
+        return model not in self._excluded
+
+    def _remember(self, key, model, response, created):
+        size = len(response.encode())
+        if size > self._max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._entries[key] = (model, response, size, created)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self._max_entries or self._bytes > self._max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted[2]
+            self._stats["evictions"] += 1
+
+    def get(self, model, prompt, system_prompt=None, history=None):
+        """Resposta guardada para a pergunta, ou None (também se o modelo está excluído)."""
+        if not self.enabled_for(model):
+            return None
+        key = cache_key(model, prompt, system_prompt, history)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[3] >= now - self._ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                self._entries.pop(key)
+                self._bytes -= entry[2]
+        if self._store is not None:
+            try:
+                response = self._store.cached_response(key, now - self._ttl)
+            except self._store.errors as err:
+                print(f"Erro ao ler o cache de respostas: {err}")
+                response = None
+                with self._lock:
+                    self._stats["store_errors"] += 1
+            if response is not None:
+                with self._lock:
+                    self._stats["store_hits"] += 1
+                    self._remember(key, model, response, now)
+                return response
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, model, prompt, response, system_prompt=None, history=None):
+        if not self.enabled_for(model):
+            return
+        key = cache_key(model, prompt, system_prompt, history)
+        now = time.time()
+        with self._lock:
+            self._remember(key, model, response, now)
+            self._stats["puts"] += 1
+            trim = self._trim_every and self._stats["puts"] % self._trim_every == 0
+        if self._store is not None:
+            try:
+                self._store.store_response(key, model, response, now)
+                if trim:
+                    self._store.trim_responses(now - self._ttl, self._store_max_entries)
+            except self._store.errors as err:
+                print(f"Erro ao gravar no cache de respostas: {err}")
+                with self._lock:
+                    self._stats["store_errors"] += 1
+
+    def purge(self, model=None):
+        """Esvazia o cache (todo ou só as respostas de um modelo).
+
+        Devolve quantas respostas saíram de cada camada: {"memory": n, "store": n}
+        ("store" é None sem a camada do banco). A camada de memória é só deste processo.
+        """
+        with self._lock:
+            keys = [k for k, entry in self._entries.items() if model is None or entry[0] == model]
+            for key in keys:
+                self._bytes -= self._entries.pop(key)[2]
+        store = self._store.purge_responses(model) if self._store is not None else None
+        return {"memory": len(keys), "store": store}
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["entries"] = len(self._entries)
+            data["bytes"] = self._bytes
+            lookups = data["hits"] + data["store_hits"] + data["misses"]
+            data["hit_rate"] = round((data["hits"] + data["store_hits"]) / lookups, 4) if lookups else 0.0
+            data["persistent"] = self._store is not None
+            data["excluded_models"] = sorted(self._excluded)
+            return data
+
+
+def main(argv=None):
+    from app import storage
+    from app.models import semantic_cache
+
+    parser = argparse.ArgumentParser(description="Cache de respostas dos modelos")
+    sub = parser.add_subparsers(dest="command", required=True)
+    purge = sub.add_parser("purge", help="apaga as respostas em cache (exato e semântico)")
+    purge.add_argument("--model", help="só as respostas deste modelo")
+    args = parser.parse_args(argv)
+
+    if semantic_cache is not None and semantic_cache.locked_out:
+        # Reescrever os arquivos por baixo do servidor não adianta: ele continua com o log antigo aberto
+        print("Erro: o cache semântico está em uso pelo servidor; pare-o ou use POST /admin/response-cache/purge.")
+        return 1
+    try:
+        if semantic_cache is not None:
+            removed = semantic_cache.purge(f"{args.model}|" if args.model else None)
+            print(f"{removed} respostas removidas do cache semântico.")
+        # A camada em memória deste processo acabou de nascer: só a do banco interessa
+        removed = storage.purge_responses(args.model)
+        print(f"{removed} respostas removidas do cache no banco.")
+        return 0
+    except storage.errors as err:
+        print(f"Erro de banco de dados: {err}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
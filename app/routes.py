@@ -1,9 +1,18 @@
-from flask import render_template, request, session, redirect, url_for, jsonify
-from app import app, get_db_connection
-from app.models import save_conversation, load_conversations, clear_conversations, get_response
+from flask import render_template, request, session, url_for, jsonify, Response
+from app import app, storage
+from app.models import save_conversation, load_chats, chats_cursor, search_conversations, search_cursor, clear_conversations, get_response, write_behind, transcript_cache, llm_clients
+from app.models import stream_response, checkpoint_conversation, response_timings, response_cache, semantic_cache
+from app.models import gateways, breakers, failover_counts, hedgers, summary_refresher, is_error_response, ERRO_LIMITE, ERRO_INDISPONIVEL, MODELO_INVALIDO
+from app.models import job_queue, inflight, render_queue, BODY_HTML, BODY_RAW
+from app.models import history_etag, history_page
+from app.jobs import QueueFull, FINISHED
+from app.formatting import ResponseFormatter, format_response, render_cache
+from config import GEMINI_API_KEY, OPENAI_API_KEY, HISTORY_PAGE_SIZE, CHATS_PAGE_SIZE, SEARCH_PAGE_SIZE
+from config import STREAM_CHECKPOINT_INTERVAL, ADMIN_TOKEN, JOBS_MAX_WAIT
+import hmac
+import json
 import os
-from config import GEMINI_API_KEY, OPENAI_API_KEY
-import re
+import time
 import uuid
 
 @app.route("/", methods=["GET", "POST"])
@@ -19,45 +28,198 @@ def index():
     user_id = session["user_id"]
     chat_id = session["chat_id"]
 
-    # Carrega as conversas do chat atual
-    conversations = load_conversations(user_id, chat_id)
-
-    # Agrupa as conversas por data na barra lateral
-    sidebar_conversations = {}
-    for conv in conversations:
-        date_group = conv['date_group'].strftime('%Y-%m-%d')
-        if date_group not in sidebar_conversations:
-            sidebar_conversations[date_group] = []
-        sidebar_conversations[date_group].append(conv)
-
     # Define o modelo padrão com base nas chaves de API
-    if GEMINI_API_KEY and not OPENAI_API_KEY:
-        default_model = "gemini"
-    elif OPENAI_API_KEY and not GEMINI_API_KEY:
-        default_model = "gpt"
-    else:
-        default_model = "gpt"
+    default_model = choose_default_model()
 
     if request.method == "POST":
         user_message = request.form["message"]
         selected_model = request.form.get("model", default_model)
 
-        response = get_response(selected_model, user_message)
+        started = time.perf_counter()
+        response = get_response(selected_model, user_message, user_id, chat_id)
+        response_timings.record(f"{selected_model}.response", time.perf_counter() - started)
         formatted_response = format_response(response)
 
-        # Salva a conversa no banco de dados
-        save_conversation(user_id, chat_id, user_message, formatted_response, selected_model)
+        # Falhas do provedor (ex.: limite de requisições) não são gravadas como resposta
+        if is_error_response(response):
+            return jsonify({'response': formatted_response, 'error': True}), error_status(response)
+
+        # Salva a conversa no banco de dados (o texto do modelo e o HTML já pronto)
+        save_conversation(user_id, chat_id, user_message, response, selected_model, formatted_response)
 
         # Retorna a resposta formatada como JSON
         return jsonify({'response': formatted_response})
 
+    # A barra lateral e o histórico do chat vêm pelo JavaScript (GET /conversations e /chats)
     return render_template(
         "index.html",
-        conversations=conversations,
-        sidebar_conversations=sidebar_conversations,
         default_model=default_model
     )
 
+def choose_default_model():
+    """Modelo padrão com base nas chaves de API configuradas."""
+    if GEMINI_API_KEY and not OPENAI_API_KEY:
+        return "gemini"
+    elif OPENAI_API_KEY and not GEMINI_API_KEY:
+        return "gpt"
+    return "gpt"
+
+def error_status(response):
+    """Código HTTP para uma resposta de erro de get_response."""
+    if response == ERRO_LIMITE:
+        return 429
+    if response == MODELO_INVALIDO:
+        return 400
+    if response == ERRO_INDISPONIVEL:
+        return 503
+    return 502
+
+def sse_event(data, event=None):
+    """Serializa um evento Server-Sent Events com um JSON no campo data."""
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+def stream_turn(user_id, chat_id, user_message, model):
+    """Repassa os pedaços da resposta ao navegador e grava a conversa no fim.
+
+    Cada evento traz o HTML que ficou definitivo ("html", para acrescentar) e
+    a prévia do trecho ainda aberto ("tail", para substituir). Gerações mais
+    longas que STREAM_CHECKPOINT_INTERVAL são gravadas parcialmente e
+    atualizadas no fim; se o navegador desconectar, grava o que já chegou.
+    """
+    started = time.perf_counter()
+    last_checkpoint = started
+    ttft = None
+    formatter = ResponseFormatter()
+    raw = []
+    html = ""
+    conversation_id = None
+    try:
+        for text in stream_response(model, user_message, user_id, chat_id):
+            if ttft is None:
+                ttft = time.perf_counter() - started
+                response_timings.record(f"{model}.ttft", ttft)
+            raw.append(text)
+            delta = formatter.feed(text)
+            html += delta
+            yield sse_event({"html": delta, "tail": formatter.tail()})
+            if STREAM_CHECKPOINT_INTERVAL and time.perf_counter() - last_checkpoint >= STREAM_CHECKPOINT_INTERVAL:
+                conversation_id = checkpoint_conversation(user_id, chat_id, user_message, "".join(raw), model,
+                                                          conversation_id)
+                last_checkpoint = time.perf_counter()
+    finally:
+        html += formatter.close()
+        text = "".join(raw)
+        failed = is_error_response(text)
+        if conversation_id is not None:
+            checkpoint_conversation(user_id, chat_id, user_message, text, model, conversation_id, html=html)
+        elif not failed:
+            save_conversation(user_id, chat_id, user_message, text, model, html)
+        total = time.perf_counter() - started
+        response_timings.record(f"{model}.stream_total", total)
+    yield sse_event({
+        "html": html,
+        "error": failed,
+        "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+        "total_ms": round(total * 1000, 1)
+    }, event="done")
+
+@app.route("/stream", methods=["POST"])
+def stream():
+    if "user_id" not in session:
+        session["user_id"] = "1"
+    if "chat_id" not in session:
+        session["chat_id"] = generate_chat_id()
+
+    user_message = request.form["message"]
+    selected_model = request.form.get("model", choose_default_model())
+    return Response(
+        stream_turn(session["user_id"], session["chat_id"], user_message, selected_model),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+JOBS_DESATIVADOS = "A fila de jobs está desativada."
+
+def job_view(job):
+    """Campos do job devolvidos ao cliente (sem o payload)."""
+    result = job["result"] or {}
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "max_attempts": job["max_attempts"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+        "next_attempt_at": job["next_attempt_at"],
+        "response": result.get("response"),
+        "error": job["error"]
+    }
+
+def session_job(job_id):
+    """O job, se existir e for do usuário da sessão."""
+    job = job_queue.get(job_id)
+    if job is None or job["owner"] != session.get("user_id", "1"):
+        return None
+    return job
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Enfileira a pergunta e responde na hora com o id do job (202)."""
+    if job_queue is None:
+        return jsonify({"status": "error", "message": JOBS_DESATIVADOS}), 404
+    if "user_id" not in session:
+        session["user_id"] = "1"
+    if "chat_id" not in session:
+        session["chat_id"] = generate_chat_id()
+
+    selected_model = request.form.get("model", choose_default_model())
+    if selected_model not in gateways:
+        return jsonify({"status": "error", "message": MODELO_INVALIDO}), 400
+    payload = {
+        "user_id": session["user_id"],
+        "chat_id": session["chat_id"],
+        "message": request.form["message"],
+        "model": selected_model
+    }
+    try:
+        job = job_queue.submit(payload, owner=session["user_id"])
+    except QueueFull as e:
+        print(f"Job recusado: {e}")
+        return jsonify({"status": "error", "message": ERRO_LIMITE}), 503, {"Retry-After": "5"}
+    status_url = url_for("job_status", job_id=job["id"])
+    return jsonify(dict(job_view(job), status_url=status_url)), 202, {"Location": status_url}
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Estado do job; com ?wait=N espera até N segundos (máx. JOBS_MAX_WAIT) ele terminar."""
+    if job_queue is None:
+        return jsonify({"status": "error", "message": JOBS_DESATIVADOS}), 404
+    job = session_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job não encontrado."}), 404
+    wait = min(request.args.get("wait", default=0, type=float), JOBS_MAX_WAIT)
+    if wait > 0 and job["status"] not in FINISHED:
+        job = job_queue.wait(job_id, wait) or job
+    return jsonify(job_view(job))
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-Sent Events com o estado do job a cada mudança; o evento "done" traz o resultado."""
+    if job_queue is None:
+        return jsonify({"status": "error", "message": JOBS_DESATIVADOS}), 404
+    if session_job(job_id) is None:
+        return jsonify({"status": "error", "message": "Job não encontrado."}), 404
+
+    def events():
+        for job in job_queue.watch(job_id, JOBS_MAX_WAIT):
+            if job is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield sse_event(job_view(job), event="done" if job["status"] in FINISHED else "status")
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/clear", methods=["POST"])
 def clear_history():
     user_id = session.get("user_id", "1")
@@ -80,35 +242,69 @@ def new_chat():
 def generate_chat_id():
     return str(uuid.uuid4())
 
-def format_response(response):
-    """Formata a resposta do Gemini para melhor legibilidade."""
-    lines = response.split('\n')
-    formatted_lines = []
-    for line in lines:
-        while len(line) > 80:
-            split_point = line.rfind(' ', 0, 80)
-            if split_point == -1:
-                split_point = 80
-            formatted_lines.append(line[:split_point])
-            line = line[split_point:].strip()
-        if len(line.strip()) > 5:
-            formatted_lines.append(line)
-    formatted_response = "<br>".join(formatted_lines)
-    formatted_response = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', formatted_response)
-    return formatted_response
+def page_params(args=None):
+    """Lê os parâmetros de paginação ?before=<id>&limit=N da requisição (ou de `args`).
+
+    Devolve (before, limit), ou None se `before` não for um id: tratá-lo como
+    "sem cursor" devolveria a primeira página de novo e prenderia a rolagem infinita num laço.
+    """
+    args = request.args if args is None else args
+    before = args.get("before") or None
+    if before is not None:
+        try:
+            before = int(before)
+        except ValueError:
+            return None
+    limit = args.get("limit", default=HISTORY_PAGE_SIZE, type=int)
+    return before, limit
+
+def body_param(args=None):
+    """?body=html (padrão) ou ?body=raw (o texto do modelo, para renderizar no cliente); None se inválido."""
+    body = (request.args if args is None else args).get("body", BODY_HTML)
+    return body if body in (BODY_HTML, BODY_RAW) else None
+
+BODY_INVALIDO = "Parâmetro body inválido (use html ou raw)."
+CURSOR_INVALIDO = "Parâmetro before inválido (use o next_cursor da página anterior)."
+
+def not_modified(req, etag):
+    """True se o If-None-Match da requisição já tem esta versão (comparação fraca)."""
+    return etag is not None and req.if_none_match.contains_weak(etag)
+
+def history_headers(response, etag, last_modified):
+    """ETag e Last-Modified do histórico; o navegador guarda a resposta, mas revalida antes de usá-la."""
+    if etag is not None:
+        # Fraco: o HTML da mesma versão pode sair do banco ou ser renderizado de novo
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route("/chat/<chat_id>", methods=["GET"])
 def load_chat(chat_id):
     user_id = session.get("user_id", "1")
-
-    # Carrega as conversas do chat_id selecionado
-    conversations = load_conversations(user_id, chat_id)
+    params = page_params()
+    if params is None:
+        return jsonify({"status": "error", "message": CURSOR_INVALIDO}), 400
+    before, limit = params
+    body = body_param()
+    if body is None:
+        return jsonify({"status": "error", "message": BODY_INVALIDO}), 400
 
     # Atualiza o chat_id atual na sessão
     session["chat_id"] = chat_id
 
-    # Retorna as conversas como JSON
-    return jsonify({"conversations": conversations})
+    # 304 se o cliente já tem esta versão da página, sem ler as mensagens
+    etag, last_modified = history_etag(user_id, chat_id, [before, limit, body])
+    if not_modified(request, etag):
+        return history_headers(Response(status=304), etag, last_modified)
+
+    # Carrega uma página das conversas do chat_id selecionado (mais novas primeiro)
+    conversations, next_cursor, ok = history_page(user_id, chat_id, before, limit, body)
+
+    # Retorna as conversas como JSON (sem ETag se o banco falhou: a página pode estar incompleta)
+    response = jsonify({"conversations": conversations, "next_cursor": next_cursor})
+    return history_headers(response, etag if ok else None, last_modified)
 
 @app.route("/conversations", methods=["GET"])
 def get_conversations():
@@ -116,18 +312,133 @@ def get_conversations():
     chat_id = session.get("chat_id")
 
     if not user_id or not chat_id:
-        return jsonify({"conversations": [], "sidebar_conversations": {}, "current_chat_id": None})
+        return jsonify({"conversations": [], "sidebar_conversations": {}, "current_chat_id": None, "next_cursor": None})
 
-    conversations = load_conversations(user_id, chat_id)
-    sidebar_conversations = {}
-    for conv in conversations:
-        date_group = conv['date_group'].strftime('%Y-%m-%d')
-        if date_group not in sidebar_conversations:
-            sidebar_conversations[date_group] = []
-        sidebar_conversations[date_group].append(conv)
+    params = page_params()
+    if params is None:
+        return jsonify({"status": "error", "message": CURSOR_INVALIDO}), 400
+    before, limit = params
+    body = body_param()
+    if body is None:
+        return jsonify({"status": "error", "message": BODY_INVALIDO}), 400
+    etag, last_modified = history_etag(user_id, chat_id, [before, limit, body], sidebar=True)
+    if not_modified(request, etag):
+        return history_headers(Response(status=304), etag, last_modified)
+    conversations, next_cursor, ok = history_page(user_id, chat_id, before, limit, body)
+    chats, chats_next_cursor = load_chats(user_id)
 
-    return jsonify({
+    response = jsonify({
         "conversations": conversations,
-        "sidebar_conversations": sidebar_conversations,
-        "current_chat_id": chat_id
-    })
\ No newline at end of file
+        "sidebar_conversations": group_chats_by_day(chats),
+        "current_chat_id": chat_id,
+        "next_cursor": next_cursor,
+        "chats_next_cursor": chats_next_cursor
+    })
+    return history_headers(response, etag if ok else None, last_modified)
+
+@app.route("/chats", methods=["GET"])
+def list_chats():
+    user_id = session.get("user_id", "1")
+    before = request.args.get("before")
+    limit = request.args.get("limit", default=CHATS_PAGE_SIZE, type=int)
+    if before and chats_cursor(before) is None:
+        return jsonify({"status": "error", "message": CURSOR_INVALIDO}), 400
+
+    chats, next_cursor = load_chats(user_id, before, limit)
+    return jsonify({"groups": group_chats_by_day(chats), "next_cursor": next_cursor})
+
+@app.route("/search", methods=["GET"])
+def search():
+    user_id = session.get("user_id", "1")
+    query = request.args.get("q", "").strip()
+    before = request.args.get("before")
+    limit = request.args.get("limit", default=SEARCH_PAGE_SIZE, type=int)
+    if before and search_cursor(before) is None:
+        return jsonify({"status": "error", "message": CURSOR_INVALIDO}), 400
+
+    results, next_cursor = search_conversations(user_id, query, before, limit)
+    return jsonify({"results": results, "next_cursor": next_cursor})
+
+def group_chats_by_day(chats):
+    """Agrupa chats já ordenados por data (vinda do SQL) em [{date, chats}]."""
+    groups = []
+    for chat in chats:
+        date_group = chat['date_group'].strftime('%Y-%m-%d')
+        if not groups or groups[-1]["date"] != date_group:
+            groups.append({"date": date_group, "chats": []})
+        groups[-1]["chats"].append(chat)
+    return groups
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Estatísticas internas para acompanhamento de desempenho
+    return jsonify({
+        "storage": storage.stats(),
+        "write_behind": write_behind.snapshot(),
+        "transcript_cache": transcript_cache.stats() if transcript_cache is not None else None,
+        "llm_clients": llm_clients.stats(),
+        "response_timings": response_timings.snapshot(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+        "gateways": {name: gateway.stats() for name, gateway in gateways.items()},
+        "circuit_breakers": {name: breaker.stats() for name, breaker in breakers.items()},
+        "failovers": dict(failover_counts),
+        "hedging": {name: hedger.stats() for name, hedger in hedgers.items()},
+        "summaries": summary_refresher.stats(),
+        "jobs": job_queue.stats() if job_queue is not None else None,
+        "single_flight": inflight.stats() if inflight is not None else None,
+        "render_cache": render_cache.stats() if render_cache is not None else None,
+        "render_queue": render_queue.stats() if render_queue is not None else None
+    })
+
+def is_admin_request():
+    """Exige o cabeçalho X-Admin-Token igual a ADMIN_TOKEN; sem ADMIN_TOKEN, as rotas ficam fechadas.
+
+    O endereço de origem não basta: atrás de um proxy local todo cliente chega como 127.0.0.1.
+    """
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), ADMIN_TOKEN.encode())
+
+@app.route("/admin/response-cache/purge", methods=["POST"])
+def purge_response_cache():
+    """Limpa os caches de respostas e devolve quantas saíram de cada camada.
+
+    Vale só para o processo que atendeu: com vários workers, a camada em
+    memória e o cache semântico dos outros continuam até o TTL (só a camada
+    do banco é compartilhada). O `pid` da resposta mostra qual foi limpo.
+    """
+    if not is_admin_request():
+        return jsonify({"status": "error", "message": "Acesso negado."}), 403
+    model = request.args.get("model") or None
+    removed = {"memory": 0, "store": None, "semantic": None}
+    try:
+        if semantic_cache is not None:
+            removed["semantic"] = semantic_cache.purge(f"{model}|" if model else None)
+        if response_cache is not None:
+            removed.update(response_cache.purge(model))
+    except storage.errors as err:
+        print(f"Erro ao limpar o cache de respostas: {err}")
+        return jsonify({"status": "error", "message": "Erro ao limpar o cache de respostas."}), 500
+    return jsonify({"status": "success", "removed": removed, "pid": os.getpid()})
+
+@app.route("/admin/jobs/dead", methods=["GET"])
+def dead_jobs():
+    """Jobs na fila de mortos, do mais recente para o mais antigo (?limit=N)."""
+    if not is_admin_request():
+        return jsonify({"status": "error", "message": "Acesso negado."}), 403
+    if job_queue is None:
+        return jsonify({"status": "error", "message": JOBS_DESATIVADOS}), 404
+    limit = max(1, min(request.args.get("limit", default=50, type=int), 500))
+    return jsonify({"jobs": [dict(job_view(job), payload=job["payload"]) for job in job_queue.dead_letters(limit)]})
+
+@app.route("/admin/jobs/<job_id>/retry", methods=["POST"])
+def retry_dead_job(job_id):
+    if not is_admin_request():
+        return jsonify({"status": "error", "message": "Acesso negado."}), 403
+    if job_queue is None:
+        return jsonify({"status": "error", "message": JOBS_DESATIVADOS}), 404
+    job = job_queue.requeue(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job não está na fila de mortos."}), 404
+    return jsonify(job_view(job))
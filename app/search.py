@@ -0,0 +1,102 @@
+"""Busca textual no histórico de conversas.
+
+O texto pesquisável de cada conversa (mensagem + resposta, sem as tags HTML
+nem os marcadores do Markdown)
+fica numa tabela de índice própria: `conversations_search` com índice
+FULLTEXT no MySQL e a tabela virtual FTS5 `conversations_fts` no SQLite.
+Ela é alimentada na mesma transação do INSERT, de modo que a busca funciona
+mesmo com o texto da conversa gravado comprimido.
+
+Uso:
+    python -m app.search reindex   # reconstrói o índice a partir do histórico
+"""
+import html
+import re
+import sys
+from app.formatting import MARKDOWN, format_response
+
+TAG_RE = re.compile(r"<[^>]+>")
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def strip_html(text):
+    """Texto visível de uma resposta formatada (as quebras <br> viram espaço)."""
+    if not text:
+        return ""
+    return html.unescape(TAG_RE.sub(" ", text))
+
+
+def markdown_text(text):
+    """Texto visível de uma resposta em Markdown: renderizada (com o cache de renderização) e sem as tags."""
+    return strip_html(format_response(text)) if text else ""
+
+
+def search_body(user_message, gpt_response, response_format=None):
+    """Texto indexado para uma conversa, também usado nos trechos (sem **, #, crases, etc.)."""
+    response = markdown_text(gpt_response) if response_format == MARKDOWN else strip_html(gpt_response)
+    return strip_html(user_message) + "\n" + response
+
+
+def query_terms(query):
+    """Palavras da busca, sem operadores."""
+    return TOKEN_RE.findall(query.lower())
+
+
+def fts5_query(query):
+    """Converte a busca do usuário numa expressão FTS5 segura (todas as palavras)."""
+    return " ".join(f'"{term}"' for term in query_terms(query))
+
+
+def make_snippet(text, terms, width=160):
+    """Trecho do texto em volta da primeira palavra encontrada, com <mark>.
+
+    O trecho é escapado antes de marcar as palavras, então pode ir direto
+    para o innerHTML.
+    """
+    text = " ".join(text.split())
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - width // 3) if positions else 0
+    end = min(len(text), start + width)
+    snippet = html.escape(text[start:end])
+    for term in sorted(set(terms), key=len, reverse=True):
+        snippet = re.sub(f"({re.escape(html.escape(term))})", r"<mark>\1</mark>", snippet, flags=re.IGNORECASE)
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+def main(argv=None):
+    from app import storage
+    from app.models import body_codec
+
+    args = argv if argv is not None else sys.argv[1:]
+    if args != ["reindex"]:
+        print("Uso: python -m app.search reindex")
+        return 2
+    try:
+        last_id = 0
+        total = 0
+        storage.clear_search_index()
+        while True:
+            rows = storage.body_rows(last_id, 1000)
+            if not rows:
+                break
+            entries = []
+            for row in rows:
+                conv = body_codec.decode(row)
+                entries.append((row["id"], row["user_id"], row["chat_id"],
+                                search_body(conv["user_message"], conv["gpt_response"],
+                                            row["response_format"])))
+            storage.index_bodies(entries)
+            last_id = rows[-1]["id"]
+            total += len(rows)
+            print(f"  até o id {last_id}: {total} conversas indexadas")
+        print(f"Índice de busca reconstruído: {total} conversas.")
+        return 0
+    except storage.errors as err:
+        print(f"Erro de banco de dados: {err}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""Cache semântico: reaproveita respostas de perguntas parecidas.
+
+Cada pergunta vira um vetor (por padrão, n-gramas de caracteres e palavras
+espalhados por hashing num vetor de `dim` posições, sem modelo externo nem
+rede). Os vetores ficam numa matriz NumPy float16/float32 de `capacity`
+linhas; a busca calcula a similaridade de cosseno com todas as linhas em
+blocos e aceita a melhor se passar de `threshold`. Em float16 a matriz
+ocupa metade, mas cada bloco é convertido para float32 antes do produto,
+o que torna a busca várias vezes mais lenta. Com a matriz cheia, a
+linha usada há mais tempo é substituída (LRU).
+
+Similaridade alta não garante o mesmo sentido: "deletar" e "não deletar",
+ou "10 metros" e "100 metros", ficam acima de 0.92. Por isso a melhor linha
+só é aceita se as palavras de negação e os números da pergunta forem os
+mesmos da pergunta guardada.
+
+Com `path`, a matriz fica num arquivo mapeado em memória (`<path>.vectors`)
+e as perguntas/respostas num log JSONL (`<path>.log`), relido ao iniciar.
+Cada gravação acrescenta uma linha ao log; quando ele passa de
+`LOG_COMPACT_FACTOR` vezes a capacidade, é reescrito só com as linhas vivas.
+Só um processo por vez usa os arquivos (bloqueio exclusivo em `<path>.lock`):
+cada processo escolhe as linhas da matriz por conta própria, então dois
+gravando juntos misturariam o vetor de um com a resposta do outro. Os demais
+(outros workers do gunicorn, `python -m app.jobs worker`) ficam com um cache
+só em memória e `locked_out` verdadeiro.
+
+Requer o pacote numpy (pip install numpy).
+"""
+import importlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from app.response_cache import normalize_prompt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+SEARCH_BLOCK = 65536   # linhas por bloco na busca (limita a memória temporária em float32)
+LOG_COMPACT_FACTOR = 2  # o log é compactado ao passar de capacity * LOG_COMPACT_FACTOR linhas
+
+WORD_RE = re.compile(r"\w+")
+NEGATIONS = frozenset({"não", "nao", "nem", "nunca", "jamais", "sem", "nenhum", "nenhuma",
+                       "not", "no", "never", "without", "nor", "dont", "doesnt", "isnt"})
+
+
+def guard_terms(text):
+    """Palavras de negação e números do texto: precisam coincidir para um acerto."""
+    words = WORD_RE.findall(normalize_prompt(text).replace("'", ""))
+    return frozenset(w for w in words if w in NEGATIONS or any(c.isdigit() for c in w))
+
+
+class HashingEmbedder:
+    """Vetores de n-gramas com hashing (feature hashing), normalizados.
+
+    Usa crc32 em vez de hash() para que os vetores não mudem entre processos
+    (o hash de strings do Python é aleatório a cada execução). A pontuação é
+    ignorada: "Como fazer um loop?" e "como fazer um loop" dão o mesmo vetor.
+    """
+
+    def __init__(self, dim=512, ngram=3):
+        self.dim = dim
+        self.ngram = ngram
+
+    def _features(self, text):
+        words = WORD_RE.findall(normalize_prompt(text))
+        text = " ".join(words)
+        features = Counter(words)
+        padded = f" {text} "
+        for i in range(len(padded) - self.ngram + 1):
+            features["#" + padded[i:i + self.ngram]] += 1
+        return features
+
+    def __call__(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                h = zlib.crc32(feature.encode())
+                matrix[row, h % self.dim] += count if h & 0x80000000 else -count
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+
+def lock_file(path):
+    """Abre `path` com bloqueio exclusivo; None se outro processo já o tem."""
+    handle = open(path, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+def load_embedder(name, dim):
+    """"hashing" ou o caminho "modulo:funcao" de uma função textos -> matriz (n, dim)."""
+    if name == "hashing":
+        return HashingEmbedder(dim)
+    module, _, attr = name.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+class SemanticCache:
+    """Matriz de vetores das perguntas com as respostas correspondentes.
+
+    As respostas são separadas por `namespace` (modelo + prompt de sistema +
+    histórico): uma pergunta só aproveita respostas do mesmo namespace.
+    """
+
+    def __init__(self, embedder, dim=512, capacity=100000, threshold=0.9, dtype="float32", ttl=86400, path=None):
+        if np is None:
+            raise RuntimeError("SEMANTIC_CACHE_ENABLED requer o pacote numpy (pip install numpy).")
+        self._embed = embedder
+        self.dim = dim
+        self.capacity = capacity
+        self.threshold = threshold
+        self._ttl = ttl
+        self._dtype = np.dtype(dtype)
+        self._lock = threading.RLock()
+        self._file_lock = lock_file(f"{path}.lock") if path else None
+        self.locked_out = bool(path) and self._file_lock is None
+        if self.locked_out:
+            print(f"Aviso: o cache semântico em {path} está em uso por outro processo; "
+                  "este processo usa um cache só em memória.")
+            path = None
+        self._path = path
+        if path:
+            vectors_path = f"{path}.vectors"
+            expected = capacity * dim * self._dtype.itemsize
+            mode = "r+" if os.path.exists(vectors_path) and os.path.getsize(vectors_path) == expected else "w+"
+            self._vectors = np.memmap(vectors_path, dtype=self._dtype, mode=mode, shape=(capacity, dim))
+        else:
+            self._vectors = np.zeros((capacity, dim), dtype=self._dtype)
+        self._namespace = np.full(capacity, -1, dtype=np.int32)   # -1 = linha livre
+        self._created = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._entries = [None] * capacity                         # (namespace, pergunta, resposta)
+        self._namespaces = {}
+        self._size = 0                                             # linhas já usadas alguma vez
+        self._free = []
+        self._stats = {"hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+        self._log = None
+        self._log_lines = 0
+        if path:
+            self._load_log()
+
+    def _namespace_id(self, namespace, create=False):
+        ns_id = self._namespaces.get(namespace)
+        if ns_id is None and create:
+            ns_id = self._namespaces[namespace] = len(self._namespaces)
+        return ns_id
+
+    # --- Persistência -----------------------------------------------------------
+
+    def _load_log(self):
+        """Relê o log (a última gravação de cada linha vale) e o reescreve compactado."""
+        log_path = f"{self._path}.log"
+        if os.path.exists(log_path):
+            slots = {}
+            with open(log_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # linha cortada por uma queda no meio da gravação
+                    if record.get("slot", -1) < self.capacity:
+                        slots[record["slot"]] = record
+            for slot, record in slots.items():
+                self._fill_slot(slot, self._namespace_id(record["ns"], create=True), record["created"],
+                                record["prompt"], record["response"])
+            self._size = max(slots) + 1 if slots else 0
+            self._free = [s for s in range(self._size) if self._namespace[s] == -1]
+        self._rewrite_log()
+
+    def _rewrite_log(self):
+        if not self._path:
+            return
+        names = {ns_id: name for name, ns_id in self._namespaces.items()}
+        tmp_path = f"{self._path}.log.tmp"
+        self._log_lines = 0
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for slot in range(self._size):
+                entry = self._entries[slot]
+                if entry is not None:
+                    self._log_lines += 1
+                    f.write(json.dumps({"slot": slot, "ns": names[entry[0]], "created": self._created[slot],
+                                        "prompt": entry[1], "response": entry[2]}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, f"{self._path}.log")
+        if self._log is not None:
+            self._log.close()
+        self._log = open(f"{self._path}.log", "a", encoding="utf-8")
+
+    def _append_log(self, record):
+        if self._log is not None:
+            self._log.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._log.flush()
+            self._log_lines += 1
+            if self._log_lines > self.capacity * LOG_COMPACT_FACTOR:
+                self._rewrite_log()
+
+    # --- Busca e gravação ---------------------------------------------------------
+
+    def _fill_slot(self, slot, ns_id, created, prompt, response):
+        self._namespace[slot] = ns_id
+        self._created[slot] = created
+        self._last_used[slot] = created
+        self._entries[slot] = (ns_id, prompt, response)
+
+    def _search(self, ns_id, queries):
+        """Melhor (linha, similaridade) para cada vetor de `queries`, só no namespace."""
+        count = len(queries)
+        best_rows = np.full(count, -1, dtype=np.int64)
+        best_scores = np.full(count, -np.inf, dtype=np.float32)
+        oldest = time.time() - self._ttl
+        for start in range(0, self._size, SEARCH_BLOCK):
+            end = min(start + SEARCH_BLOCK, self._size)
+            valid = (self._namespace[start:end] == ns_id) & (self._created[start:end] >= oldest)
+            if not valid.any():
+                continue
+            scores = np.asarray(self._vectors[start:end], dtype=np.float32) @ queries.T
+            scores[~valid] = -np.inf
+            rows = scores.argmax(axis=0)
+            values = scores[rows, np.arange(count)]
+            better = values > best_scores
+            best_rows[better] = rows[better] + start
+            best_scores[better] = values[better]
+        return best_rows, best_scores
+
+    def _accepts(self, row, score, prompt):
+        return row >= 0 and score >= self.threshold and guard_terms(prompt) == guard_terms(self._entries[row][1])
+
+    def lookup_many(self, namespace, prompts):
+        """Respostas em cache para várias perguntas de uma vez (None onde não houver)."""
+        queries = np.asarray(self._embed(prompts), dtype=np.float32)
+        with self._lock:
+            ns_id = self._namespace_id(namespace)
+            if ns_id is None:
+                self._stats["misses"] += len(prompts)
+                return [None] * len(prompts)
+            rows, scores = self._search(ns_id, queries)
+            results = []
+            now = time.time()
+            for prompt, row, score in zip(prompts, rows, scores):
+                if self._accepts(row, score, prompt):
+                    self._last_used[row] = now
+                    self._stats["hits"] += 1
+                    results.append(self._entries[row][2])
+                else:
+                    self._stats["misses"] += 1
+                    results.append(None)
+            return results
+
+    def lookup(self, namespace, prompt):
+        return self.lookup_many(namespace, [prompt])[0]
+
+    def put_many(self, namespace, prompts, responses, vectors=None):
+        """Guarda pares pergunta/resposta; `vectors` evita recalcular os vetores."""
+        if vectors is None:
+            vectors = self._embed(prompts)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            ns_id = self._namespace_id(namespace, create=True)
+            now = time.time()
+            for prompt, response, vector in zip(prompts, responses, vectors):
+                slot = self._take_slot()
+                self._vectors[slot] = vector
+                self._fill_slot(slot, ns_id, now, prompt, response)
+                self._stats["puts"] += 1
+                self._append_log({"slot": slot, "ns": namespace, "created": now, "prompt": prompt, "response": response})
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+
+    def put(self, namespace, prompt, response):
+        self.put_many(namespace, [prompt], [response])
+
+    def _take_slot(self):
+        if self._free:
+            return self._free.pop()
+        if self._size < self.capacity:
+            self._size += 1
+            return self._size - 1
+        slot = int(self._last_used[:self._size].argmin())
+        self._stats["evictions"] += 1
+        return slot
+
+    def purge(self, prefix=None):
+        """Apaga as respostas cujo namespace começa com `prefix` (ou todas)."""
+        with self._lock:
+            names = {ns_id: name for name, ns_id in self._namespaces.items()}
+            removed = 0
+            for slot in range(self._size):
+                entry = self._entries[slot]
+                if entry is not None and (prefix is None or names[entry[0]].startswith(prefix)):
+                    self._namespace[slot] = -1
+                    self._entries[slot] = None
+                    self._free.append(slot)
+                    removed += 1
+            self._rewrite_log()
+            return removed
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["entries"] = self._size - len(self._free)
+            data["capacity"] = self.capacity
+            data["threshold"] = self.threshold
+            data["locked_out"] = self.locked_out
+            data["dtype"] = self._dtype.name
+            data["matrix_bytes"] = int(self.capacity * self.dim * self._dtype.itemsize)
+            return data
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+            if self._file_lock is not None:
+                self._file_lock.close()
+                self._file_lock = None
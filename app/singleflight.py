@@ -0,0 +1,95 @@
+"""Single-flight: pedidos iguais em andamento compartilham uma só chamada.
+
+Enquanto a primeira chamada com uma chave (a "líder") não termina, as
+seguintes com a mesma chave não chamam `fn`: esperam o resultado da líder e
+o recebem também (ou a mesma exceção). Depois que a líder termina a chave é
+liberada; o reaproveitamento de respostas já prontas é papel do cache.
+
+Cada chamada em andamento é um `concurrent.futures.Future`, então serve a
+threads (`do`) e a corrotinas (`do_async`, que espera sem ocupar thread;
+`do_await`, quando a chamada também é uma corrotina) com a mesma tabela.
+Em `do_await` a chamada roda numa task à parte: se a corrotina líder for
+cancelada (ex.: o cliente desconectou), as seguintes ainda recebem o resultado.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}  # chave -> Future da chamada líder
+        self._lock = threading.Lock()
+        self._tasks = set()  # tasks de do_await em andamento (o loop só guarda referências fracas)
+        self._stats = {"calls": 0, "leaders": 0, "collapsed": 0, "errors": 0}
+
+    def _join(self, key):
+        """(future, é líder) para a chave."""
+        with self._lock:
+            self._stats["calls"] += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self._stats["collapsed"] += 1
+                return future, False
+            future = self._calls[key] = Future()
+            # Em andamento: quem desistir de esperar (ex.: corrotina cancelada) não cancela os demais
+            future.set_running_or_notify_cancel()
+            self._stats["leaders"] += 1
+            return future, True
+
+    def _run(self, key, future, fn):
+        try:
+            result = fn()
+        except BaseException as e:
+            error = e
+        else:
+            error = None
+        self._finish(key, future, result if error is None else None, error)
+
+    def _finish(self, key, future, result, error):
+        with self._lock:
+            del self._calls[key]
+            if error is not None:
+                self._stats["errors"] += 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn):
+        """Chama `fn()` ou espera a chamada igual em andamento; devolve (resultado, compartilhado)."""
+        future, leader = self._join(key)
+        if leader:
+            self._run(key, future, fn)
+        return future.result(), not leader
+
+    async def do_async(self, key, fn):
+        """Como `do`, para corrotinas; `fn` (bloqueante) roda numa thread do executor padrão."""
+        future, leader = self._join(key)
+        if leader:
+            asyncio.get_running_loop().run_in_executor(None, self._run, key, future, fn)
+        return await asyncio.wrap_future(future), not leader
+
+    async def _run_await(self, key, future, fn):
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._finish(key, future, None, e)
+        else:
+            self._finish(key, future, result, None)
+
+    async def do_await(self, key, fn):
+        """Como `do_async`, mas `fn()` devolve um awaitable, esperado no próprio loop (sem thread)."""
+        future, leader = self._join(key)
+        if leader:
+            task = asyncio.ensure_future(self._run_await(key, future, fn))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await asyncio.wrap_future(future), not leader
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data["in_flight"] = len(self._calls)
+            return data
@@ -0,0 +1,707 @@
+"""Backends de armazenamento das conversas.
+
+As funções de app.models não falam SQL diretamente: elas chamam um objeto
+de armazenamento com a interface abaixo, escolhido por STORAGE_BACKEND em
+config.py.
+
+    insert_conversations(rows, summaries, search_bodies) -> ids das linhas gravadas, na ordem de `rows`
+    query_conversations(user_id, chat_id) -> chat inteiro, do mais novo ao mais antigo
+    query_page(user_id, chat_id, before, limit) -> até `limit` linhas com id < before
+    delete_chat(user_id, chat_id)
+    list_chats(user_id, before, limit) -> até `limit` chats, do mais recente ao mais antigo
+    search(user_id, query, before, limit) -> até `limit` conversas, da mais relevante à menos
+    chat_version(user_id, chat_id) -> versão do chat (None se ele não existe)
+    chats_version(user_id) -> (número de chats, maior versão) do usuário
+    touch_chat(user_id, chat_id, version)
+    stats() -> dicionário para /metrics
+
+`rows` são listas [user_id, chat_id, user_message, gpt_response, timestamp,
+date_group, model, codec, user_message_blob, gpt_response_blob, user_tokens,
+response_tokens, response_format, response_html, render_version] e `summaries`
+são as linhas correspondentes da tabela `chats`; `search_bodies` é o texto
+indexado para busca de cada linha (ver app.search). A versão de um chat
+(coluna `version`, em microssegundos) sobe a cada gravação: fica maior que a
+anterior e pelo menos igual ao `version` recebido em `summaries` ou em
+touch_chat. As consultas devolvem o texto
+como está gravado (comprimido ou não, ver app.compression); quem decodifica é
+app.models. Os erros de banco de cada backend estão em `errors`, e os que não
+adianta repetir em `permanent_errors`.
+
+Para as ferramentas de app.compression e app.search há ainda
+uncompressed_rows, body_rows, update_bodies, sample_bodies, sample_chats,
+load_dictionaries, save_dictionary, clear_search_index e index_bodies; para o
+contexto enviado aos modelos (app.context), update_tokens, query_range,
+chat_summary e save_chat_summary; para o HTML pré-renderizado das respostas
+(app.formatting), render_rows e update_rendered.
+"""
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+import mysql.connector
+from app.pool import PoolTimeout
+from app.search import fts5_query
+
+
+class MySQLStorage:
+    """Armazenamento no MySQL, usando o pool de conexões de app."""
+
+    errors = (mysql.connector.Error, PoolTimeout)
+    # Erros que uma nova tentativa não resolve (dado inválido, restrição violada, SQL errado)
+    permanent_errors = (mysql.connector.DataError, mysql.connector.IntegrityError, mysql.connector.ProgrammingError,
+                        mysql.connector.NotSupportedError)
+
+    INSERT_CONVERSATION_SQL = "INSERT INTO conversations (user_id, chat_id, user_message, gpt_response, timestamp, date_group, model, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+    UPSERT_CHAT_SQL = """
+        INSERT INTO chats (user_id, chat_id, title, created_at, last_message_at, message_count, model, version)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            last_message_at = GREATEST(last_message_at, VALUES(last_message_at)),
+            message_count = message_count + VALUES(message_count),
+            model = VALUES(model),
+            version = GREATEST(version + 1, VALUES(version))
+    """
+
+    SELECT_RANGE_SQL = "SELECT id, user_message, gpt_response, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format FROM conversations WHERE user_id = %s AND chat_id = %s AND id > %s AND id < %s ORDER BY id LIMIT %s"
+    SELECT_RENDER_SQL = "SELECT id, user_id, chat_id, gpt_response, codec, gpt_response_blob FROM conversations WHERE id > %s AND response_format = 'markdown' AND (render_version IS NULL OR render_version < %s) ORDER BY id LIMIT %s"
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    INSERT_SEARCH_SQL = "INSERT INTO conversations_search (id, user_id, chat_id, body) VALUES (%s, %s, %s, %s)"
+
+    def insert_conversations(self, rows, summaries, search_bodies):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            # Um INSERT por linha, na mesma transação: os ids de um INSERT de várias
+            # linhas só são consecutivos com auto_increment_increment = 1 (não no
+            # Galera ou na replicação em grupo)
+            ids = []
+            for row in rows:
+                mycursor.execute(self.INSERT_CONVERSATION_SQL, row)
+                ids.append(mycursor.lastrowid)
+            mycursor.executemany(self.UPSERT_CHAT_SQL, summaries)
+            mycursor.executemany(self.INSERT_SEARCH_SQL, [
+                (conversation_id, row[0], row[1], body) for conversation_id, row, body in zip(ids, rows, search_bodies)
+            ])
+            mydb.commit()
+        return ids
+
+    def query_conversations(self, user_id, chat_id):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute("SELECT id, user_message, gpt_response, DATE(timestamp) as date_group, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version FROM conversations WHERE user_id = %s AND chat_id = %s ORDER BY timestamp DESC, id DESC", (user_id, chat_id))
+            return mycursor.fetchall()
+
+    def query_page(self, user_id, chat_id, before, limit):
+        sql = "SELECT id, user_message, gpt_response, DATE(timestamp) as date_group, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version FROM conversations WHERE user_id = %s AND chat_id = %s"
+        params = [user_id, chat_id]
+        if before is not None:
+            sql += " AND id < %s"
+            params.append(before)
+        sql += " ORDER BY id DESC LIMIT %s"
+        params.append(limit)
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute(sql, params)
+            return mycursor.fetchall()
+
+    def delete_chat(self, user_id, chat_id):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("DELETE FROM conversations WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
+            mycursor.execute("DELETE FROM chats WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
+            mycursor.execute("DELETE FROM conversations_search WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
+            mydb.commit()
+
+    def list_chats(self, user_id, before, limit):
+        sql = "SELECT chat_id, title, created_at, last_message_at, message_count, model, DATE(last_message_at) as date_group FROM chats WHERE user_id = %s"
+        params = [user_id]
+        if before is not None:
+            last_message_at, chat_id = before
+            sql += " AND (last_message_at < %s OR (last_message_at = %s AND chat_id < %s))"
+            params += [last_message_at, last_message_at, chat_id]
+        sql += " ORDER BY last_message_at DESC, chat_id DESC LIMIT %s"
+        params.append(limit)
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute(sql, params)
+            return mycursor.fetchall()
+
+    def uncompressed_rows(self, after_id, limit):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute("SELECT id, user_message, gpt_response FROM conversations WHERE id > %s AND codec IS NULL ORDER BY id LIMIT %s", (after_id, limit))
+            return mycursor.fetchall()
+
+    def body_rows(self, after_id, limit):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute("SELECT id, user_id, chat_id, user_message, gpt_response, codec, user_message_blob, gpt_response_blob, response_format FROM conversations WHERE id > %s ORDER BY id LIMIT %s", (after_id, limit))
+            return mycursor.fetchall()
+
+    def update_bodies(self, updates):
+        """Regrava o texto de várias linhas: [(codec, texto, texto, blob, blob, id)]."""
+        if not updates:
+            return
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.executemany("UPDATE conversations SET codec = %s, user_message = %s, gpt_response = %s, user_message_blob = %s, gpt_response_blob = %s WHERE id = %s", updates)
+            mydb.commit()
+
+    def sample_bodies(self, limit):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT gpt_response, response_format FROM conversations WHERE gpt_response IS NOT NULL ORDER BY id DESC LIMIT %s", (limit,))
+            return [(row[0], row[1]) for row in mycursor.fetchall()]
+
+    def sample_chats(self, limit):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT user_id, chat_id FROM chats ORDER BY last_message_at DESC LIMIT %s", (limit,))
+            return mycursor.fetchall()
+
+    def load_dictionaries(self):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT id, codec, data FROM compression_dicts")
+            return {row[0]: (row[1], bytes(row[2])) for row in mycursor.fetchall()}
+
+    def save_dictionary(self, codec, data):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("INSERT INTO compression_dicts (codec, data) VALUES (%s, %s)", (codec, data))
+            mydb.commit()
+            return mycursor.lastrowid
+
+    def search(self, user_id, query, before, limit):
+        # A relevância vem do índice FULLTEXT; o cursor é (relevância, id) da última linha
+        sql = """
+            SELECT s.id, MATCH(s.body) AGAINST (%s IN NATURAL LANGUAGE MODE) AS score,
+                   c.chat_id, c.timestamp, c.user_message, c.gpt_response, c.codec, c.user_message_blob, c.gpt_response_blob, c.response_format
+            FROM conversations_search s JOIN conversations c ON c.id = s.id
+            WHERE s.user_id = %s AND MATCH(s.body) AGAINST (%s IN NATURAL LANGUAGE MODE)
+        """
+        params = [query, user_id, query]
+        if before is not None:
+            score, last_id = before
+            sql += " HAVING score < %s OR (score = %s AND s.id < %s)"
+            params += [score, score, last_id]
+        sql += " ORDER BY score DESC, s.id DESC LIMIT %s"
+        params.append(limit)
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute(sql, params)
+            return mycursor.fetchall()
+
+    def clear_search_index(self):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("DELETE FROM conversations_search")
+            mydb.commit()
+
+    def index_bodies(self, entries):
+        """Indexa conversas já gravadas: [(id, user_id, chat_id, texto)]."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.executemany("REPLACE INTO conversations_search (id, user_id, chat_id, body) VALUES (%s, %s, %s, %s)", entries)
+            mydb.commit()
+
+    def update_tokens(self, updates):
+        """Regrava a contagem de tokens: [(user_tokens, response_tokens, id)]."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.executemany("UPDATE conversations SET user_tokens = %s, response_tokens = %s WHERE id = %s", updates)
+            mydb.commit()
+
+    def query_range(self, user_id, chat_id, after_id, before_id, limit):
+        """Até `limit` conversas com after_id < id < before_id, da mais antiga para a mais nova."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute(self.SELECT_RANGE_SQL, (user_id, chat_id, after_id or 0, before_id, limit))
+            return mycursor.fetchall()
+
+    def chat_summary(self, user_id, chat_id):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute("SELECT summary, summary_through, summary_tokens FROM chats WHERE user_id = %s AND chat_id = %s AND summary IS NOT NULL", (user_id, chat_id))
+            return mycursor.fetchone()
+
+    def save_chat_summary(self, user_id, chat_id, summary, through_id, tokens):
+        """Grava o resumo, a menos que já exista um que cubra mais conversas."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("UPDATE chats SET summary = %s, summary_through = %s, summary_tokens = %s WHERE user_id = %s AND chat_id = %s AND (summary_through IS NULL OR summary_through < %s)",
+                             (summary, through_id, tokens, user_id, chat_id, through_id))
+            mydb.commit()
+
+    def chat_version(self, user_id, chat_id):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT version FROM chats WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
+            row = mycursor.fetchone()
+            return row[0] if row else None
+
+    def chats_version(self, user_id):
+        """Lê só o índice (user_id, version)."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT COUNT(*), COALESCE(MAX(version), 0) FROM chats WHERE user_id = %s", (user_id,))
+            count, version = mycursor.fetchone()
+            return count, version
+
+    def touch_chat(self, user_id, chat_id, version):
+        """Avança a versão do chat depois de regravar uma conversa já existente."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("UPDATE chats SET version = GREATEST(version + 1, %s) WHERE user_id = %s AND chat_id = %s",
+                             (version, user_id, chat_id))
+            mydb.commit()
+
+    def render_rows(self, after_id, limit, version):
+        """Conversas em Markdown com id > after_id sem HTML ou com HTML de versão anterior a `version`."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor(dictionary=True)
+            mycursor.execute(self.SELECT_RENDER_SQL, (after_id, version, limit))
+            return mycursor.fetchall()
+
+    def update_rendered(self, updates):
+        """Grava o HTML pré-renderizado: [(response_html, render_version, id)]."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.executemany("UPDATE conversations SET response_html = %s, render_version = %s WHERE id = %s", updates)
+            mydb.commit()
+
+    def cached_response(self, key, min_created):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT response FROM response_cache WHERE cache_key = %s AND created_at >= %s", (key, min_created))
+            row = mycursor.fetchone()
+            return row[0] if row else None
+
+    def store_response(self, key, model, response, created):
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("REPLACE INTO response_cache (cache_key, model, response, created_at) VALUES (%s, %s, %s, %s)",
+                             (key, model, response, created))
+            mydb.commit()
+
+    def purge_responses(self, model=None):
+        """Apaga as respostas em cache (todas ou de um modelo); devolve quantas."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            if model is None:
+                mycursor.execute("DELETE FROM response_cache")
+            else:
+                mycursor.execute("DELETE FROM response_cache WHERE model = %s", (model,))
+            mydb.commit()
+            return mycursor.rowcount
+
+    def trim_responses(self, min_created, max_entries):
+        """Apaga as respostas expiradas e as mais antigas além de `max_entries`."""
+        with self._pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute("DELETE FROM response_cache WHERE created_at < %s", (min_created,))
+            mycursor.execute("SELECT created_at FROM response_cache ORDER BY created_at DESC LIMIT 1 OFFSET %s", (max_entries,))
+            row = mycursor.fetchone()
+            if row:
+                mycursor.execute("DELETE FROM response_cache WHERE created_at <= %s", (row[0],))
+            mydb.commit()
+
+    def stats(self):
+        return {"backend": "mysql", "pool": self._pool.stats()}
+
+
+class SQLiteStorage:
+    """Armazenamento num arquivo SQLite local, em modo WAL.
+
+    Pensado para instalações de um só nó: dispensa o servidor MySQL. Cada
+    thread tem a sua conexão (o sqlite3 não compartilha conexões entre
+    threads); com WAL, leitores não bloqueiam o escritor. As consultas usam
+    sempre o mesmo texto SQL, e o cache de statements do sqlite3 as mantém
+    preparadas entre chamadas. O esquema e os índices espelham as migrações
+    do MySQL.
+    """
+
+    errors = (sqlite3.Error,)
+    permanent_errors = (sqlite3.DataError, sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.InterfaceError,
+                        sqlite3.NotSupportedError)
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            chat_id TEXT,
+            user_message TEXT,
+            gpt_response TEXT,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            date_group TEXT,
+            model TEXT,
+            codec TEXT,
+            user_message_blob BLOB,
+            gpt_response_blob BLOB,
+            user_tokens INTEGER,
+            response_tokens INTEGER,
+            response_format TEXT,
+            response_html TEXT,
+            render_version INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_chat_ts ON conversations (user_id, chat_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_date ON conversations (user_id, date_group)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_chat_id ON conversations (user_id, chat_id, id)",
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            title TEXT,
+            created_at TEXT,
+            last_message_at TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            model TEXT,
+            summary TEXT,
+            summary_through INTEGER,
+            summary_tokens INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, chat_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chats_user_last ON chats (user_id, last_message_at, chat_id)",
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            body, user_id, chat_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_model ON response_cache (model)",
+    ]
+
+    # Colunas acrescentadas depois da primeira versão do esquema: (tabela, coluna, tipo)
+    ADDED_COLUMNS = [
+        ("conversations", "codec", "TEXT"),
+        ("conversations", "user_message_blob", "BLOB"),
+        ("conversations", "gpt_response_blob", "BLOB"),
+        ("conversations", "user_tokens", "INTEGER"),
+        ("conversations", "response_tokens", "INTEGER"),
+        ("conversations", "response_format", "TEXT"),
+        ("conversations", "response_html", "TEXT"),
+        ("conversations", "render_version", "INTEGER"),
+        ("chats", "summary", "TEXT"),
+        ("chats", "summary_through", "INTEGER"),
+        ("chats", "summary_tokens", "INTEGER"),
+        ("chats", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+
+    # Índices sobre colunas de ADDED_COLUMNS, criados depois delas
+    ADDED_INDEXES = [
+        "CREATE INDEX IF NOT EXISTS idx_chats_user_version ON chats (user_id, version)",
+    ]
+
+    INSERT_CONVERSATION_SQL = "INSERT INTO conversations (user_id, chat_id, user_message, gpt_response, timestamp, date_group, model, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    UPSERT_CHAT_SQL = """
+        INSERT INTO chats (user_id, chat_id, title, created_at, last_message_at, message_count, model, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, chat_id) DO UPDATE SET
+            last_message_at = MAX(last_message_at, excluded.last_message_at),
+            message_count = message_count + excluded.message_count,
+            model = excluded.model,
+            version = MAX(version + 1, excluded.version)
+    """
+
+    SELECT_CONVERSATIONS_SQL = "SELECT id, user_message, gpt_response, DATE(timestamp) as date_group, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version FROM conversations WHERE user_id = ? AND chat_id = ? ORDER BY timestamp DESC, id DESC"
+    SELECT_PAGE_SQL = "SELECT id, user_message, gpt_response, DATE(timestamp) as date_group, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version FROM conversations WHERE user_id = ? AND chat_id = ? ORDER BY id DESC LIMIT ?"
+    SELECT_PAGE_BEFORE_SQL = "SELECT id, user_message, gpt_response, DATE(timestamp) as date_group, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format, response_html, render_version FROM conversations WHERE user_id = ? AND chat_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+    SELECT_RANGE_SQL = "SELECT id, user_message, gpt_response, chat_id, codec, user_message_blob, gpt_response_blob, user_tokens, response_tokens, response_format FROM conversations WHERE user_id = ? AND chat_id = ? AND id > ? AND id < ? ORDER BY id LIMIT ?"
+    SELECT_RENDER_SQL = "SELECT id, user_id, chat_id, gpt_response, codec, gpt_response_blob FROM conversations WHERE id > ? AND response_format = 'markdown' AND (render_version IS NULL OR render_version < ?) ORDER BY id LIMIT ?"
+    SELECT_CHATS_SQL = "SELECT chat_id, title, created_at, last_message_at, message_count, model, DATE(last_message_at) as date_group FROM chats WHERE user_id = ? ORDER BY last_message_at DESC, chat_id DESC LIMIT ?"
+    SELECT_CHATS_BEFORE_SQL = "SELECT chat_id, title, created_at, last_message_at, message_count, model, DATE(last_message_at) as date_group FROM chats WHERE user_id = ? AND (last_message_at < ? OR (last_message_at = ? AND chat_id < ?)) ORDER BY last_message_at DESC, chat_id DESC LIMIT ?"
+
+    def __init__(self, path, synchronous="NORMAL", mmap_size=256 * 1024 * 1024, cache_size=-64 * 1024,
+                 busy_timeout=5000):
+        self._path = path
+        self._pragmas = [
+            "PRAGMA journal_mode = WAL",
+            f"PRAGMA synchronous = {synchronous}",
+            f"PRAGMA mmap_size = {int(mmap_size)}",
+            f"PRAGMA cache_size = {int(cache_size)}",
+            f"PRAGMA busy_timeout = {int(busy_timeout)}",
+            "PRAGMA temp_store = MEMORY",
+        ]
+        self._local = threading.local()
+        self._connections = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        with conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            for table, column, kind in self.ADDED_COLUMNS:
+                columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+            for statement in self.ADDED_INDEXES:
+                conn.execute(statement)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            for pragma in self._pragmas:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._connections += 1
+        return conn
+
+    @staticmethod
+    def _conversation(row):
+        conversation = dict(row)
+        if conversation.get("date_group"):
+            conversation["date_group"] = date.fromisoformat(conversation["date_group"])
+        return conversation
+
+    @staticmethod
+    def _chat(row):
+        chat = dict(row)
+        for field in ("created_at", "last_message_at"):
+            if chat.get(field):
+                chat[field] = datetime.fromisoformat(chat[field])
+        if chat.get("date_group"):
+            chat["date_group"] = date.fromisoformat(chat["date_group"])
+        return chat
+
+    INSERT_SEARCH_SQL = "INSERT INTO conversations_fts (rowid, user_id, chat_id, body) VALUES (?, ?, ?, ?)"
+
+    SEARCH_SQL = """
+        SELECT f.rowid AS id, -bm25(conversations_fts, 1.0, 0.0) AS score,
+               c.chat_id, c.timestamp, c.user_message, c.gpt_response, c.codec, c.user_message_blob, c.gpt_response_blob, c.response_format
+        FROM conversations_fts f JOIN conversations c ON c.id = f.rowid
+        WHERE conversations_fts MATCH ? AND f.user_id = ?
+        ORDER BY score DESC, id DESC LIMIT ?
+    """
+    SEARCH_BEFORE_SQL = """
+        SELECT f.rowid AS id, -bm25(conversations_fts, 1.0, 0.0) AS score,
+               c.chat_id, c.timestamp, c.user_message, c.gpt_response, c.codec, c.user_message_blob, c.gpt_response_blob, c.response_format
+        FROM conversations_fts f JOIN conversations c ON c.id = f.rowid
+        WHERE conversations_fts MATCH ? AND f.user_id = ?
+          AND (-bm25(conversations_fts, 1.0, 0.0) < ? OR (-bm25(conversations_fts, 1.0, 0.0) = ? AND f.rowid < ?))
+        ORDER BY score DESC, id DESC LIMIT ?
+    """
+
+    def insert_conversations(self, rows, summaries, search_bodies):
+        conn = self._connection()
+        with conn:
+            # Dentro de uma transação o SQLite tem um único escritor: os ids são consecutivos
+            first_id = conn.execute(self.INSERT_CONVERSATION_SQL, rows[0]).lastrowid
+            conn.executemany(self.INSERT_CONVERSATION_SQL, rows[1:])
+            ids = list(range(first_id, first_id + len(rows)))
+            conn.executemany(self.UPSERT_CHAT_SQL, summaries)
+            conn.executemany(self.INSERT_SEARCH_SQL, [
+                (conversation_id, row[0], row[1], body) for conversation_id, row, body in zip(ids, rows, search_bodies)
+            ])
+        return ids
+
+    def query_conversations(self, user_id, chat_id):
+        rows = self._connection().execute(self.SELECT_CONVERSATIONS_SQL, (user_id, chat_id)).fetchall()
+        return [self._conversation(row) for row in rows]
+
+    def query_page(self, user_id, chat_id, before, limit):
+        if before is None:
+            rows = self._connection().execute(self.SELECT_PAGE_SQL, (user_id, chat_id, limit)).fetchall()
+        else:
+            rows = self._connection().execute(self.SELECT_PAGE_BEFORE_SQL, (user_id, chat_id, before, limit)).fetchall()
+        return [self._conversation(row) for row in rows]
+
+    def delete_chat(self, user_id, chat_id):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM conversations_fts WHERE rowid IN (SELECT id FROM conversations WHERE user_id = ? AND chat_id = ?)", (user_id, chat_id))
+            conn.execute("DELETE FROM conversations WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            conn.execute("DELETE FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def list_chats(self, user_id, before, limit):
+        if before is None:
+            rows = self._connection().execute(self.SELECT_CHATS_SQL, (user_id, limit)).fetchall()
+        else:
+            last_message_at, chat_id = before
+            rows = self._connection().execute(
+                self.SELECT_CHATS_BEFORE_SQL, (user_id, last_message_at, last_message_at, chat_id, limit)
+            ).fetchall()
+        return [self._chat(row) for row in rows]
+
+    def uncompressed_rows(self, after_id, limit):
+        rows = self._connection().execute("SELECT id, user_message, gpt_response FROM conversations WHERE id > ? AND codec IS NULL ORDER BY id LIMIT ?", (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def body_rows(self, after_id, limit):
+        rows = self._connection().execute("SELECT id, user_id, chat_id, user_message, gpt_response, codec, user_message_blob, gpt_response_blob, response_format FROM conversations WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def update_bodies(self, updates):
+        """Regrava o texto de várias linhas: [(codec, texto, texto, blob, blob, id)]."""
+        conn = self._connection()
+        with conn:
+            conn.executemany("UPDATE conversations SET codec = ?, user_message = ?, gpt_response = ?, user_message_blob = ?, gpt_response_blob = ? WHERE id = ?", updates)
+
+    def sample_bodies(self, limit):
+        rows = self._connection().execute("SELECT gpt_response, response_format FROM conversations WHERE gpt_response IS NOT NULL ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def sample_chats(self, limit):
+        rows = self._connection().execute("SELECT user_id, chat_id FROM chats ORDER BY last_message_at DESC LIMIT ?", (limit,)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def load_dictionaries(self):
+        rows = self._connection().execute("SELECT id, codec, data FROM compression_dicts").fetchall()
+        return {row["id"]: (row["codec"], bytes(row["data"])) for row in rows}
+
+    def save_dictionary(self, codec, data):
+        conn = self._connection()
+        with conn:
+            return conn.execute("INSERT INTO compression_dicts (codec, data) VALUES (?, ?)", (codec, data)).lastrowid
+
+    def search(self, user_id, query, before, limit):
+        # bm25 é menor para os mais relevantes; as palavras viram termos FTS5 entre aspas.
+        # O filtro pelo user_id entra na expressão FTS5 para cruzar as listas do
+        # índice antes de calcular o bm25, e é conferido de novo no WHERE.
+        terms = fts5_query(query)
+        if not terms:
+            return []
+        user_phrase = '"' + str(user_id).replace('"', '""') + '"'
+        query = f"user_id : {user_phrase} AND body : ({terms})"
+        if before is None:
+            rows = self._connection().execute(self.SEARCH_SQL, (query, user_id, limit)).fetchall()
+        else:
+            score, last_id = before
+            rows = self._connection().execute(self.SEARCH_BEFORE_SQL, (query, user_id, score, score, last_id, limit)).fetchall()
+        results = []
+        for row in rows:
+            result = dict(row)
+            result["timestamp"] = datetime.fromisoformat(result["timestamp"])
+            results.append(result)
+        return results
+
+    def clear_search_index(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM conversations_fts")
+
+    def index_bodies(self, entries):
+        """Indexa conversas já gravadas: [(id, user_id, chat_id, texto)]."""
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM conversations_fts WHERE rowid = ?", [(entry[0],) for entry in entries])
+            conn.executemany(self.INSERT_SEARCH_SQL, entries)
+
+    def update_tokens(self, updates):
+        """Regrava a contagem de tokens: [(user_tokens, response_tokens, id)]."""
+        conn = self._connection()
+        with conn:
+            conn.executemany("UPDATE conversations SET user_tokens = ?, response_tokens = ? WHERE id = ?", updates)
+
+    def query_range(self, user_id, chat_id, after_id, before_id, limit):
+        """Até `limit` conversas com after_id < id < before_id, da mais antiga para a mais nova."""
+        rows = self._connection().execute(self.SELECT_RANGE_SQL, (user_id, chat_id, after_id or 0, before_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def chat_summary(self, user_id, chat_id):
+        row = self._connection().execute("SELECT summary, summary_through, summary_tokens FROM chats WHERE user_id = ? AND chat_id = ? AND summary IS NOT NULL", (user_id, chat_id)).fetchone()
+        return dict(row) if row else None
+
+    def save_chat_summary(self, user_id, chat_id, summary, through_id, tokens):
+        """Grava o resumo, a menos que já exista um que cubra mais conversas."""
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE chats SET summary = ?, summary_through = ?, summary_tokens = ? WHERE user_id = ? AND chat_id = ? AND (summary_through IS NULL OR summary_through < ?)",
+                         (summary, through_id, tokens, user_id, chat_id, through_id))
+
+    def chat_version(self, user_id, chat_id):
+        row = self._connection().execute("SELECT version FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)).fetchone()
+        return row[0] if row else None
+
+    def chats_version(self, user_id):
+        """Lê só o índice (user_id, version)."""
+        count, version = self._connection().execute("SELECT COUNT(*), COALESCE(MAX(version), 0) FROM chats WHERE user_id = ?", (user_id,)).fetchone()
+        return count, version
+
+    def touch_chat(self, user_id, chat_id, version):
+        """Avança a versão do chat depois de regravar uma conversa já existente."""
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE chats SET version = MAX(version + 1, ?) WHERE user_id = ? AND chat_id = ?",
+                         (version, user_id, chat_id))
+
+    def render_rows(self, after_id, limit, version):
+        """Conversas em Markdown com id > after_id sem HTML ou com HTML de versão anterior a `version`."""
+        rows = self._connection().execute(self.SELECT_RENDER_SQL, (after_id, version, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def update_rendered(self, updates):
+        """Grava o HTML pré-renderizado: [(response_html, render_version, id)]."""
+        conn = self._connection()
+        with conn:
+            conn.executemany("UPDATE conversations SET response_html = ?, render_version = ? WHERE id = ?", updates)
+
+    def cached_response(self, key, min_created):
+        row = self._connection().execute("SELECT response FROM response_cache WHERE cache_key = ? AND created_at >= ?",
+                                         (key, min_created)).fetchone()
+        return row[0] if row else None
+
+    def store_response(self, key, model, response, created):
+        conn = self._connection()
+        with conn:
+            conn.execute("REPLACE INTO response_cache (cache_key, model, response, created_at) VALUES (?, ?, ?, ?)",
+                         (key, model, response, created))
+
+    def purge_responses(self, model=None):
+        """Apaga as respostas em cache (todas ou de um modelo); devolve quantas."""
+        conn = self._connection()
+        with conn:
+            if model is None:
+                return conn.execute("DELETE FROM response_cache").rowcount
+            return conn.execute("DELETE FROM response_cache WHERE model = ?", (model,)).rowcount
+
+    def trim_responses(self, min_created, max_entries):
+        """Apaga as respostas expiradas e as mais antigas além de `max_entries`."""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM response_cache WHERE created_at < ?", (min_created,))
+            row = conn.execute("SELECT created_at FROM response_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?",
+                               (max_entries,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (row[0],))
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "sqlite", "path": self._path, "connections": self._connections}
+
+
+def create_storage(backend, pool=None, sqlite_path=None, **sqlite_options):
+    """Cria o backend configurado em STORAGE_BACKEND ("mysql" ou "sqlite")."""
+    if backend == "sqlite":
+        return SQLiteStorage(sqlite_path, **sqlite_options)
+    if backend == "mysql":
+        return MySQLStorage(pool)
+    raise ValueError(f"STORAGE_BACKEND desconhecido: {backend}")
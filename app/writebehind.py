@@ -0,0 +1,278 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """Fila de gravação assíncrona com gravação em lote.
+
+    `enqueue` registra a linha num arquivo de spool (com fsync) e a coloca numa
+    fila limitada; uma thread de fundo junta as linhas e chama `writer(linhas)`
+    quando o lote atinge `batch_size` ou após `flush_interval` segundos.
+    Se a fila estiver cheia, `enqueue` espera até `put_timeout` segundos e
+    devolve False, para que o chamador grave de forma síncrona (backpressure).
+
+    As linhas ainda não gravadas ficam visíveis por `pending(chave)`, e as que
+    estavam no spool quando o processo caiu são regravadas pela thread de
+    fundo depois de `start`, antes das novas; o spool só perde uma linha
+    quando ela é confirmada. A entrega é "pelo menos uma vez": uma queda
+    entre o commit e o registro no spool pode repetir o último lote.
+
+    Um lote que falha com erro transitório (`is_transient(erro)`, por
+    exemplo o banco fora do ar) é repetido com backoff até `max_retries`
+    vezes. Com erro permanente, ou esgotadas as tentativas, as linhas são
+    gravadas uma a uma; as que ainda falharem vão para o arquivo
+    `dead_letter_path` (uma linha JSON com a linha e o erro) e são
+    confirmadas, para não travar a fila.
+    """
+
+    def __init__(self, writer, key, spool_path=None, maxsize=1000, batch_size=100,
+                 flush_interval=0.5, put_timeout=2.0, is_transient=None, max_retries=6,
+                 dead_letter_path=None):
+        self._writer = writer
+        self._key = key
+        self._is_transient = is_transient or (lambda err: True)
+        self._max_retries = max_retries
+        self._dead_letter_path = dead_letter_path
+        self._spool_path = spool_path
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._put_timeout = put_timeout
+        self._pending = {}  # chave -> [(seq, linha)]
+        self._unacked = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._spool = None
+        self._recovered = []
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"enqueued": 0, "flushed": 0, "batches": 0, "rejected": 0, "errors": 0, "recovered": 0,
+                      "dead": 0}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        recovered = self._recover()
+        if self._spool_path:
+            self._spool = open(self._spool_path, "a", encoding="utf-8")
+        with self._lock:
+            # As linhas recuperadas continuam no spool com o mesmo seq até serem confirmadas
+            for seq, row in recovered:
+                self._pending.setdefault(self._key(row), []).append((seq, row))
+            self._unacked += len(recovered)
+            self._seq = max([self._seq] + [seq for seq, _ in recovered])
+        self._recovered = recovered
+        self.stats["recovered"] = len(recovered)
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _recover(self):
+        """Lê o spool e devolve [(seq, linha)] das linhas que nunca foram confirmadas.
+
+        O spool é reescrito só com essas linhas (num arquivo temporário
+        trocado de uma vez pelo original): uma queda durante a regravação não
+        perde nada.
+        """
+        if not self._spool_path or not os.path.exists(self._spool_path):
+            return []
+        entries = {}
+        with open(self._spool_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # linha truncada por uma queda no meio da escrita
+                if "ack" in record:
+                    for seq in record["ack"]:
+                        entries.pop(seq, None)
+                else:
+                    entries[record["seq"]] = record["row"]
+        recovered = [(seq, entries[seq]) for seq in sorted(entries)]
+        compacted = self._spool_path + ".tmp"
+        with open(compacted, "w", encoding="utf-8") as f:
+            for seq, row in recovered:
+                f.write(json.dumps({"seq": seq, "row": row}, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted, self._spool_path)
+        return recovered
+
+    def _append_spool(self, record):
+        if self._spool is None:
+            return
+        self._spool.write(json.dumps(record, default=str) + "\n")
+        self._spool.flush()
+        os.fsync(self._spool.fileno())
+
+    def _enqueue(self, row, timeout):
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._append_spool({"seq": seq, "row": row})
+            self._pending.setdefault(self._key(row), []).append((seq, row))
+            self._unacked += 1
+        try:
+            self._queue.put((seq, row), timeout=timeout)
+        except queue.Full:
+            self._forget([(seq, row)])
+            return False
+        return True
+
+    def _forget(self, batch):
+        """Confirma as linhas no spool e as remove da visão de pendentes."""
+        seqs = {seq for seq, _ in batch}
+        with self._lock:
+            self._append_spool({"ack": sorted(seqs)})
+            for seq, row in batch:
+                key = self._key(row)
+                rows = self._pending.get(key)
+                if rows:
+                    rows[:] = [item for item in rows if item[0] not in seqs]
+                    if not rows:
+                        del self._pending[key]
+            self._unacked -= len(batch)
+            if self._unacked == 0 and self._spool is not None:
+                # Tudo confirmado: o spool pode ser zerado
+                self._spool.truncate(0)
+                self._spool.seek(0)
+            self._flushed.notify_all()
+
+    def enqueue(self, row):
+        """Agenda a gravação da linha; retorna False se a fila continuar cheia."""
+        if self._thread is None:
+            self.start()
+        if self._stop.is_set() or not self._enqueue(row, timeout=self._put_timeout):
+            self.stats["rejected"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    def pending(self, key):
+        """Linhas ainda não gravadas para a chave, da mais antiga para a mais nova."""
+        with self._lock:
+            return [row for _, row in self._pending.get(key, [])]
+
+    def wait_flushed(self, key, timeout=10.0):
+        """Espera até que não haja linhas pendentes para a chave."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._pending.get(key):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._flushed.wait(remaining)
+        return True
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self._flush_interval
+        while len(batch) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        delay = 0.5
+        for attempt in range(self._max_retries + 1):
+            try:
+                self._writer([row for _, row in batch])
+            except Exception as e:
+                error = e
+                self.stats["errors"] += 1
+                print(f"Erro ao gravar lote de conversas: {e}")
+                if not self._is_transient(e):
+                    break
+                if attempt == self._max_retries:
+                    print(f"Aviso: lote de {len(batch)} conversas não gravado depois de {attempt + 1} tentativas.")
+                    break
+                if self._stop.wait(delay):
+                    # Mantém no spool; serão regravadas na próxima inicialização
+                    return
+                delay = min(delay * 2, 30)
+            else:
+                self._forget(batch)
+                self.stats["flushed"] += len(batch)
+                self.stats["batches"] += 1
+                return
+        self._write_each(batch, error)
+
+    def _write_each(self, batch, error):
+        """Grava uma a uma as linhas de um lote que falhou; as que falharem vão para o dead letter."""
+        if len(batch) == 1:
+            dead = [(batch[0], error)]
+        else:
+            dead = []
+            for item in batch:
+                try:
+                    self._writer([item[1]])
+                    self.stats["flushed"] += 1
+                except Exception as e:
+                    dead.append((item, e))
+        if dead:
+            self._dead_letter(dead)
+        self._forget(batch)
+
+    def _dead_letter(self, dead):
+        self.stats["dead"] += len(dead)
+        print(f"Aviso: {len(dead)} conversas não puderam ser gravadas"
+              + (f" e foram para {self._dead_letter_path}." if self._dead_letter_path else ":"))
+        if not self._dead_letter_path:
+            for (seq, row), error in dead:
+                print(json.dumps({"row": row, "error": str(error)}, default=str))
+            return
+        with open(self._dead_letter_path, "a", encoding="utf-8") as f:
+            for (seq, row), error in dead:
+                f.write(json.dumps({"seq": seq, "row": row, "error": str(error)}, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _run(self):
+        recovered, self._recovered = self._recovered, []
+        for start in range(0, len(recovered), self._batch_size):
+            if self._stop.is_set():
+                return
+            self._write(recovered[start:start + self._batch_size])
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+        self.flush()
+
+    def flush(self):
+        """Grava imediatamente tudo o que estiver na fila."""
+        while True:
+            batch = []
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self, timeout=10.0):
+        """Interrompe a thread de fundo gravando o que restou na fila."""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def snapshot(self):
+        data = dict(self.stats)
+        data["queued"] = self._queue.qsize()
+        return data
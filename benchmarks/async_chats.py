@@ -0,0 +1,214 @@
+"""Milhares de chats simultâneos num único processo: servidor assíncrono (python run.py --async).
+
+Sobe o provedor stub (neste processo, respondendo em --latency-ms) e o
+servidor em cada modo de --modes, e dispara --chats chats ao mesmo tempo:
+cada um abre uma sessão (POST /new) e manda uma pergunta ao GPT (POST /, ou
+POST /stream com --stream). Mostra quantos terminaram, o tempo total,
+p50/p99, o máximo de chamadas simultâneas que chegaram ao stub, o pico de
+threads e de memória do servidor e o tempo de CPU do servidor por chat.
+
+No modo "async" todos os chats ficam em andamento juntos (máx. no stub ≈
+--chats) com poucas threads; no gunicorn (--modes production, 1 worker com
+--threads threads) as threads limitam quantos esperam o modelo ao mesmo tempo.
+Com latência longa no stub, o tempo total mostra a concorrência; com
+latência curta, a CPU por chat (o servidor, o stub e os clientes dividem
+a máquina) é o que limita a vazão.
+
+O processo do servidor desliga as cotas do gateway (PROVIDER_LIMITS,
+USER_RPM, USER_TPM), que seguram todas as sessões (são do usuário "1"), e os
+caches de respostas, para cada pergunta chegar ao stub.
+
+Uso:
+    python -m benchmarks.async_chats --chats 2000 --latency-ms 2000
+    python -m benchmarks.async_chats --chats 500 --modes async production --stream
+"""
+import argparse
+import asyncio
+import os
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+from benchmarks.serving import free_port
+from benchmarks.stub_provider import StubProfile, start_stub_provider
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(mode, port, threads):
+    """Processo do servidor (--serve): config.py sem cotas nem caches de respostas, depois run.py."""
+    import config
+    config.PROVIDER_LIMITS = {}
+    config.USER_RPM = config.USER_TPM = None
+    config.RESPONSE_CACHE_ENABLED = config.SEMANTIC_CACHE_ENABLED = False
+    import run
+    if mode == "async":
+        return run.run_async(port)
+    return run.run_production(port, workers=1, threads=threads)
+
+
+def raise_file_limit():
+    # Cada chat usa um socket no cliente, dois no servidor e um no stub
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def http(port, method, path, form=None, cookie=None):
+    """Uma requisição HTTP/1.1 com Connection: close; devolve (status, cookie de sessão, corpo)."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = urlencode(form).encode() if form else b""
+    lines = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1", "Connection: close", f"Content-Length: {len(body)}"]
+    if form:
+        lines.append("Content-Type: application/x-www-form-urlencoded")
+    if cookie:
+        lines.append(f"Cookie: {cookie}")
+    try:
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+        data = await reader.read()
+    finally:
+        writer.close()
+    head, _, payload = data.partition(b"\r\n\r\n")
+    header_lines = head.decode("latin-1").split("\r\n")
+    status = int(header_lines[0].split()[1])
+    set_cookie = next((line.split(":", 1)[1].strip().split(";", 1)[0] for line in header_lines[1:]
+                       if line.lower().startswith("set-cookie:")), None)
+    return status, set_cookie, payload
+
+
+async def wait_ready(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"o servidor saiu com código {process.returncode}")
+        try:
+            await http(port, "GET", "/chats")
+            return
+        except (OSError, IndexError, ValueError):
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"o servidor não respondeu na porta {port}")
+
+
+def group_usage(pgid):
+    """(threads, RSS em MB, CPU em s) somados dos processos do grupo (o servidor e os workers do gunicorn)."""
+    threads = rss = ticks = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+            ticks += int(fields[11]) + int(fields[12])
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return threads, rss / 1024, ticks / os.sysconf("SC_CLK_TCK")
+
+
+async def chat(port, index, stream, timeout):
+    started = time.perf_counter()
+    try:
+        _, cookie, _ = await asyncio.wait_for(http(port, "POST", "/new"), timeout)
+        form = {"message": f"pergunta número {index} do benchmark de chats simultâneos", "model": "gpt"}
+        status, _, payload = await asyncio.wait_for(http(port, "POST", "/stream" if stream else "/", form, cookie),
+                                                    timeout)
+        ok = status == 200 and (not stream or (b"event: done" in payload and b'"error": true' not in payload))
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+async def run_load(port, pgid, chats, stream, timeout):
+    peak = {"threads": 0, "rss": 0.0}
+    done = asyncio.Event()
+
+    async def monitor():
+        while not done.is_set():
+            threads, rss, _ = group_usage(pgid)
+            peak["threads"] = max(peak["threads"], threads)
+            peak["rss"] = max(peak["rss"], rss)
+            await asyncio.sleep(0.2)
+
+    cpu_started = group_usage(pgid)[2]
+    watcher = asyncio.create_task(monitor())
+    started = time.perf_counter()
+    results = await asyncio.gather(*(chat(port, i, stream, timeout) for i in range(chats)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await watcher
+    cpu = group_usage(pgid)[2] - cpu_started
+    latencies = sorted(latency for ok, latency in results if ok)
+    return {
+        "ok": len(latencies),
+        "errors": chats - len(latencies),
+        "elapsed": elapsed,
+        "p50": statistics.median(latencies) if latencies else 0,
+        "p99": latencies[max(0, int(len(latencies) * 0.99) - 1)] if latencies else 0,
+        "threads": peak["threads"],
+        "rss": peak["rss"],
+        "cpu_ms": cpu / chats * 1000,
+    }
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=2000, help="chats disparados ao mesmo tempo")
+    parser.add_argument("--latency-ms", type=float, default=2000, help="latência do stub até a resposta")
+    parser.add_argument("--modes", nargs="+", default=["async"], choices=["async", "production"])
+    parser.add_argument("--threads", type=int, default=32, help="threads do worker do gunicorn (modo production)")
+    parser.add_argument("--stream", action="store_true", help="usa POST /stream em vez de POST /")
+    parser.add_argument("--timeout", type=float, default=300, help="tempo máximo de cada requisição")
+    parser.add_argument("--serve", nargs=2, metavar=("MODO", "PORTA"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve(args.serve[0], int(args.serve[1]), args.threads)
+
+    files = raise_file_limit()
+    if files < args.chats * 3:
+        print(f"Aviso: limite de {files} arquivos abertos; pode faltar socket para {args.chats} chats (ulimit -n).")
+    print(f"{args.chats} chats simultâneos, stub com {args.latency_ms:.0f} ms, {'POST /stream' if args.stream else 'POST /'}")
+    print(f"{'modo':<12}{'ok':>7}{'erros':>7}{'tempo s':>9}{'p50 s':>8}{'p99 s':>8}{'máx. no stub':>14}"
+          f"{'threads':>9}{'RSS MB':>8}{'CPU ms/chat':>13}")
+    for mode in args.modes:
+        stub = start_stub_provider(StubProfile(latency_ms=args.latency_ms, latency_sigma=0.1, output_tokens=50,
+                                               token_ms=0))
+        env = dict(os.environ, LLM_STUB_URL=f"http://127.0.0.1:{stub.server_address[1]}", SECRET_KEY="benchmark")
+        port = free_port()
+        command = [sys.executable, "-m", "benchmarks.async_chats", "--serve", mode, str(port),
+                   "--threads", str(args.threads)]
+        process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                   start_new_session=True)
+        try:
+            asyncio.run(wait_ready(port, process))
+            result = asyncio.run(run_load(port, process.pid, args.chats, args.stream, args.timeout))
+        finally:
+            stop_server(process)
+            stub.shutdown()
+        print(f"{mode:<12}{result['ok']:>7}{result['errors']:>7}{result['elapsed']:9.1f}{result['p50']:8.2f}"
+              f"{result['p99']:8.2f}{stub.profile.stats['max_in_flight']:>14}{result['threads']:>9}"
+              f"{result['rss']:8.0f}{result['cpu_ms']:13.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
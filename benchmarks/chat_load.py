@@ -0,0 +1,126 @@
+"""Benchmark da latência de carregar um chat, antes e depois dos índices.
+
+Cria uma tabela descartável `conversations_bench` com o mesmo esquema de
+`conversations`, popula com N linhas (padrão: 1.000.000) espalhadas por
+vários usuários e chats, mede a consulta de `load_conversations` sem índice
+secundário, cria os mesmos índices das migrações 3 e 4 e mede de novo.
+
+Uso:
+    python -m benchmarks.chat_load --rows 1000000 --queries 200
+"""
+import argparse
+import random
+import statistics
+import time
+import uuid
+from datetime import date, timedelta
+import mysql.connector
+from config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT
+
+TABLE = "conversations_bench"
+LOAD_SQL = (f"SELECT user_message, gpt_response, DATE(timestamp) as date_group, chat_id FROM {TABLE} "
+            "WHERE user_id = %s AND chat_id = %s ORDER BY timestamp DESC")
+
+
+def connect():
+    return mysql.connector.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD,
+                                   database=DB_NAME, port=DB_PORT)
+
+
+def populate(mydb, rows, users, chats_per_user, batch=5000):
+    mycursor = mydb.cursor()
+    mycursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    mycursor.execute(f"""
+        CREATE TABLE {TABLE} (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id VARCHAR(255),
+            chat_id VARCHAR(36),
+            user_message TEXT,
+            gpt_response TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            date_group DATE,
+            model VARCHAR(50)
+        )
+    """)
+    chats = [(str(u), str(uuid.uuid4())) for u in range(users) for _ in range(chats_per_user)]
+    sql = (f"INSERT INTO {TABLE} (user_id, chat_id, user_message, gpt_response, timestamp, date_group, model) "
+           "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+    start = date(2024, 1, 1)
+    inserted = 0
+    while inserted < rows:
+        values = []
+        for _ in range(min(batch, rows - inserted)):
+            user_id, chat_id = random.choice(chats)
+            day = start + timedelta(days=random.randint(0, 365))
+            values.append((user_id, chat_id, "pergunta de teste " * 4, "resposta <br><strong>de teste</strong> " * 10,
+                           f"{day} {random.randint(0, 23):02d}:{random.randint(0, 59):02d}:00", day, "gemini"))
+        mycursor.executemany(sql, values)
+        mydb.commit()
+        inserted += len(values)
+    mycursor.close()
+    return chats
+
+
+def measure(mydb, chats, queries):
+    mycursor = mydb.cursor()
+    timings = []
+    for user_id, chat_id in random.sample(chats, min(queries, len(chats))):
+        started = time.perf_counter()
+        mycursor.execute(LOAD_SQL, (user_id, chat_id))
+        mycursor.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    mycursor.close()
+    timings.sort()
+    return {
+        "p50_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "max_ms": timings[-1],
+    }
+
+
+def explain(mydb, chat):
+    mycursor = mydb.cursor(dictionary=True)
+    mycursor.execute("EXPLAIN " + LOAD_SQL, chat)
+    plan = mycursor.fetchall()
+    mycursor.close()
+    return ", ".join(f"type={row['type']} key={row['key']} rows={row['rows']}" for row in plan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--chats-per-user", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="não apaga a tabela ao final")
+    args = parser.parse_args()
+
+    mydb = connect()
+    print(f"Populando {args.rows} linhas em {TABLE}...")
+    chats = populate(mydb, args.rows, args.users, args.chats_per_user)
+
+    print("Sem índices:", explain(mydb, chats[0]))
+    before = measure(mydb, chats, args.queries)
+
+    mycursor = mydb.cursor()
+    mycursor.execute(f"CREATE INDEX idx_bench_user_chat_ts ON {TABLE} (user_id, chat_id, timestamp)")
+    mycursor.execute(f"CREATE INDEX idx_bench_user_date ON {TABLE} (user_id, date_group)")
+    mycursor.execute(f"ANALYZE TABLE {TABLE}")
+    mycursor.fetchall()
+
+    print("Com índices:", explain(mydb, chats[0]))
+    after = measure(mydb, chats, args.queries)
+
+    print(f"{'':10}{'p50 (ms)':>12}{'p95 (ms)':>12}{'max (ms)':>12}")
+    for label, result in (("antes", before), ("depois", after)):
+        print(f"{label:10}{result['p50_ms']:12.2f}{result['p95_ms']:12.2f}{result['max_ms']:12.2f}")
+    print(f"Ganho no p50: {before['p50_ms'] / max(after['p50_ms'], 1e-6):.0f}x")
+
+    if not args.keep:
+        mycursor.execute(f"DROP TABLE {TABLE}")
+    mycursor.close()
+    mydb.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Benchmark da renderização das respostas: format_response antigo x Markdown.
+
+Gera respostas sintéticas no estilo dos modelos (parágrafos, listas,
+blocos de código, **negrito**, `código` e links) de 1 KB a 200 KB e mede,
+por tamanho, o tempo médio de:
+
+- antigo: o format_response anterior (quebra em 80 colunas com rfind,
+  descarta linhas curtas, regex de negrito no texto inteiro);
+- markdown: o renderizador de app.formatting, sem cache;
+- markdown+cache: format_response com o texto já no cache (hash + consulta);
+- streaming: o mesmo texto entregue ao ResponseFormatter em pedaços de
+  `--chunk` caracteres, com uma prévia (tail) por pedaço, como no /stream.
+
+A coluna µs/KB do markdown deve ficar estável entre os tamanhos (custo linear).
+
+Uso:
+    python -m benchmarks.formatting --repeat 20
+"""
+import argparse
+import random
+import re
+import time
+from app.formatting import ResponseFormatter, format_response, render
+
+SIZES_KB = [1, 5, 20, 50, 100, 200]
+WORDS = ("a resposta do modelo explica o algoritmo passo a passo com exemplos de entrada e saída "
+         "para que o usuário entenda cada etapa da solução proposta").split()
+
+
+def legacy_format_response(response):
+    """O format_response original, para comparação."""
+    lines = response.split('\n')
+    formatted_lines = []
+    for line in lines:
+        while len(line) > 80:
+            split_point = line.rfind(' ', 0, 80)
+            if split_point == -1:
+                split_point = 80
+            formatted_lines.append(line[:split_point])
+            line = line[split_point:].strip()
+        if len(line.strip()) > 5:
+            formatted_lines.append(line)
+    formatted_response = "<br>".join(formatted_lines)
+    formatted_response = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', formatted_response)
+    return formatted_response
+
+
+def sentence(rng, words=12):
+    parts = [rng.choice(WORDS) for _ in range(words)]
+    i = rng.randrange(words)
+    kind = rng.random()
+    if kind < 0.3:
+        parts[i] = f"**{parts[i]}**"
+    elif kind < 0.5:
+        parts[i] = f"`{parts[i]}()`"
+    elif kind < 0.6:
+        parts[i] = f"[{parts[i]}](https://exemplo.com/{parts[i]})"
+    return " ".join(parts).capitalize() + "."
+
+
+def synthetic_response(size, seed=0):
+    """Markdown de ~`size` caracteres, misturando os blocos que os modelos costumam gerar."""
+    rng = random.Random(seed)
+    blocks = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.45:
+            block = " ".join(sentence(rng) for _ in range(rng.randint(2, 6)))
+        elif kind < 0.7:
+            marker = "-" if rng.random() < 0.5 else "1."
+            block = "\n".join(f"{marker} {sentence(rng, 8)}" for _ in range(rng.randint(3, 6)))
+        elif kind < 0.9:
+            body = "\n".join(f"    x{i} = soma(x{i - 1}, {i}) * 2  # passo {i} < limite" for i in range(rng.randint(4, 12)))
+            block = f"```python\ndef exemplo():\n{body}\n    return x0\n```"
+        else:
+            block = f"## {sentence(rng, 4)}"
+        blocks.append(block)
+        length += len(block) + 2
+    return "\n\n".join(blocks)[:size]
+
+
+def timed(fn, text, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def streamed(chunk):
+    def run(text):
+        formatter = ResponseFormatter()
+        for i in range(0, len(text), chunk):
+            formatter.feed(text[i:i + chunk])
+            formatter.tail()
+        formatter.close()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--chunk", type=int, default=20, help="caracteres por pedaço no streaming")
+    args = parser.parse_args()
+
+    print(f"{'tamanho':>8}{'antigo ms':>11}{'markdown ms':>13}{'µs/KB':>8}{'cache ms':>10}{'streaming ms':>14}")
+    for kb in SIZES_KB:
+        text = synthetic_response(kb * 1024, seed=kb)
+        format_response(text)  # deixa no cache para a coluna "cache"
+        legacy = timed(legacy_format_response, text, args.repeat)
+        markdown = timed(render, text, args.repeat)
+        cached = timed(format_response, text, args.repeat)
+        stream = timed(streamed(args.chunk), text, max(1, args.repeat // 4))
+        print(f"{kb:>6}KB{legacy:11.2f}{markdown:13.2f}{markdown * 1000 / kb:8.0f}{cached:10.3f}{stream:14.2f}")
+
+
+if __name__ == "__main__":
+    main()
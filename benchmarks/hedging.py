@@ -0,0 +1,92 @@
+"""Benchmark do hedge entre provedores com latência de cauda pesada.
+
+Dois provedores de mentira respondem com latência log-normal (mediana
+`--median-ms`) e, numa fração `--slow-rate` das chamadas, uma cauda de
+Pareto várias vezes mais lenta, independente entre os provedores. Compara
+só o principal contra o Hedger (hedge no p95 recente, orçamento de
+`--budget`) e mostra p50/p95/p99/p99.9, a fração de hedges e a carga
+extra nos provedores.
+
+Uso:
+    python -m benchmarks.hedging --requests 3000 --threads 32
+"""
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.hedging import Hedger
+from app.metrics import percentile
+
+
+class StubProvider:
+    """Dorme uma latência sorteada e devolve uma resposta fixa."""
+
+    def __init__(self, name, median, slow_rate, seed):
+        self.name = name
+        self._median = median
+        self._slow_rate = slow_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def latency(self):
+        with self._lock:
+            self.calls += 1
+            value = self._median * self._rng.lognormvariate(0, 0.3)
+            if self._rng.random() < self._slow_rate:
+                value *= 5 + self._rng.paretovariate(1.5) * 5
+            return value
+
+    def __call__(self):
+        time.sleep(self.latency())
+        return f"resposta do {self.name}"
+
+
+def run(ask, requests, threads):
+    timings = []
+
+    def one(_):
+        started = time.perf_counter()
+        ask()
+        timings.append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(one, range(requests)))
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--median-ms", type=float, default=40)
+    parser.add_argument("--slow-rate", type=float, default=0.03)
+    parser.add_argument("--percentile", type=float, default=0.95)
+    parser.add_argument("--budget", type=float, default=0.05)
+    args = parser.parse_args()
+
+    median = args.median_ms / 1000
+    print(f"{args.requests} pedidos, {args.threads} threads, mediana {args.median_ms:g} ms, "
+          f"{args.slow_rate:.0%} lentos por provedor")
+    print(f"{'modo':14}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}{'hedges':>9}{'vencidos':>10}{'carga':>8}")
+    for mode in ("só principal", "hedge"):
+        primary = StubProvider("principal", median, args.slow_rate, seed=1)
+        secondary = StubProvider("reserva", median, args.slow_rate, seed=2)
+        hedger = Hedger(percentile=args.percentile, min_delay=median, max_delay=median * 10, budget=args.budget)
+        if mode == "hedge":
+            def ask():
+                return hedger.call(("principal", primary), ("reserva", secondary))
+        else:
+            ask = primary
+        timings = run(ask, args.requests, args.threads)
+        stats = hedger.stats()
+        load = (primary.calls + secondary.calls) / args.requests
+        print(f"{mode:14}" + "".join(f"{percentile(timings, q) * 1000:{w}.1f}"
+                                     for q, w in ((0.5, 9), (0.95, 9), (0.99, 9), (0.999, 10)))
+              + f"{stats['hedge_rate']:9.1%}{stats['hedges_won']:10}{load:8.2f}x")
+    print("'vencidos' são os hedges em que o reserva respondeu antes; 'carga' é chamadas aos provedores por pedido.")
+
+
+if __name__ == "__main__":
+    main()
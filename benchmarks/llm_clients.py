@@ -0,0 +1,118 @@
+"""Micro-benchmark do custo de criar os clientes de LLM a cada requisição.
+
+Sobe um servidor local que imita o endpoint /v1/chat/completions do OpenAI
+(resposta fixa, HTTP/1.1 com keep-alive) e compara:
+
+- por requisição: cria o cliente a cada chamada, como o código antigo fazia;
+- registro: o cliente é criado uma vez pelo ProviderRegistry e reaproveitado.
+
+Mostra a latência média/p95 por chamada e quantas conexões TCP o servidor
+recebeu. Para o Gemini, que não tem endpoint local, mede só o custo de
+`genai.configure` + `GenerativeModel` por chamada contra o cliente guardado.
+
+Uso:
+    python -m benchmarks.llm_clients --requests 500 --threads 4
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.providers import ProviderRegistry, gemini_model, openai_chat
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4",
+    "choices": [{"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": "Resposta de teste."}}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 4, "total_tokens": 14},
+}).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(call, requests, threads):
+    timings = []
+
+    def one(_):
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return statistics.mean(timings), timings[int(len(timings) * 0.95) - 1], requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    server = start_stub()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    messages = [{"role": "user", "content": "Olá"}]
+
+    def build():
+        return openai_chat("sk-bench", base_url=base_url, max_connections=args.threads)
+
+    registry = ProviderRegistry({"gpt": build, "gemini": lambda: gemini_model("bench-key")})
+    registry.warm_up(["gpt"])
+
+    print(f"{args.requests} chamadas com {args.threads} threads ao stub em {base_url}")
+    print(f"{'GPT':16}{'média ms':>10}{'p95 ms':>10}{'req/s':>10}{'conexões':>10}")
+    for name, call in [
+        ("por requisição", lambda: build().create(model="gpt-4", messages=messages)),
+        ("registro", lambda: registry.get("gpt").create(model="gpt-4", messages=messages)),
+    ]:
+        before = server.connections
+        mean, p95, rate = run(call, args.requests, args.threads)
+        print(f"{name:16}{mean:10.2f}{p95:10.2f}{rate:10.0f}{server.connections - before:10}")
+
+    print(f"{'Gemini (setup)':16}{'média ms':>10}{'p95 ms':>10}")
+    for name, call in [
+        ("por requisição", lambda: gemini_model("bench-key")),
+        ("registro", lambda: registry.get("gemini")),
+    ]:
+        mean, p95, _ = run(call, args.requests, 1)
+        print(f"{name:16}{mean:10.3f}{p95:10.3f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Injeção de falhas: novas tentativas, circuit breaker e provedor reserva.
+
+Sobe dois servidores locais que imitam /v1/chat/completions do OpenAI. O
+principal passa por fases (saudável, instável com 503s, fora do ar
+travando até o timeout, recuperado); o reserva está sempre saudável.
+Clientes em paralelo fazem perguntas o tempo todo, com três estratégias:
+
+- sem proteção: uma chamada, erro vira mensagem de erro (como antes);
+- retries+breaker: retry_call com o CircuitBreaker do provedor;
+- com reserva: idem, e se falhar pergunta ao provedor reserva.
+
+Para cada fase mostra a taxa de sucesso e a latência, e no fim as
+transições do circuito.
+
+Uso:
+    python -m benchmarks.resilience --threads 8 --phase-seconds 3
+"""
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.metrics import percentile
+from app.providers import openai_chat
+from app.resilience import CircuitBreaker, retry_call
+from benchmarks.llm_clients import COMPLETION
+
+# (nome, fração de respostas 503, trava até o timeout do cliente)
+PHASES = [
+    ("saudável", 0.0, False),
+    ("instável", 0.3, False),
+    ("fora do ar", 1.0, True),
+    ("recuperado", 0.0, False),
+]
+MESSAGES = [{"role": "user", "content": "Olá"}]
+
+
+class FaultHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        error_rate, hang = self.server.fault
+        if hang:
+            time.sleep(self.server.hang_seconds)
+        if hang or random.random() < error_rate:
+            body = b'{"error": {"message": "falha injetada", "type": "server_error"}}'
+            self.send_response(503)
+        else:
+            body = COMPLETION
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # o cliente desistiu pelo timeout
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(hang_seconds):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FaultHandler)
+    server.daemon_threads = True
+    server.fault = (0.0, False)
+    server.hang_seconds = hang_seconds
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_strategy(call, server, threads, phase_seconds, think):
+    """Roda as fases no servidor principal; devolve {fase: [(ok, ms)]}."""
+    results = {name: [] for name, _, _ in PHASES}
+    current = [PHASES[0][0]]
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            phase = current[0]
+            started = time.perf_counter()
+            ok = call()
+            results[phase].append((ok, (time.perf_counter() - started) * 1000))
+            time.sleep(think)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for name, error_rate, hang in PHASES:
+        current[0] = name
+        server.fault = (error_rate, hang)
+        time.sleep(phase_seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--phase-seconds", type=float, default=3.0)
+    parser.add_argument("--timeout", type=float, default=1.0, help="timeout do cliente, em segundos")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--base-delay", type=float, default=0.05)
+    parser.add_argument("--failure-threshold", type=int, default=5)
+    parser.add_argument("--reset-timeout", type=float, default=1.0)
+    parser.add_argument("--think-ms", type=float, default=20, help="pausa de cada cliente entre perguntas")
+    args = parser.parse_args()
+
+    primary = start_server(hang_seconds=args.timeout * 2)
+    backup = start_server(hang_seconds=args.timeout * 2)
+
+    def client(server):
+        return openai_chat("sk-bench", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                           max_connections=args.threads, timeout=args.timeout, max_retries=0)
+
+    primary_chat, backup_chat = client(primary), client(backup)
+    breakers = {}
+
+    def ask(chat):
+        chat.create(model="gpt-4", messages=MESSAGES)
+        return True
+
+    def unprotected():
+        try:
+            return ask(primary_chat)
+        except Exception:
+            return False
+
+    def protected(failover):
+        breaker = breakers.setdefault(failover, CircuitBreaker("principal", args.failure_threshold, args.reset_timeout))
+        backup_breaker = breakers.setdefault(("reserva", failover), CircuitBreaker("reserva"))
+
+        def call():
+            for chat, b in [(primary_chat, breaker)] + ([(backup_chat, backup_breaker)] if failover else []):
+                try:
+                    return retry_call(lambda: ask(chat), b, retries=args.retries,
+                                      base_delay=args.base_delay, max_delay=1.0)
+                except Exception:
+                    continue
+            return False
+        return call
+
+    strategies = [("sem proteção", unprotected), ("retries+breaker", protected(False)),
+                  ("com reserva", protected(True))]
+    print(f"{args.threads} threads, {args.phase_seconds:g}s por fase, timeout do cliente {args.timeout:g}s")
+    print(f"{'estratégia':18}{'fase':12}{'pedidos':>9}{'sucesso':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    for label, call in strategies:
+        results = run_strategy(call, primary, args.threads, args.phase_seconds, args.think_ms / 1000)
+        for phase, samples in results.items():
+            timings = sorted(ms for _, ms in samples)
+            success = sum(ok for ok, _ in samples) / len(samples) if samples else 0.0
+            print(f"{label:18}{phase:12}{len(samples):9}{success:9.0%}"
+                  f"{percentile(timings, 0.5):9.1f}{percentile(timings, 0.95):9.1f}")
+    for name, breaker in breakers.items():
+        if breaker.name != "principal":
+            continue
+        stats = breaker.stats()
+        label = "com reserva" if name else "retries+breaker"
+        print(f"\nCircuito ({label}): {stats['opened']} aberturas, {stats['rejected']} chamadas rejeitadas, "
+              f"{stats['retries']} novas tentativas")
+        for t in stats["transitions"]:
+            print(f"  {t['from']} -> {t['to']}: {t['reason']}")
+    primary.shutdown()
+    backup.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark da busca no histórico (/search) com 1M+ mensagens.
+
+Popula o backend escolhido com N conversas sintéticas de vários usuários,
+mede a latência da busca por índice (FULLTEXT no MySQL, FTS5 no SQLite),
+incluindo a página seguinte pelo cursor, e, como referência, a de um
+`LIKE '%termo%'`. No SQLite usa um arquivo temporário; no MySQL grava com
+um prefixo de user_id próprio e apaga ao final.
+
+Uso:
+    python -m benchmarks.search --backend sqlite --rows 1000000
+    python -m benchmarks.search --backend mysql --rows 1000000
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from app import db_pool
+from app.search import search_body
+from app.storage import MySQLStorage, SQLiteStorage
+
+WORDS = ("python java função classe banco dados índice consulta servidor cliente rede "
+         "memória processo thread fila cache arquivo lista dicionário erro exceção teste "
+         "modelo resposta pergunta exemplo código variável loop recursão algoritmo").split()
+QUERIES = ["python", "índice consulta", "recursão algoritmo", "cache memória", "exceção teste"]
+
+
+# Vocabulário com frequências tipo Zipf (poucas palavras muito comuns e uma cauda
+# longa); as palavras das buscas ficam espalhadas entre as posições 10 e 300.
+VOCABULARY = [f"termo{n}" for n in range(20000)]
+for position, word in enumerate(WORDS):
+    VOCABULARY.insert(10 + position * 10, word)
+WEIGHTS = [1.0 / (rank + 1) for rank in range(len(VOCABULARY))]
+CUM_WEIGHTS = list(itertools.accumulate(WEIGHTS))
+
+
+def sentence(rng, words):
+    return " ".join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=words))
+
+
+def populate(storage, rows, users, batch):
+    rng = random.Random(42)
+    stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    today = datetime.now().date().isoformat()
+    prefix = f"bench-{uuid.uuid4().hex[:8]}"
+    user_ids = [f"{prefix}-{i}" for i in range(users)]
+    for start in range(0, rows, batch):
+        chunk = []
+        for _ in range(min(batch, rows - start)):
+            user_message = sentence(rng, 8)
+            gpt_response = "<br>".join(f"<strong>{sentence(rng, 1)}</strong> {sentence(rng, 15)}" for _ in range(4))
+            chunk.append([rng.choice(user_ids), str(rng.randrange(10000)), user_message, gpt_response,
+                          stamp, today, "gemini", None, None, None, None, None, None, None, None])
+        storage.insert_conversations(chunk, [], [search_body(r[2], r[3]) for r in chunk])
+    return user_ids
+
+
+def timed(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def like_scan(storage, backend, user_id, term):
+    if backend == "sqlite":
+        storage._connection().execute(
+            "SELECT id FROM conversations WHERE user_id = ? AND (user_message LIKE ? OR gpt_response LIKE ?) LIMIT 21",
+            (user_id, f"%{term}%", f"%{term}%")).fetchall()
+    else:
+        with db_pool.connection() as mydb:
+            mycursor = mydb.cursor()
+            mycursor.execute(
+                "SELECT id FROM conversations WHERE user_id = %s AND (user_message LIKE %s OR gpt_response LIKE %s) LIMIT 21",
+                (user_id, f"%{term}%", f"%{term}%"))
+            mycursor.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.backend == "sqlite":
+            storage = SQLiteStorage(os.path.join(directory, "bench.db"))
+        else:
+            storage = MySQLStorage(db_pool)
+
+        started = time.perf_counter()
+        user_ids = populate(storage, args.rows, args.users, args.batch)
+        print(f"{args.rows} conversas gravadas em {time.perf_counter() - started:.1f}s ({args.backend})")
+
+        user_id = user_ids[0]
+        print(f"{'busca':22}{'índice p50':>12}{'índice p95':>12}{'pág. 2 p50':>12}{'LIKE p50':>10}")
+        for query in QUERIES:
+            first = storage.search(user_id, query, None, 21)
+            cursor = (first[19]["score"], first[19]["id"]) if len(first) > 20 else None
+            index_p50, index_p95 = timed(lambda: storage.search(user_id, query, None, 21), args.repeats)
+            next_p50, _ = timed(lambda: storage.search(user_id, query, cursor, 21), args.repeats) if cursor else (0.0, 0.0)
+            like_p50, _ = timed(lambda: like_scan(storage, args.backend, user_id, query.split()[0]), max(3, args.repeats // 10))
+            print(f"{query:22}{index_p50:12.2f}{index_p95:12.2f}{next_p50:12.2f}{like_p50:10.2f}")
+        print("Latências em ms, 20 resultados por página.")
+
+        if args.backend == "mysql":
+            for uid in user_ids:
+                with db_pool.connection() as mydb:
+                    mycursor = mydb.cursor()
+                    mycursor.execute("DELETE FROM conversations WHERE user_id = %s", (uid,))
+                    mycursor.execute("DELETE FROM conversations_search WHERE user_id = %s", (uid,))
+                    mydb.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Benchmark da busca no cache semântico com 100k e 1M perguntas guardadas.
+
+Preenche o cache com vetores unitários aleatórios (mais algumas perguntas
+reais, para conferir os acertos) e mede a latência de uma busca isolada e
+de buscas em lote, em float16 e float32. Por padrão a matriz fica num
+arquivo temporário mapeado em memória, como com SEMANTIC_CACHE_PATH.
+
+Com --precision, mede só a qualidade dos acertos: guarda uma pergunta de
+cada par rotulado, busca a outra e conta acertos certos (mesmo sentido) e
+errados (sentido diferente) em cada limiar.
+
+Uso:
+    python -m benchmarks.semantic_cache --sizes 100000 1000000 --dtypes float16 float32
+    python -m benchmarks.semantic_cache --precision --thresholds 0.85 0.9 0.92
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import numpy as np
+import config
+from app.semantic_cache import HashingEmbedder, SemanticCache
+
+PROMPTS = [
+    "como faço um loop em python",
+    "qual a diferença entre lista e tupla",
+    "explique o que é recursão",
+    "como conectar no mysql com python",
+    "o que é uma exceção em java",
+]
+PARAPHRASES = [
+    "Como faço um loop em Python?",
+    "qual a diferença entre lista e tupla?",
+    "explique, o que é recursão",
+    "como conectar no MySQL com Python",
+    "O que é uma exceção em Java?",
+]
+
+# (guardada, buscada, mesmo sentido?)
+PAIRS = [
+    ("Qual a capital da França?", "Qual é a capital da França?", True),
+    ("como faço um loop em python", "Como faço um loop em Python?", True),
+    ("explique o que é recursão", "explique, o que é recursão", True),
+    ("qual a diferença entre lista e tupla", "qual é a diferença entre lista e tupla?", True),
+    ("como conectar no mysql com python", "como me conecto ao MySQL usando Python?", True),
+    ("o que é uma exceção em java", "O que significa uma exceção no Java?", True),
+    ("como ordenar uma lista em python", "como eu ordeno uma lista no python", True),
+    ("como criar um ambiente virtual", "como crio um ambiente virtual em python?", True),
+    ("como deletar um arquivo em python", "como não deletar um arquivo em python", False),
+    ("quanto é 2 + 2", "quanto é 2 + 3", False),
+    ("converter 10 metros em pés", "converter 100 metros em pés", False),
+    ("liste os números primos até 50", "liste os números primos até 500", False),
+    ("devo usar async neste código?", "não devo usar async neste código?", False),
+    ("como conectar no mysql com python", "como conectar no postgresql com python", False),
+    ("como faço um loop em python", "como faço um loop em java", False),
+    ("qual a capital da frança", "qual a capital da itália", False),
+    ("qual a diferença entre lista e tupla", "qual a diferença entre tupla e conjunto", False),
+]
+
+
+def precision(embedder, dim, thresholds):
+    """Acertos certos/errados dos pares rotulados em cada limiar."""
+    same = sum(1 for *_, label in PAIRS if label)
+    print(f"{'limiar':>8}{'acertos certos':>16}{'acertos errados':>17}{'precisão':>10}")
+    for threshold in thresholds:
+        cache = SemanticCache(embedder, dim=dim, capacity=len(PAIRS), threshold=threshold)
+        right = wrong = 0
+        for i, (stored, query, label) in enumerate(PAIRS):
+            cache.put(f"par{i}", stored, "resposta")
+            if cache.lookup(f"par{i}", query) is not None:
+                right += label
+                wrong += not label
+        hits = right + wrong
+        print(f"{threshold:8.2f}{right:>11}/{same:<4}{wrong:>12}/{len(PAIRS) - same:<4}"
+              f"{(right / hits if hits else 1.0):10.2f}")
+    print("'acertos errados' são respostas de outra pergunta entregues como se fossem desta.")
+
+
+def timed(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def fill(cache, size, dim, batch=50000):
+    rng = np.random.default_rng(42)
+    filled = 0
+    while filled < size - len(PROMPTS):
+        count = min(batch, size - len(PROMPTS) - filled)
+        vectors = rng.standard_normal((count, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        cache.put_many("bench", [""] * count, ["resposta"] * count, vectors=vectors)
+        filled += count
+    cache.put_many("bench", PROMPTS, [f"resposta: {p}" for p in PROMPTS])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--dtypes", nargs="+", default=["float16", "float32"])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--batch", type=int, default=32, help="perguntas por busca em lote")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--in-memory", action="store_true", help="matriz em memória em vez de memmap")
+    parser.add_argument("--precision", action="store_true", help="mede acertos certos/errados em vez da latência")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[config.SEMANTIC_CACHE_THRESHOLD])
+    args = parser.parse_args()
+
+    embedder = HashingEmbedder(args.dim)
+    if args.precision:
+        precision(embedder, args.dim, args.thresholds)
+        return
+    embed_p50, _ = timed(lambda: embedder(PARAPHRASES[:1]), 200)
+    print(f"Vetor de uma pergunta (hashing, dim {args.dim}): {embed_p50:.3f} ms")
+    print(f"{'entradas':>10}{'dtype':>9}{'matriz MB':>11}{'carga s':>9}{'busca p50':>11}{'busca p95':>11}"
+          f"{'lote/perg.':>11}{'acertos':>9}")
+
+    for size in args.sizes:
+        for dtype in args.dtypes:
+            with tempfile.TemporaryDirectory() as directory:
+                path = None if args.in_memory else os.path.join(directory, "bench")
+                cache = SemanticCache(embedder, dim=args.dim, capacity=size, threshold=config.SEMANTIC_CACHE_THRESHOLD,
+                                      dtype=dtype, path=path)
+                started = time.perf_counter()
+                fill(cache, size, args.dim)
+                load_s = time.perf_counter() - started
+
+                single_p50, single_p95 = timed(lambda cache=cache: cache.lookup("bench", PARAPHRASES[0]), args.repeats)
+                queries = (PARAPHRASES * (args.batch // len(PARAPHRASES) + 1))[:args.batch]
+                batch_p50, _ = timed(lambda cache=cache: cache.lookup_many("bench", queries), max(3, args.repeats // 4))
+                hits = sum(r is not None for r in cache.lookup_many("bench", PARAPHRASES))
+                print(f"{size:10}{dtype:>9}{cache.stats()['matrix_bytes'] / 2**20:11.0f}{load_s:9.1f}"
+                      f"{single_p50:11.2f}{single_p95:11.2f}{batch_p50 / args.batch:11.3f}{hits:>6}/{len(PARAPHRASES)}")
+                cache.close()
+                del cache
+    print("Latências em ms; 'lote/perg.' é o tempo de uma busca em lote dividido pelo número de perguntas.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Vazão do servidor de desenvolvimento do Flask x gunicorn (python run.py --production).
+
+Sobe o aplicativo com `run.py` em cada modo, apontado para o provedor stub
+(LLM_STUB_URL, iniciado aqui), e dispara `--clients` clientes com conexões
+persistentes durante `--duration` segundos. Cada cliente abre um chat
+(POST /new) e repete as requisições de `--paths`; mostra requisições por
+segundo, p50/p99 e erros de cada modo.
+
+Os caminhos padrão (/conversations e /chats) medem o servidor, a sessão e o
+banco. Com --chat, cada cliente também manda perguntas (POST /) ao stub, que
+responde em --latency-ms: aí conta quantas requisições o servidor consegue
+manter esperando o modelo. Nesse caso aumente USER_RPM/USER_TPM e
+PROVIDER_LIMITS em config.py, senão o gateway limita a vazão (todas as
+sessões são do usuário "1").
+
+Uso:
+    python -m benchmarks.serving --clients 64 --duration 10 --workers 4 --threads 16
+    python -m benchmarks.serving --modes production --chat --latency-ms 500
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+from benchmarks.stub_provider import StubProfile, start_stub_provider
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port, workers, threads, stub_url):
+    env = dict(os.environ, LLM_STUB_URL=stub_url, SECRET_KEY="benchmark")
+    command = [sys.executable, "run.py", str(port), f"--{mode}", "--workers", str(workers), "--threads", str(threads)]
+    # Grupo de processos próprio: o reloader do modo dev e os workers do gunicorn saem juntos
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/chats")
+            conn.getresponse().read()
+            conn.close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f"o servidor ({mode}) não respondeu na porta {port}")
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+class Client:
+    """Uma conexão persistente com o cookie de sessão do seu chat."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        body = urlencode(form) if form else None
+        headers = {"Content-Type": "application/x-www-form-urlencoded"} if form else {}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                # Conexão fechada pelo servidor (keep-alive expirado ou HTTP/1.0): reconecta uma vez
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+                continue
+            cookie = response.getheader("Set-Cookie")
+            if cookie:
+                self.cookie = cookie.split(";", 1)[0]
+            if response.getheader("Connection", "").lower() == "close":
+                self.conn.close()
+                self.conn = None
+            return response.status
+
+
+def run_load(port, clients, duration, paths):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker(index):
+        client = Client(port)
+        client.request("POST", "/new")
+        sent = 0
+        local = []
+        while time.monotonic() < stop_at:
+            for path in paths:
+                started = time.perf_counter()
+                try:
+                    if path == "/":
+                        status = client.request("POST", "/", {"message": f"pergunta {index}-{sent}", "model": "gpt"})
+                        sent += 1
+                    else:
+                        status = client.request("GET", path)
+                except (OSError, http.client.HTTPException):
+                    status = None
+                if status != 200:
+                    with lock:
+                        errors[0] += 1
+                    continue
+                local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50": statistics.median(latencies) * 1000 if latencies else 0,
+        "p99": latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000 if latencies else 0,
+        "errors": errors[0],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["dev", "production"], choices=["dev", "production"])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="processos do gunicorn")
+    parser.add_argument("--threads", type=int, default=16, help="threads por processo do gunicorn")
+    parser.add_argument("--paths", nargs="+", default=["/conversations", "/chats"])
+    parser.add_argument("--chat", action="store_true", help="inclui perguntas ao modelo (POST /) via stub")
+    parser.add_argument("--latency-ms", type=float, default=300, help="latência do stub")
+    args = parser.parse_args(argv)
+
+    stub = start_stub_provider(StubProfile(latency_ms=args.latency_ms, output_tokens=100, token_ms=0))
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    paths = args.paths + (["/"] if args.chat else [])
+
+    print(f"{args.clients} clientes, {args.duration:.0f}s, caminhos: {' '.join(paths)}")
+    print(f"{'modo':<12}{'processos':>10}{'threads':>9}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'erros':>7}")
+    for mode in args.modes:
+        workers, threads = (args.workers, args.threads) if mode == "production" else (1, 1)
+        port = free_port()
+        process = start_server(mode, port, workers, threads, stub_url)
+        try:
+            result = run_load(port, args.clients, args.duration, paths)
+        finally:
+            stop_server(process)
+        label = "-" if mode == "dev" else threads
+        print(f"{mode:<12}{workers:>10}{label:>9}{result['rps']:10.0f}{result['p50']:9.1f}{result['p99']:9.1f}"
+              f"{result['errors']:>7}")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
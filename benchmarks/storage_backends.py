@@ -0,0 +1,118 @@
+"""Benchmark comparando os backends de armazenamento (MySQL e SQLite).
+
+Mede a vazão de gravação (uma conversa por transação, como no modo
+síncrono, e em lotes, como no write-behind) e a latência de carregar a
+primeira página e o chat inteiro. Os dados usam um user_id próprio e são
+apagados ao final; o SQLite roda num arquivo temporário.
+
+Uso:
+    python -m benchmarks.storage_backends --rows 20000 --chats 200
+    python -m benchmarks.storage_backends --skip-mysql
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from app import db_pool
+from app.search import search_body
+from app.storage import MySQLStorage, SQLiteStorage
+from config import SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE
+
+
+def make_rows(user_id, chats, count):
+    now = datetime.now()
+    rows = []
+    for i in range(count):
+        chat_id = chats[i % len(chats)]
+        rows.append([user_id, chat_id, f"pergunta {i} " * 5, "resposta <br><strong>longa</strong> " * 20,
+                     now.strftime('%Y-%m-%d %H:%M:%S'), now.date().isoformat(), "gemini", None, None, None, 15, 60,
+                     None, None, None])
+    return rows
+
+
+def summaries(rows):
+    return [[row[0], row[1], row[2][:80], row[4], row[4], 1, row[6], time.time_ns() // 1000] for row in rows]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(len(values) * fraction) - 1)]
+
+
+def run(name, storage, rows, batch, chats, user_id, queries):
+    single = rows[: len(rows) // 4]
+    started = time.perf_counter()
+    for row in single:
+        storage.insert_conversations([row], summaries([row]), [search_body(row[2], row[3])])
+    single_rate = len(single) / (time.perf_counter() - started)
+
+    batched = rows[len(single):]
+    started = time.perf_counter()
+    for i in range(0, len(batched), batch):
+        chunk = batched[i:i + batch]
+        storage.insert_conversations(chunk, summaries(chunk), [search_body(r[2], r[3]) for r in chunk])
+    batch_rate = len(batched) / (time.perf_counter() - started)
+
+    page_ms, full_ms = [], []
+    for chat_id in random.choices(chats, k=queries):
+        started = time.perf_counter()
+        storage.query_page(user_id, chat_id, None, 51)
+        page_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        storage.query_conversations(user_id, chat_id)
+        full_ms.append((time.perf_counter() - started) * 1000)
+
+    for chat_id in chats:
+        storage.delete_chat(user_id, chat_id)
+
+    return {
+        "backend": name,
+        "insert_single": single_rate,
+        "insert_batch": batch_rate,
+        "page_p50": statistics.median(page_ms),
+        "page_p95": percentile(page_ms, 0.95),
+        "full_p50": statistics.median(full_ms),
+        "full_p95": percentile(full_ms, 0.95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--skip-mysql", action="store_true")
+    args = parser.parse_args()
+
+    user_id = f"bench-{uuid.uuid4()}"
+    chats = [str(uuid.uuid4()) for _ in range(args.chats)]
+    rows = make_rows(user_id, chats, args.rows)
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite = SQLiteStorage(os.path.join(directory, "bench.db"), synchronous=SQLITE_SYNCHRONOUS,
+                               mmap_size=SQLITE_MMAP_SIZE, cache_size=SQLITE_CACHE_SIZE)
+        results.append(run("sqlite", sqlite, rows, args.batch, chats, user_id, args.queries))
+
+    if not args.skip_mysql:
+        mysql = MySQLStorage(db_pool)
+        try:
+            results.append(run("mysql", mysql, rows, args.batch, chats, user_id, args.queries))
+        except mysql.errors as err:
+            print(f"MySQL indisponível, resultado omitido: {err}")
+
+    print(f"{args.rows} linhas em {args.chats} chats (lotes de {args.batch})")
+    print(f"{'backend':8}{'1/tx (l/s)':>12}{'lote (l/s)':>12}{'pág p50':>10}{'pág p95':>10}{'chat p50':>10}{'chat p95':>10}")
+    for r in results:
+        print(f"{r['backend']:8}{r['insert_single']:12.0f}{r['insert_batch']:12.0f}"
+              f"{r['page_p50']:10.2f}{r['page_p95']:10.2f}{r['full_p50']:10.2f}{r['full_p95']:10.2f}")
+    print("Latências em ms.")
+
+
+if __name__ == "__main__":
+    main()
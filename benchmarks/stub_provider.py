@@ -0,0 +1,309 @@
+"""Provedor de LLM de mentira, local, para testes de carga e de latência sem rede.
+
+Fala o suficiente das duas APIs usadas pelo app, com e sem streaming:
+
+- OpenAI: POST /v1/chat/completions (`stream: true` responde em SSE);
+- Gemini (transporte REST do SDK): POST /v1beta/models/<modelo>:generateContent
+  e :streamGenerateContent (um array JSON enviado aos pedaços).
+
+A latência até o primeiro token é log-normal (mediana `--latency-ms`,
+dispersão `--latency-sigma`), com uma fração `--slow-rate` de chamadas
+`--slow-factor` vezes mais lentas; depois cada token leva `--token-ms`. O
+tamanho da resposta varia em torno de `--output-tokens`, e o texto depende
+só da pergunta e de `--seed` (a mesma pergunta recebe sempre a mesma
+resposta). `--error-rate` responde 500/503, `--throttle-rate` responde 429
+ao acaso, e `--rpm`/`--tpm` devolvem 429 como a cota de um provedor real.
+
+Para o app usar o stub, defina LLM_STUB_URL (config.py ou variável de
+ambiente) com o endereço do servidor. Não importa nada de `app`, para subir
+sem banco nem chaves.
+
+Uso:
+    python -m benchmarks.stub_provider --port 8090 --latency-ms 300 --token-ms 15 --error-rate 0.01
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("o modelo responde com um texto de teste gerado localmente para medir a vazão e a latência "
+         "do aplicativo sem chamar nenhum provedor de verdade nem depender da rede em cada pedido").split()
+GEMINI_PATH = re.compile(r"^/v1(?:beta)?/models/([^/:]+):(generateContent|streamGenerateContent)")
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class QuotaBucket:
+    """Cota por minuto recarregada continuamente, como a de um provedor."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        if self.tokens < min(amount, self.capacity):
+            return False
+        self.tokens -= amount
+        return True
+
+
+class StubProfile:
+    """Comportamento do stub: latência, tamanho das respostas, erros e cotas."""
+
+    def __init__(self, latency_ms=300, latency_sigma=0.3, slow_rate=0.0, slow_factor=10, token_ms=10,
+                 output_tokens=150, error_rate=0.0, throttle_rate=0.0, rpm=None, tpm=None, seed=0):
+        self.latency = latency_ms / 1000
+        self.latency_sigma = latency_sigma
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.token_delay = token_ms / 1000
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._buckets = {}  # (provedor, "rpm"|"tpm") -> QuotaBucket
+        self._limits = {"rpm": rpm, "tpm": tpm}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "throttled": 0, "tokens": 0, "in_flight": 0,
+                      "max_in_flight": 0}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+            if name == "in_flight":
+                self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+    def first_token_delay(self):
+        with self._lock:
+            delay = self.latency * self._rng.lognormvariate(0, self.latency_sigma)
+            if self._rng.random() < self.slow_rate:
+                delay *= self.slow_factor
+            return delay
+
+    def fault(self, provider, prompt_tokens):
+        """Status HTTP da falha a simular neste pedido (429, 500, 503) ou None."""
+        with self._lock:
+            now = time.monotonic()
+            for kind, amount in (("rpm", 1), ("tpm", prompt_tokens + self.output_tokens)):
+                limit = self._limits[kind]
+                if not limit:
+                    continue
+                if not self._buckets.setdefault((provider, kind), QuotaBucket(limit)).take(amount, now):
+                    return 429
+            roll = self._rng.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 503 if roll < self.throttle_rate + self.error_rate / 2 else 500
+        return None
+
+    def words(self, prompt):
+        """Palavras da resposta, determinadas pela pergunta e pela semente."""
+        digest = hashlib.sha256(f"{self.seed}|{prompt}".encode()).digest()
+        rng = random.Random(digest)
+        count = max(1, int(self.output_tokens * rng.uniform(0.5, 1.5)))
+        return [rng.choice(WORDS) for _ in range(count)]
+
+
+def _openai_prompt(body):
+    return "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+
+
+def _gemini_prompt(body):
+    return "\n".join(str(part.get("text", "")) for content in body.get("contents", [])
+                     for part in content.get("parts", []))
+
+
+def _openai_chunk(content=None, finish_reason=None):
+    delta = {"role": "assistant", "content": content} if content is not None else {}
+    return {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": "gpt-4",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+
+def _gemini_response(text, prompt_tokens, output_tokens, finish=True):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                              "totalTokenCount": prompt_tokens + output_tokens}}
+
+
+ERROR_BODIES = {
+    "openai": {
+        429: {"message": "Rate limit reached (stub).", "type": "rate_limit_error", "code": "rate_limit_exceeded"},
+        500: {"message": "Internal error (stub).", "type": "server_error", "code": None},
+        503: {"message": "Service unavailable (stub).", "type": "server_error", "code": None},
+    },
+    "gemini": {
+        429: {"code": 429, "message": "Resource has been exhausted (stub).", "status": "RESOURCE_EXHAUSTED"},
+        500: {"code": 500, "message": "Internal error (stub).", "status": "INTERNAL"},
+        503: {"code": 503, "message": "The service is currently unavailable (stub).", "status": "UNAVAILABLE"},
+    },
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, data, headers=()):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _chunk(self, data):
+        data = data.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, dict(self.server.profile.stats))
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        profile = self.server.profile
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        gemini = GEMINI_PATH.match(self.path)
+        if self.path.startswith("/v1/chat/completions"):
+            provider, prompt, stream = "openai", _openai_prompt(body), bool(body.get("stream"))
+        elif gemini:
+            provider, prompt, stream = "gemini", _gemini_prompt(body), gemini.group(2) == "streamGenerateContent"
+        else:
+            self._send_json(404, {"error": {"message": f"Caminho não suportado pelo stub: {self.path}"}})
+            return
+        profile.count("requests")
+        prompt_tokens = estimate_tokens(prompt)
+        status = profile.fault(provider, prompt_tokens)
+        if status is not None:
+            profile.count("throttled" if status == 429 else "errors")
+            headers = [("Retry-After", "1")] if status == 429 else []
+            self._send_json(status, {"error": ERROR_BODIES[provider][status]}, headers)
+            return
+        words = profile.words(prompt)
+        profile.count("tokens", len(words))
+        profile.count("in_flight")
+        try:
+            time.sleep(profile.first_token_delay())
+            if stream:
+                profile.count("streams")
+                self._stream(provider, words, prompt_tokens)
+            else:
+                time.sleep(profile.token_delay * len(words))
+                self._complete(provider, " ".join(words), prompt_tokens, len(words))
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # o cliente desistiu (timeout ou hedge perdido)
+        finally:
+            profile.count("in_flight", -1)
+
+    def _complete(self, provider, text, prompt_tokens, output_tokens):
+        if provider == "openai":
+            self._send_json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": "gpt-4",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens,
+                          "total_tokens": prompt_tokens + output_tokens},
+            })
+        else:
+            self._send_json(200, _gemini_response(text, prompt_tokens, output_tokens))
+
+    def _stream(self, provider, words, prompt_tokens):
+        if provider == "openai":
+            self._start_chunked("text/event-stream")
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(self.server.profile.token_delay)
+                self._chunk(f"data: {json.dumps(_openai_chunk(word if i == 0 else ' ' + word))}\n\n")
+            self._chunk(f"data: {json.dumps(_openai_chunk(finish_reason='stop'))}\n\n")
+            self._chunk("data: [DONE]\n\n")
+        else:
+            # O SDK do Gemini lê um array JSON, um elemento por pedaço
+            self._start_chunked("application/json")
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(self.server.profile.token_delay)
+                element = _gemini_response(word if i == 0 else " " + word, prompt_tokens, i + 1,
+                                           finish=i == len(words) - 1)
+                self._chunk(("[" if i == 0 else ",") + json.dumps(element) + "\n")
+            self._chunk("]")
+        self._end_chunked()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096  # milhares de conexões podem chegar juntas (ex.: benchmarks.async_chats)
+
+
+def start_stub_provider(profile, host="127.0.0.1", port=0):
+    """Sobe o stub numa thread e devolve o servidor (endereço em `server.server_address`)."""
+    server = StubServer((host, port), StubHandler)
+    server.profile = profile
+    threading.Thread(target=server.serve_forever, name="stub-provider", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=300, help="mediana do tempo até o primeiro token")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="dispersão (log-normal) da latência")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fração de chamadas lentas (cauda)")
+    parser.add_argument("--slow-factor", type=float, default=10, help="quantas vezes mais lentas")
+    parser.add_argument("--token-ms", type=float, default=10, help="tempo de geração de cada token")
+    parser.add_argument("--output-tokens", type=int, default=150, help="tamanho médio das respostas")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fração de respostas 500/503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fração de respostas 429 ao acaso")
+    parser.add_argument("--rpm", type=int, help="cota de requisições por minuto de cada provedor (429 acima)")
+    parser.add_argument("--tpm", type=int, help="cota de tokens por minuto de cada provedor (429 acima)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    profile = StubProfile(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma, slow_rate=args.slow_rate,
+                          slow_factor=args.slow_factor, token_ms=args.token_ms, output_tokens=args.output_tokens,
+                          error_rate=args.error_rate, throttle_rate=args.throttle_rate, rpm=args.rpm, tpm=args.tpm,
+                          seed=args.seed)
+    server = StubServer((args.host, args.port), StubHandler)
+    server.profile = profile
+    print(f"Provedor stub em http://{args.host}:{args.port} (defina LLM_STUB_URL com esse endereço; "
+          f"estatísticas em /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Estatísticas: {profile.stats}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
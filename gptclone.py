@@ -184,11 +184,15 @@ def create_database_and_table():
             CREATE TABLE IF NOT EXISTS conversations (
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 user_id VARCHAR(255),
+                chat_id VARCHAR(36),
                 user_message TEXT,
                 gpt_response TEXT,
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 date_group DATE,
-                model VARCHAR(50)
+                model VARCHAR(50),
+                INDEX idx_conversations_user_chat_ts (user_id, chat_id, timestamp),
+                INDEX idx_conversations_user_date (user_id, date_group),
+                INDEX idx_conversations_user_chat_id (user_id, chat_id, id)
             )
         """)
         mydb.commit()
@@ -202,17 +206,32 @@ def create_database_and_table():
             print(f"Outro erro do MySQL: {err}")
         sys.exit(1)
 
+def apply_migrations():
+    """Aplica as migrações pendentes do esquema (colunas e índices novos)."""
+    try:
+        subprocess.check_call([sys.executable, "-m", "app.migrations"], cwd=PROJECT_NAME)
+        logger.info("Migrações do esquema aplicadas.")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Erro ao aplicar migrações: {e}")
+        print(f"Erro ao aplicar migrações: {e}")
+        sys.exit(1)
+
 def check_port(port):
     """Verifica se a porta especificada está em uso."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         return s.connect_ex(('localhost', port)) == 0
 
-def start_flask_app(port):
-    """Inicia o aplicativo Flask na porta especificada."""
+def start_flask_app(port, production=False):
+    """Inicia o aplicativo Flask na porta especificada.
+
+    Com `production`, usa o gunicorn com os workers e threads de config.py
+    (ver run.py) no lugar do servidor de desenvolvimento.
+    """
     try:
-        print(f"Iniciando o aplicativo na porta {port}...")
+        print(f"Iniciando o aplicativo na porta {port}{' (produção)' if production else ''}...")
         # Usar PROJECT_NAME aqui, pois run.py está no diretório principal
-        subprocess.Popen([sys.executable, f"{PROJECT_NAME}/run.py", str(port)])
+        mode = "--production" if production else "--dev"
+        subprocess.Popen([sys.executable, f"{PROJECT_NAME}/run.py", str(port), mode])
         print(f"Aplicativo iniciado com sucesso. Acesse em http://localhost:{port}")
     except Exception as e:
         logger.error(f"Erro ao iniciar o aplicativo Flask: {e}")
@@ -815,7 +834,11 @@ def main():
     else:
         logger.info("O banco de dados e a tabela já existem. Nenhuma ação necessária.")
 
-    # 7. Inicia o aplicativo Flask
+    # 6.1 Atualiza o esquema de bancos criados por versões anteriores
+    apply_migrations()
+
+    # 7. Inicia o aplicativo Flask (python gptclone.py --production para o servidor de produção)
+    production = "--production" in sys.argv[1:]
     if check_port(DEFAULT_PORT):
         logger.warning(f"A porta {DEFAULT_PORT} está em uso. Tentando a porta {BACKUP_PORT}...")
         if check_port(BACKUP_PORT):
@@ -823,9 +846,9 @@ def main():
             print(f"Erro: As portas {DEFAULT_PORT} e {BACKUP_PORT} estão em uso. Libere uma delas para iniciar o aplicativo.")
             sys.exit(1)
         else:
-            start_flask_app(BACKUP_PORT)
+            start_flask_app(BACKUP_PORT, production)
     else:
-        start_flask_app(DEFAULT_PORT)
+        start_flask_app(DEFAULT_PORT, production)
 
     logger.info("Configuração concluída com sucesso!")
 
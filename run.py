@@ -1,8 +1,163 @@
+"""Inicia o aplicativo.
 
+    python run.py [porta]                    # modo de SERVER_MODE em config.py (padrão: dev)
+    python run.py 8000 --dev                 # servidor de desenvolvimento do Flask (debug, recarga automática)
+    python run.py 8000 --production          # gunicorn: SERVER_WORKERS processos x SERVER_THREADS threads
+    python run.py 8000 --production --workers 4 --threads 16
+    python run.py 8000 --async               # hypercorn com app.asgi: chat e histórico como corrotinas (um processo)
+
+O modo de produção usa o gunicorn (só Linux/macOS) com workers "gthread":
+cada requisição ocupa uma thread enquanto espera o modelo ou o banco, e o
+processo principal só vigia os workers (não importa o aplicativo). Nele:
+
+- recarregar o código sem derrubar conexões: kill -HUP $(cat gunicorn.pid)
+  (sobem workers novos e os antigos terminam as requisições em andamento,
+  por até SERVER_GRACEFUL_TIMEOUT segundos);
+- cada worker é reciclado depois de SERVER_MAX_REQUESTS requisições;
+- um worker sem sinal de vida por SERVER_TIMEOUT segundos é reiniciado.
+
+Cada processo tem seus próprios caches em memória, fila de jobs local,
+single-flight e cotas do gateway. Com SERVER_WORKERS > 1, use os backends
+"redis" do cache de conversas e da fila de jobs e divida PROVIDER_LIMITS
+pelo número de workers. Com o SQLite, os workers disputam o bloqueio de
+escrita do arquivo: prefira 1 worker com mais threads. A SECRET_KEY das sessões precisa ser a mesma em
+todos: sem a variável de ambiente SECRET_KEY, a gerada aqui é repassada aos
+workers. O spool do write-behind é um arquivo por worker
+(WRITE_BEHIND_SPOOL_PATH.N, N > 0), regravado pelo próximo worker com o
+mesmo número se um deles cair.
+
+Comparação com o servidor de desenvolvimento: python -m benchmarks.serving
+
+O modo assíncrono (requer o pacote quart, que traz o hypercorn) roda um
+único processo: as rotas de chat, histórico e novo/limpar chat são
+corrotinas e um chat esperando o modelo não ocupa thread (ver app/asgi.py).
+Milhares de chats simultâneos: python -m benchmarks.async_chats
+"""
+import argparse
+import itertools
 import os
 import sys
-from app import app
+from config import SECRET_KEY, SERVER_MODE, SERVER_HOST, SERVER_WORKERS, SERVER_THREADS, SERVER_KEEPALIVE
+from config import SERVER_TIMEOUT, SERVER_GRACEFUL_TIMEOUT, SERVER_MAX_REQUESTS, SERVER_MAX_REQUESTS_JITTER, SERVER_PID_FILE
+from config import TRANSCRIPT_CACHE_BACKEND, JOBS_ENABLED, JOBS_BACKEND, STORAGE_BACKEND
+from config import SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_PATH
+from config import ASYNC_EXECUTOR_WORKERS
+
+
+def _pre_fork(server, worker):
+    # Número (slot) do worker: o menor que nenhum worker vivo está usando
+    used = {getattr(other, "slot", None) for other in server.WORKERS.values()}
+    worker.slot = next(slot for slot in itertools.count() if slot not in used)
+
+
+def _post_fork(server, worker):
+    # Lido por app.models antes de abrir o spool do write-behind
+    os.environ["SERVER_WORKER_SLOT"] = str(worker.slot)
+
+
+def production_options(port, workers=SERVER_WORKERS, threads=SERVER_THREADS):
+    """Configuração do gunicorn a partir de config.py."""
+    return {
+        "bind": f"{SERVER_HOST}:{port}",
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread",
+        "keepalive": SERVER_KEEPALIVE,
+        "timeout": SERVER_TIMEOUT,
+        "graceful_timeout": SERVER_GRACEFUL_TIMEOUT,
+        "max_requests": SERVER_MAX_REQUESTS,
+        "max_requests_jitter": SERVER_MAX_REQUESTS_JITTER,
+        "pidfile": SERVER_PID_FILE,
+        "proc_name": "chatgpt-clone",
+        "pre_fork": _pre_fork,
+        "post_fork": _post_fork,
+    }
+
+
+def _process_warnings(workers):
+    if workers <= 1:
+        return
+    if TRANSCRIPT_CACHE_BACKEND in ("local", "local-redis"):
+        print("Aviso: com vários workers o cache de conversas em memória fica desatualizado entre os processos; "
+              "use TRANSCRIPT_CACHE_BACKEND = \"redis\" (ou \"none\").")
+    if STORAGE_BACKEND == "sqlite":
+        print("Aviso: com SQLite os workers disputam o bloqueio de escrita do arquivo; prefira 1 worker com mais threads.")
+    if JOBS_ENABLED and JOBS_BACKEND == "local":
+        print("Aviso: com vários workers a fila de jobs local não é compartilhada (GET /jobs/<id> pode cair em "
+              "outro processo); use JOBS_BACKEND = \"redis\".")
+    if SEMANTIC_CACHE_ENABLED and SEMANTIC_CACHE_PATH:
+        print("Aviso: só um processo grava o cache semântico em SEMANTIC_CACHE_PATH; os outros workers usam um "
+              "cache só em memória, não compartilhado.")
+    print(f"Aviso: as cotas de PROVIDER_LIMITS valem por processo ({workers} workers).")
+
+
+def run_production(port, workers=SERVER_WORKERS, threads=SERVER_THREADS):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("Erro: o modo de produção requer o pacote gunicorn (pip install gunicorn).")
+        return 1
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            for key, value in production_options(port, workers, threads).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Importado em cada worker, depois do fork (threads e conexões não atravessam o fork)
+            from app import app
+            return app
+
+    os.environ.setdefault("SECRET_KEY", SECRET_KEY)
+    _process_warnings(workers)
+    print(f"Servidor de produção em http://{SERVER_HOST}:{port} ({workers} workers x {threads} threads)")
+    ProductionServer().run()
+    return 0
+
+
+def run_async(port):
+    try:
+        from hypercorn.config import Config
+        from hypercorn.run import run
+        import quart  # noqa: F401 (app.asgi)
+    except ImportError:
+        print("Erro: o modo assíncrono requer o pacote quart (pip install quart), que traz o hypercorn.")
+        return 1
+    config = Config()
+    config.bind = [f"{SERVER_HOST}:{port}"]
+    config.application_path = "app.asgi:application"
+    config.workers = 0  # no próprio processo: a concorrência vem do loop de eventos
+    config.keep_alive_timeout = SERVER_KEEPALIVE
+    config.graceful_timeout = SERVER_GRACEFUL_TIMEOUT
+    config.backlog = 4096  # milhares de clientes podem conectar ao mesmo tempo
+    print(f"Servidor assíncrono em http://{SERVER_HOST}:{port} (1 processo, {ASYNC_EXECUTOR_WORKERS} threads para o banco)")
+    return run(config)
+
+
+def run_dev(port):
+    from app import app
+    app.run(debug=True, host=SERVER_HOST, port=port)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inicia o aplicativo")
+    parser.add_argument("port", nargs="?", type=int, default=8000)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--production", dest="mode", action="store_const", const="production")
+    mode.add_argument("--dev", dest="mode", action="store_const", const="dev")
+    mode.add_argument("--async", dest="mode", action="store_const", const="async")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS)
+    args = parser.parse_args(argv)
+
+    mode = args.mode or SERVER_MODE
+    if mode == "production":
+        return run_production(args.port, max(1, args.workers), max(1, args.threads))
+    if mode == "async":
+        return run_async(args.port)
+    return run_dev(args.port)
+
 
 if __name__ == "__main__":
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
-    app.run(debug=True, host='0.0.0.0', port=port)
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""Testes do circuit breaker, das novas tentativas e do provedor reserva.
+
+Sem rede nem espera de verdade: `fn` é falsa, o relógio do circuito é
+controlado pelo teste e `retry_call` recebe um `sleep` que só anota a espera.
+
+Uso:
+    python -m pytest tests
+"""
+import random
+import pytest
+from app import resilience
+from app.resilience import CircuitBreaker, CircuitOpen, retry_call
+
+
+class ProviderError(Exception):
+    """Erro de SDK com código HTTP, como openai.APIStatusError."""
+
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(resilience, "time", fake)
+    return fake
+
+
+def flaky(errors, result="ok"):
+    """`fn` que levanta os erros de `errors` em ordem e depois devolve `result`."""
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return fn, calls
+
+
+# --- CircuitBreaker -------------------------------------------------------------
+
+def test_breaker_closed_open_half_open_closed(clock):
+    breaker = CircuitBreaker("gpt", failure_threshold=3, reset_timeout=30)
+    assert breaker.state == CircuitBreaker.CLOSED
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure(ProviderError(503))
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    breaker.record_failure(ProviderError(503))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now += 29
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 1
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()          # só uma chamada de teste por vez
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+    moves = [(t["from"], t["to"]) for t in breaker.stats()["transitions"]]
+    assert moves == [("closed", "open"), ("open", "half_open"), ("half_open", "closed")]
+
+
+def test_breaker_half_open_failure_reopens(clock):
+    breaker = CircuitBreaker("gpt", failure_threshold=1, reset_timeout=10)
+    breaker.allow()
+    breaker.record_failure(ProviderError(500))
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure(ProviderError(500))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+@pytest.mark.parametrize("status, retryable", [(429, True), (400, False), (401, False), (404, False)])
+def test_record_error_ignores_rate_limit_and_client_errors(clock, status, retryable):
+    breaker = CircuitBreaker("gpt", failure_threshold=2, reset_timeout=30)
+    for _ in range(5):
+        assert breaker.allow()
+        assert breaker.record_error(ProviderError(status)) is retryable
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["failures"] == 0
+
+
+def test_record_error_counts_server_errors(clock):
+    breaker = CircuitBreaker("gpt", failure_threshold=2, reset_timeout=30)
+    for _ in range(2):
+        breaker.allow()
+        assert breaker.record_error(ProviderError(503))
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+# --- retry_call -----------------------------------------------------------------
+
+def test_retry_call_retries_then_succeeds(clock):
+    breaker = CircuitBreaker("gpt", failure_threshold=10)
+    fn, calls = flaky([ProviderError(503), ProviderError(502)])
+    sleeps = []
+    assert retry_call(fn, breaker, retries=2, base_delay=0.5, max_delay=8, sleep=sleeps.append) == "ok"
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+    assert breaker.stats()["retries"] == 2
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retry_call_gives_up_after_retries(clock):
+    breaker = CircuitBreaker("gpt", failure_threshold=10)
+    errors = [ProviderError(503) for _ in range(4)]
+    fn, calls = flaky(errors)
+    sleeps = []
+    with pytest.raises(ProviderError) as raised:
+        retry_call(fn, breaker, retries=3, sleep=sleeps.append)
+    assert raised.value is errors[-1]
+    assert len(calls) == 4
+    assert len(sleeps) == 3
+
+
+def test_retry_call_does_not_retry_client_errors(clock):
+    breaker = CircuitBreaker("gpt")
+    fn, calls = flaky([ProviderError(400)])
+    sleeps = []
+    with pytest.raises(ProviderError):
+        retry_call(fn, breaker, retries=3, sleep=sleeps.append)
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_retry_call_backoff_bounds(clock, monkeypatch):
+    breaker = CircuitBreaker("gpt", failure_threshold=100)
+    sleeps = []
+    for _ in range(50):
+        fn, _ = flaky([ProviderError(503)] * 5)
+        retry_call(fn, breaker, retries=5, base_delay=0.5, max_delay=4, sleep=sleeps.append)
+    for i, delay in enumerate(sleeps):
+        assert 0 <= delay <= min(4, 0.5 * 2 ** (i % 5))
+
+    # Com o jitter no máximo, a espera dobra a cada tentativa até max_delay
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+    sleeps = []
+    fn, _ = flaky([ProviderError(503)] * 5)
+    retry_call(fn, breaker, retries=5, base_delay=0.5, max_delay=4, sleep=sleeps.append)
+    assert sleeps == [0.5, 1, 2, 4, 4]
+
+
+def test_retry_call_circuit_open(clock):
+    breaker = CircuitBreaker("gpt", failure_threshold=2, reset_timeout=30)
+    fn, calls = flaky([ProviderError(503)] * 10)
+    sleeps = []
+    with pytest.raises(CircuitOpen):
+        retry_call(fn, breaker, retries=5, sleep=sleeps.append)
+    assert len(calls) == 2              # o circuito abriu e a terceira tentativa nem saiu
+    assert breaker.stats()["rejected"] == 1
+
+
+# --- _call_model ----------------------------------------------------------------
+
+@pytest.fixture
+def providers(monkeypatch):
+    """app.models com provedores falsos: `answers[modelo]` é a resposta ou o erro a levantar."""
+    from app import models
+    answers = {}
+    calls = []
+
+    def attempt(model, prompt, user_id, context=None):
+        calls.append(model)
+        answer = answers[model]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(models, "_attempt", attempt)
+    monkeypatch.setattr(models, "FAILOVER_ENABLED", True)
+    monkeypatch.setattr(models, "HEDGE_ENABLED", False)
+    monkeypatch.setattr(models, "RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(models, "PROVIDER_KEYS", {"gpt": "chave", "gemini": "chave"})
+    monkeypatch.setattr(models, "breakers", {name: CircuitBreaker(name) for name in ("gpt", "gemini")})
+    monkeypatch.setattr(models, "failover_counts", {"gpt": 0, "gemini": 0})
+    return models, answers, calls
+
+
+def test_call_model_fails_over_to_backup(providers):
+    models, answers, calls = providers
+    answers.update(gpt=ProviderError(503), gemini="resposta do gemini")
+    assert models._call_model("gpt", "Olá") == ("gemini", "resposta do gemini")
+    assert calls == ["gpt"] * (models.RETRY_ATTEMPTS + 1) + ["gemini"]
+    assert models.failover_counts["gpt"] == 1
+
+
+def test_call_model_prefers_primary(providers):
+    models, answers, calls = providers
+    answers.update(gpt="resposta do gpt", gemini="resposta do gemini")
+    assert models._call_model("gpt", "Olá") == ("gpt", "resposta do gpt")
+    assert calls == ["gpt"]
+    assert models.failover_counts["gpt"] == 0
+
+
+def test_call_model_without_failover(providers, monkeypatch):
+    models, answers, calls = providers
+    monkeypatch.setattr(models, "FAILOVER_ENABLED", False)
+    answers.update(gpt=ProviderError(503), gemini="resposta do gemini")
+    assert models._call_model("gpt", "Olá") == ("gpt", models.ERRO_GPT)
+    assert "gemini" not in calls
+
+
+def test_call_model_open_circuit_goes_straight_to_backup(providers):
+    models, answers, calls = providers
+    models.breakers["gpt"] = CircuitBreaker("gpt", failure_threshold=1, reset_timeout=60)
+    models.breakers["gpt"].allow()
+    models.breakers["gpt"].record_failure()
+    answers.update(gpt="não deveria ser chamado", gemini="resposta do gemini")
+    assert models._call_model("gpt", "Olá") == ("gemini", "resposta do gemini")
+    assert calls == ["gemini"]
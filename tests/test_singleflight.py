@@ -0,0 +1,118 @@
+"""Testes do single-flight: chamadas iguais em andamento viram uma só.
+
+Uso:
+    python -m pytest tests
+"""
+import asyncio
+import threading
+import time
+import pytest
+from app.singleflight import SingleFlight
+
+
+class Boom(Exception):
+    pass
+
+
+def test_do_collapses_concurrent_calls():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return "ok"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", fn)))
+    leader.start()
+    while flight.stats()["in_flight"] == 0:
+        time.sleep(0.001)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", fn))) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()["collapsed"] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert calls == [1]
+    assert sorted(results) == [("ok", False)] + [("ok", True)] * 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_do_releases_the_key():
+    flight = SingleFlight()
+    assert flight.do("k", lambda: 1) == (1, False)
+    assert flight.do("k", lambda: 2) == (2, False)
+
+
+def test_do_await_shares_result_and_exception():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def ok():
+            calls.append("ok")
+            await asyncio.sleep(0.01)
+            return "ok"
+
+        async def fail():
+            calls.append("fail")
+            await asyncio.sleep(0.01)
+            raise Boom("falhou")
+
+        results = await asyncio.gather(*(flight.do_await("a", ok) for _ in range(3)))
+        errors = await asyncio.gather(*(flight.do_await("b", fail) for _ in range(3)), return_exceptions=True)
+        return calls, results, errors, flight.stats()
+
+    calls, results, errors, stats = asyncio.run(scenario())
+    assert calls == ["ok", "fail"]
+    assert results == [("ok", False), ("ok", True), ("ok", True)]
+    assert len(errors) == 3 and all(isinstance(e, Boom) for e in errors)
+    assert errors[0] is errors[1] is errors[2]
+    assert stats["errors"] == 1 and stats["in_flight"] == 0
+
+
+def test_do_await_leader_cancelled_followers_still_get_result():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def fn():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        leader = asyncio.ensure_future(flight.do_await("k", fn))
+        await started.wait()
+        follower = asyncio.ensure_future(flight.do_await("k", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(scenario()) == ("ok", True)
+
+
+def test_do_async_runs_blocking_fn_once():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return "ok"
+
+        tasks = [asyncio.ensure_future(flight.do_async("k", fn)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return calls, await asyncio.gather(*tasks)
+
+    calls, results = asyncio.run(scenario())
+    assert calls == [1]
+    assert sorted(results) == [("ok", False), ("ok", True), ("ok", True)]